@@ -10,6 +10,7 @@ from utils.pipelines.main import (
     add_or_update_system_message,
     get_tools_specs,
 )
+from ai_gil_utils.metrics import start_metrics_exporter, time_hook
 
 
 class Pipeline:
@@ -29,7 +30,7 @@ class Pipeline:
     async def on_startup(self):
         # This function is called when the server is started.
         print(f"on_startup:{__name__}")
-        pass
+        start_metrics_exporter()
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
@@ -40,10 +41,12 @@ class Pipeline:
         """
         Do something before the pipeline. So before the message goes through the LLM
         """
-        return body
+        with time_hook(self.name, "inlet", body.get("model")):
+            return body
 
     async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
         """
         Do something after the pipeline. So after the message goes through the LLM
         """
-        return body
+        with time_hook(self.name, "outlet", body.get("model")):
+            return body
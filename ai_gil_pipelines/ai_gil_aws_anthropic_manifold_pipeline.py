@@ -1,5 +1,4 @@
 import os
-import boto3
 from botocore.exceptions import ClientError
 from schemas import OpenAIChatMessage
 from typing import List, Union, Generator, Iterator
@@ -7,16 +6,30 @@ from pydantic import BaseModel
 import json
 
 from utils.pipelines.main import pop_system_message
+from ai_gil_utils.bedrock_regions import get_bedrock_pool
+from ai_gil_utils.context_window import ContextWindow
+from ai_gil_utils.image_preprocessing import MAX_IMAGE_EDGE, prepare_image
+from ai_gil_utils.logs import get_logger, log_metrics
+from ai_gil_utils.message_cache import ConversionCache
+from ai_gil_utils.metrics import RequestMetrics, start_metrics_exporter
+from ai_gil_utils.prompt_caching import add_cache_breakpoints
 from ai_gil_utils.private.prompts.video_script import TITLE_AND_HOOK_SYSTEM_PROMPT
+from ai_gil_utils.resilience import CircuitOpenError, call_with_retry, retry_stream
+from ai_gil_utils.single_flight import coalesce_identical
+from ai_gil_utils.startup import start_warm_up
+from ai_gil_utils.stream_events import ANTHROPIC_SKIPPED_EVENTS, coalesce_deltas, decode_events
 
 AWS_REGION = "us-east-1"  # GIL: sonnet 3.5 is only located here
 
+logger = get_logger("ai_gil_aws_anthropic")
+
 
 class Pipeline:
     class Valves(BaseModel):
         AWS_ACCESS_KEY_ID: str = ""
         AWS_SECRET_ACCESS_KEY: str = ""
-        AWS_REGION: str = AWS_REGION
+        AWS_REGION: str = AWS_REGION  # where every model is called, unless BEDROCK_MODEL_REGIONS lists it
+        PROMPT_CACHING: bool = True  # only used by models that support it
 
     def __init__(self):
         self.type = "manifold"
@@ -31,13 +44,16 @@ class Pipeline:
             }
         )
         self.client = self.create_bedrock_client()
+        self.message_cache = ConversionCache()
+        self.context_window = ContextWindow()
 
     def create_bedrock_client(self):
-        return boto3.client(
-            service_name="bedrock-runtime",
+        # AWS_REGION, or the regions of the model in BEDROCK_MODEL_REGIONS, failing over when one throttles
+        return get_bedrock_pool(
             region_name=self.valves.AWS_REGION,
             aws_access_key_id=self.valves.AWS_ACCESS_KEY_ID,
             aws_secret_access_key=self.valves.AWS_SECRET_ACCESS_KEY,
+            model_family="anthropic",
         )
 
     def get_anthropic_models(self):
@@ -57,6 +73,22 @@ class Pipeline:
                 "name": "claude-3.5-sonnet (video_hook)",
                 "system_prompt": TITLE_AND_HOOK_SYSTEM_PROMPT,
             },
+            # Models with prompt caching (ai_gil_utils.prompt_caching), through their US inference profiles
+            {
+                "id": "us.anthropic.claude-3-5-haiku-20241022-v1:0",
+                "name": "claude-3.5-haiku",
+                "system_prompt": None,
+            },
+            {
+                "id": "us.anthropic.claude-3-7-sonnet-20250219-v1:0",
+                "name": "claude-3.7-sonnet",
+                "system_prompt": None,
+            },
+            {
+                "id": "us.anthropic.claude-3-7-sonnet-20250219-v1:0__video_hook",
+                "name": "claude-3.7-sonnet (video_hook)",
+                "system_prompt": TITLE_AND_HOOK_SYSTEM_PROMPT,
+            },
         ]
 
     async def on_startup(self):
@@ -71,7 +103,8 @@ class Pipeline:
         print("JOE ROGAN")
         print("JOE ROGAN")
         print("JOE ROGAN")
-        pass
+        start_metrics_exporter()
+        start_warm_up(self.id, self.warm_up)
 
     async def on_shutdown(self):
         print(f"on_shutdown:{__name__}")
@@ -84,10 +117,16 @@ class Pipeline:
     def pipelines(self) -> List[dict]:
         return self.get_anthropic_models()
 
+    def warm_up(self):
+        """Build the Bedrock clients ahead of the first request"""
+        self.client.warm_up({model["id"].split("__")[0] for model in self.get_anthropic_models()})
+
     def process_image(self, image_data):
         if image_data["url"].startswith("data:image"):
             mime_type, base64_data = image_data["url"].split(",", 1)
             media_type = mime_type.split(":")[1].split(";")[0]
+            # Downscale to what Claude actually looks at, so less is uploaded
+            base64_data, media_type = prepare_image(base64_data, media_type, MAX_IMAGE_EDGE["anthropic"])
             return {
                 "type": "image",
                 "source": {
@@ -102,14 +141,34 @@ class Pipeline:
                 "source": {"type": "url", "url": image_data["url"]},
             }
 
+    def process_message(self, message: dict) -> dict:
+        if isinstance(message.get("content"), list):
+            processed_content = []
+            for item in message["content"]:
+                if item["type"] == "text":
+                    processed_content.append({"type": "text", "text": item["text"]})
+                elif item["type"] == "image_url":
+                    processed_content.append(self.process_image(item["image_url"]))
+        else:
+            processed_content = [{"type": "text", "text": message.get("content", "")}]
+
+        return {"role": message["role"], "content": processed_content}
+
+    @coalesce_identical("ai_gil_aws_anthropic")
     def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
+        metrics = RequestMetrics(self.id, model_id)
         try:
+            chat_id = body.get("chat_id")
+
             # Remove unnecessary keys
             for key in ["user", "chat_id", "title"]:
                 body.pop(key, None)
 
+            # Fit the history in the model's context window before converting it
+            messages = self.context_window.fit(chat_id, model_id, messages, body.get("max_tokens"))
+
             system_message, messages = pop_system_message(messages)
 
             system_prompt = next(
@@ -119,37 +178,24 @@ class Pipeline:
 
             model_id = model_id.split("__")[0]
 
-            processed_messages = []
+            # Only the messages added since the previous turn of this chat are converted
+            processed_messages = self.message_cache.convert(chat_id, messages, self.process_message)
+
             image_count = 0
             total_image_size = 0
+            for message in processed_messages:
+                for item in message["content"]:
+                    if item["type"] != "image":
+                        continue
 
-            for message in messages:
-                processed_content = []
-                if isinstance(message.get("content"), list):
-                    for item in message["content"]:
-                        if item["type"] == "text":
-                            processed_content.append({"type": "text", "text": item["text"]})
-                        elif item["type"] == "image_url":
-                            if image_count >= 5:
-                                raise ValueError("Maximum of 5 images per API call exceeded")
+                    image_count += 1
+                    if image_count > 5:
+                        raise ValueError("Maximum of 5 images per API call exceeded")
 
-                            processed_image = self.process_image(item["image_url"])
-                            processed_content.append(processed_image)
-
-                            if processed_image["source"]["type"] == "base64":
-                                image_size = len(processed_image["source"]["data"]) * 3 / 4
-                            else:
-                                image_size = 0
-
-                            total_image_size += image_size
-                            if total_image_size > 100 * 1024 * 1024:
-                                raise ValueError("Total size of images exceeds 100 MB limit")
-
-                            image_count += 1
-                else:
-                    processed_content = [{"type": "text", "text": message.get("content", "")}]
-
-                processed_messages.append({"role": message["role"], "content": processed_content})
+                    if item["source"]["type"] == "base64":
+                        total_image_size += len(item["source"]["data"]) * 3 / 4
+                        if total_image_size > 100 * 1024 * 1024:
+                            raise ValueError("Total size of images exceeds 100 MB limit")
 
             # Prepare the payload
             payload = {
@@ -163,26 +209,46 @@ class Pipeline:
                 **({"system": str(system_prompt)} if system_prompt else {}),
             }
 
+            if self.valves.PROMPT_CACHING:
+                payload = add_cache_breakpoints(payload, model_id)
+
             if body.get("stream", False):
-                return self.stream_response(model_id, payload)
+                return metrics.track(
+                    coalesce_deltas(retry_stream(self.id, lambda: self.stream_response(model_id, payload, metrics)))
+                )
             else:
-                return self.get_completion(model_id, payload)
-        except ClientError as e:
+                return self.get_completion(model_id, payload, metrics)
+        except (ClientError, CircuitOpenError) as e:
+            metrics.finish(status="error")
             return f"Error: {e}"
 
-    def stream_response(self, model_id: str, payload: dict) -> Generator:
+    def stream_response(self, model_id: str, payload: dict, metrics: RequestMetrics) -> Generator:
+        body = json.dumps(payload)
+        metrics.record_payload(len(body))
         response = self.client.invoke_model_with_response_stream(
-            modelId=model_id, contentType="application/json", accept="application/json", body=json.dumps(payload)
+            modelId=model_id, contentType="application/json", accept="application/json", body=body
         )
-        for event in response.get("body"):
-            chunk = json.loads(event["chunk"]["bytes"].decode())
+        usage = {}
+        for chunk in decode_events(response.get("body"), ANTHROPIC_SKIPPED_EVENTS):
             if chunk["type"] == "content_block_start":
                 yield chunk["content_block"]["text"]
             elif chunk["type"] == "content_block_delta":
                 yield chunk["delta"]["text"]
-
-    def get_completion(self, model_id: str, payload: dict) -> str:
+            elif chunk["type"] == "message_start":
+                usage.update(chunk["message"].get("usage", {}))
+            elif chunk["type"] == "message_delta":
+                usage.update(chunk.get("usage", {}))
+        metrics.record_usage(usage)
+        log_metrics(logger, metrics, mode="stream")
+
+    def get_completion(self, model_id: str, payload: dict, metrics: RequestMetrics) -> str:
         # print("JOE ROGAN: ", payload)
-        response = self.client.invoke_model(modelId=model_id, body=json.dumps(payload))
+        body = json.dumps(payload)
+        metrics.record_payload(len(body))
+        response = call_with_retry(self.id, self.client.invoke_model, modelId=model_id, body=body)
         response_body = json.loads(response["body"].read())
-        return response_body["content"][0]["text"]
+        metrics.record_usage(response_body.get("usage", {}))
+        text = response_body["content"][0]["text"]
+        metrics.finish(text)
+        log_metrics(logger, metrics, mode="invoke_model")
+        return text
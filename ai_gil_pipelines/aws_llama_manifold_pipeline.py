@@ -1,5 +1,4 @@
 import os
-import boto3
 from botocore.exceptions import ClientError
 from schemas import OpenAIChatMessage
 from typing import List, Union, Generator, Iterator
@@ -7,13 +6,25 @@ from pydantic import BaseModel
 import json
 
 from utils.pipelines.main import pop_system_message
+from ai_gil_utils.bedrock_clients import get_invocation_usage
+from ai_gil_utils.bedrock_regions import get_bedrock_pool
+from ai_gil_utils.context_window import ContextWindow
+from ai_gil_utils.logs import get_logger, log_metrics, log_payload
+from ai_gil_utils.message_cache import ConversionCache
+from ai_gil_utils.metrics import RequestMetrics, start_metrics_exporter
+from ai_gil_utils.resilience import call_with_retry, retry_stream
+from ai_gil_utils.single_flight import coalesce_identical
+from ai_gil_utils.startup import start_warm_up
+from ai_gil_utils.stream_events import coalesce_deltas, decode_events
+
+logger = get_logger("aws_meta")
 
 
 class Pipeline:
     class Valves(BaseModel):
         AWS_ACCESS_KEY_ID: str = ""
         AWS_SECRET_ACCESS_KEY: str = ""
-        AWS_REGION: str = ""
+        AWS_REGION: str = ""  # where every model is called, unless BEDROCK_MODEL_REGIONS lists it
 
     def __init__(self):
         self.type = "manifold"
@@ -28,13 +39,16 @@ class Pipeline:
             }
         )
         self.client = self.create_bedrock_client()
+        self.message_cache = ConversionCache()
+        self.context_window = ContextWindow()
 
     def create_bedrock_client(self):
-        return boto3.client(
-            service_name="bedrock-runtime",
+        # AWS_REGION, or the regions of the model in BEDROCK_MODEL_REGIONS, failing over when one throttles
+        return get_bedrock_pool(
             region_name=self.valves.AWS_REGION,
             aws_access_key_id=self.valves.AWS_ACCESS_KEY_ID,
             aws_secret_access_key=self.valves.AWS_SECRET_ACCESS_KEY,
+            model_family="meta",
         )
 
     def get_meta_models(self):
@@ -46,7 +60,8 @@ class Pipeline:
 
     async def on_startup(self):
         print(f"on_startup:{__name__}")
-        pass
+        start_metrics_exporter()
+        start_warm_up(self.id, self.warm_up)
 
     async def on_shutdown(self):
         print(f"on_shutdown:{__name__}")
@@ -59,20 +74,32 @@ class Pipeline:
     def pipelines(self) -> List[dict]:
         return self.get_meta_models()
 
+    def warm_up(self):
+        """Build the Bedrock clients ahead of the first request"""
+        self.client.warm_up({model["id"] for model in self.get_meta_models()})
+
+    def process_message(self, message: dict) -> str:
+        content = message.get("content", "")
+        role_tag = f"<|{message['role']}_id|>"
+        return f"{role_tag}\n\n{content}\n<|eot_id|>\n"
+
+    @coalesce_identical("aws_meta")
     def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
+        metrics = RequestMetrics(self.id, model_id)
         try:
+            chat_id = body.get("chat_id")
+
             # Remove unnecessary keys
             for key in ["user", "chat_id", "title"]:
                 body.pop(key, None)
 
-            processed_messages = ""
+            # Fit the history in the model's context window before converting it
+            messages = self.context_window.fit(chat_id, model_id, messages, body.get("max_tokens"))
 
-            for message in messages:
-                content = message.get("content", "")
-                role_tag = f"<|{message['role']}_id|>"
-                processed_messages += f"{role_tag}\n\n{content}\n<|eot_id|>\n"
+            # Only the messages added since the previous turn of this chat are converted
+            processed_messages = "".join(self.message_cache.convert(chat_id, messages, self.process_message))
 
             system_message = (
                 "You are an AI assistant. You will receive messages structured as follows: "
@@ -94,12 +121,40 @@ class Pipeline:
                 "top_p": body.get("top_p", 0.9),
                 "prompt": prompt,
             }
-            return self.get_completion(model_id, payload)
+
+            if body.get("stream", False):
+                return metrics.track(
+                    coalesce_deltas(retry_stream(self.id, lambda: self.stream_response(model_id, payload, metrics)))
+                )
+            else:
+                return self.get_completion(model_id, payload, metrics)
         except Exception as e:
+            metrics.finish(status="error")
             return f"Error: {e}"
 
-    def get_completion(self, model_id: str, payload: dict) -> str:
-        print(f"Getting completion for model {model_id} with payload {payload}")
-        response = self.client.invoke_model(modelId=model_id, body=json.dumps(payload))
+    def get_completion(self, model_id: str, payload: dict, metrics: RequestMetrics) -> str:
+        log_payload(logger, "Getting completion", payload, model_id=model_id)
+        body = json.dumps(payload)
+        metrics.record_payload(len(body))
+        response = call_with_retry(self.id, self.client.invoke_model, modelId=model_id, body=body)
         response_body = json.loads(response["body"].read())
-        return response_body["generation"]
+        metrics.record_usage(get_invocation_usage(response))
+        text = response_body["generation"]
+        metrics.finish(text)
+        log_metrics(logger, metrics, mode="invoke_model")
+        return text
+
+    def stream_response(self, model_id: str, payload: dict, metrics: RequestMetrics) -> Generator:
+        body = json.dumps(payload)
+        metrics.record_payload(len(body))
+        response = self.client.invoke_model_with_response_stream(
+            modelId=model_id, contentType="application/json", accept="application/json", body=body
+        )
+        for chunk in decode_events(response.get("body")):
+            text = chunk.get("generation")
+            if text:
+                yield text
+            if "amazon-bedrock-invocationMetrics" in chunk:
+                # Only on the last event
+                metrics.record_usage(chunk["amazon-bedrock-invocationMetrics"])
+        log_metrics(logger, metrics, mode="stream")
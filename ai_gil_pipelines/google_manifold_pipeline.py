@@ -9,13 +9,77 @@ requirements: google-generativeai
 environment_variables: GOOGLE_API_KEY
 """
 
-from typing import List, Union, Iterator
+from typing import List, Union, Iterator, AsyncIterator
+from collections import OrderedDict
 import os
+import threading
 
 from pydantic import BaseModel, Field
 
-import google.generativeai as genai
-from google.generativeai.types import GenerationConfig
+from ai_gil_utils.context_window import ContextWindow
+from ai_gil_utils.image_preprocessing import MAX_IMAGE_EDGE, prepare_image
+from ai_gil_utils.message_cache import ConversionCache
+from ai_gil_utils.metrics import RequestMetrics, start_metrics_exporter
+from ai_gil_utils.model_discovery import ModelDiscovery
+from ai_gil_utils.resilience import call_with_retry, call_with_retry_async, retry_stream
+from ai_gil_utils.single_flight import coalesce_identical
+from ai_gil_utils.startup import start_warm_up
+
+GENAI_MODEL_CACHE_SIZE = int(os.getenv("GENAI_MODEL_CACHE_SIZE", "32"))
+
+# google.generativeai takes ~0.5 s to import, so it is only imported by the
+# warm-up or the first request instead of when the server loads this file
+genai = None
+GenerationConfig = None
+_genai_lock = threading.Lock()
+
+
+def load_genai():
+    global genai, GenerationConfig
+    if genai is None:
+        with _genai_lock:
+            if genai is None:
+                import google.generativeai
+                from google.generativeai.types import GenerationConfig as generation_config
+
+                GenerationConfig = generation_config
+                genai = google.generativeai
+    return genai
+
+
+def get_permissive_safety_settings() -> dict:
+    harm_category = genai.types.HarmCategory
+    block_none = genai.types.HarmBlockThreshold.BLOCK_NONE
+    return {
+        harm_category.HARM_CATEGORY_HARASSMENT: block_none,
+        harm_category.HARM_CATEGORY_HATE_SPEECH: block_none,
+        harm_category.HARM_CATEGORY_SEXUALLY_EXPLICIT: block_none,
+        harm_category.HARM_CATEGORY_DANGEROUS_CONTENT: block_none,
+    }
+
+
+def get_contents_size(contents: List[dict]) -> int:
+    """Approximate request size: the text and inline image data of every part"""
+    size = 0
+    for content in contents:
+        for part in content["parts"]:
+            if "text" in part:
+                size += len(part["text"])
+            elif "inline_data" in part:
+                size += len(part["inline_data"]["data"])
+    return size
+
+
+def record_usage(metrics: RequestMetrics, response) -> None:
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        metrics.record_usage(
+            {
+                "prompt_token_count": usage.prompt_token_count,
+                "candidates_token_count": usage.candidates_token_count,
+                "cached_content_token_count": usage.cached_content_token_count,
+            }
+        )
 
 
 class Pipeline:
@@ -35,17 +99,34 @@ class Pipeline:
         self.valves = self.Valves(
             **{"GOOGLE_API_KEY": os.getenv("GOOGLE_API_KEY", ""), "USE_PERMISSIVE_SAFETY": False}
         )
-        self.pipelines = []
-
-        genai.configure(api_key=self.valves.GOOGLE_API_KEY)
-        self.update_pipelines()
+        self.message_cache = ConversionCache()
+        self.context_window = ContextWindow()
+        self.models = OrderedDict()
+        self.models_lock = threading.Lock()  # pipe runs on worker threads, configure also in model discovery
+        self.configured_api_key = None
+
+        # Serve the cached model list right away and fetch the fresh one in the background
+        self.model_discovery = ModelDiscovery(
+            "google_genai",
+            self.get_google_models,
+            self.set_pipelines,
+            error_models=[
+                {
+                    "id": "error",
+                    "name": "Could not fetch models from Google, please update the API Key in the valves.",
+                }
+            ],
+        )
+        self.pipelines = self.model_discovery.models
+        self.model_discovery.refresh()
 
     async def on_startup(self) -> None:
         """This function is called when the server is started."""
 
         print(f"on_startup:{__name__}")
-        genai.configure(api_key=self.valves.GOOGLE_API_KEY)
-        self.update_pipelines()
+        start_metrics_exporter()
+        start_warm_up(self.id, self.warm_up)
+        await self.model_discovery.wait_if_empty()
 
     async def on_shutdown(self) -> None:
         """This function is called when the server is stopped."""
@@ -56,123 +137,222 @@ class Pipeline:
         """This function is called when the valves are updated."""
 
         print(f"on_valves_updated:{__name__}")
-        genai.configure(api_key=self.valves.GOOGLE_API_KEY)
-        self.update_pipelines()
+        self.configure()
+        self.model_discovery.refresh(force=True)
+
+    def warm_up(self) -> None:
+        """Import and configure genai ahead of the first request"""
 
-    def update_pipelines(self) -> None:
-        """Update the available models from Google GenAI"""
+        self.configure()
+
+    def configure(self) -> None:
+        """Configure genai once per API key change, models built with the old key are dropped"""
+
+        if self.valves.GOOGLE_API_KEY != self.configured_api_key:
+            load_genai()
+            with self.models_lock:
+                if self.valves.GOOGLE_API_KEY != self.configured_api_key:
+                    genai.configure(api_key=self.valves.GOOGLE_API_KEY)
+                    self.configured_api_key = self.valves.GOOGLE_API_KEY
+                    self.models.clear()
+
+    def set_pipelines(self, models: List[dict]) -> None:
+        self.pipelines = models
+
+    def get_google_models(self) -> List[dict]:
+        """Fetch the available models from Google GenAI (runs in the model discovery thread)"""
 
         if self.valves.GOOGLE_API_KEY:
-            try:
-                models = genai.list_models()
-                desired_models = {
-                    "Gemini 1.5 Flash Latest",
-                    "Gemini 1.5 Pro Latest",
-                    "Gemini 1.5 Pro Experimental 0801",
-                }  # Gil: There are a lot of models I don't care to see in the UI
-                self.pipelines = [
-                    {
-                        "id": model.name[7:],  # the "models/" part messeses up the URL
-                        "name": model.display_name,
-                    }
-                    for model in models
-                    if "generateContent" in model.supported_generation_methods
-                    if model.name[:7] == "models/"
-                    if model.display_name in desired_models
-                ]
-            except Exception:
-                self.pipelines = [
-                    {
-                        "id": "error",
-                        "name": "Could not fetch models from Google, please update the API Key in the valves.",
-                    }
-                ]
-        else:
-            self.pipelines = []
+            self.configure()
+            models = genai.list_models()
+            desired_models = {
+                "Gemini 1.5 Flash Latest",
+                "Gemini 1.5 Pro Latest",
+                "Gemini 1.5 Pro Experimental 0801",
+            }  # Gil: There are a lot of models I don't care to see in the UI
+            return [
+                {
+                    "id": model.name[7:],  # the "models/" part messeses up the URL
+                    "name": model.display_name,
+                }
+                for model in models
+                if "generateContent" in model.supported_generation_methods
+                if model.name[:7] == "models/"
+                if model.display_name in desired_models
+            ]
+        return []
+
+    def process_message(self, message: dict) -> dict:
+        """Convert an OpenAI style message to Gemini contents"""
+
+        role = "user" if message["role"] == "user" else "model"
+        if not isinstance(message.get("content"), list):
+            return {"role": role, "parts": [{"text": message["content"]}]}
+
+        parts = []
+        for content in message["content"]:
+            if content["type"] == "text":
+                parts.append({"text": content["text"]})
+            elif content["type"] == "image_url":
+                image_url = content["image_url"]["url"]
+                if image_url.startswith("data:image"):
+                    mime_type, image_data = image_url.split(",", 1)
+                    media_type = mime_type.split(":")[1].split(";")[0]
+                    image_data, media_type = prepare_image(image_data, media_type, MAX_IMAGE_EDGE["gemini"])
+                    parts.append({"inline_data": {"mime_type": media_type, "data": image_data}})
+                else:
+                    parts.append({"image_url": image_url})
+        return {"role": role, "parts": parts}
+
+    def get_model(self, model_id: str, system_message: Union[str, None]) -> "genai.GenerativeModel":
+        """Reuse configured models per (model, system instruction, safety profile)"""
+
+        self.configure()
+        key = (model_id, system_message, self.valves.USE_PERMISSIVE_SAFETY)
+        with self.models_lock:
+            model = self.models.get(key)
+            if model is None:
+                # Native system instruction, instead of resending the system prompt as a user turn
+                model = genai.GenerativeModel(
+                    model_name=model_id,
+                    system_instruction=system_message or None,
+                    safety_settings=get_permissive_safety_settings() if self.valves.USE_PERMISSIVE_SAFETY else None,
+                )
+                self.models[key] = model
+                while len(self.models) > GENAI_MODEL_CACHE_SIZE:
+                    self.models.popitem(last=False)
+            else:
+                self.models.move_to_end(key)
+        return model
+
+    def build_request(self, model_id: str, messages: List[dict], body: dict, metrics: RequestMetrics):
+        """Shared by pipe and pipe_async: returns the model and the generate_content arguments"""
+
+        # Fit the history in the model's context window before converting it
+        messages = self.context_window.fit(body.get("chat_id"), model_id, messages, body.get("max_tokens"))
+
+        system_message = next((msg["content"] for msg in messages if msg["role"] == "system"), None)
+
+        # Only the messages added since the previous turn of this chat are converted
+        contents = self.message_cache.convert(
+            body.get("chat_id"),
+            [message for message in messages if message["role"] != "system"],
+            self.process_message,
+        )
+
+        model = self.get_model(model_id, system_message)
+        metrics.record_payload(get_contents_size(contents))
+
+        generation_config = GenerationConfig(
+            temperature=body.get("temperature", 0.7),
+            top_p=body.get("top_p", 0.9),
+            top_k=body.get("top_k", 40),
+            max_output_tokens=body.get("max_tokens", 8192),
+            stop_sequences=body.get("stop", []),
+        )
+
+        # The permissive settings are already part of the model
+        safety_settings = None if self.valves.USE_PERMISSIVE_SAFETY else body.get("safety_settings")
+
+        return model, {
+            "contents": contents,
+            "generation_config": generation_config,
+            "safety_settings": safety_settings,
+            "stream": body.get("stream", False),
+        }
+
+    def validate(self, model_id: str) -> Union[str, None]:
+        """Return an error message when the request cannot be served"""
 
-    def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Iterator]:
         if not self.valves.GOOGLE_API_KEY:
             return "Error: GOOGLE_API_KEY is not set"
+        if not model_id.startswith("gemini-"):
+            return f"Error: Invalid model name format: {model_id}"
+        return None
 
-        try:
-            genai.configure(api_key=self.valves.GOOGLE_API_KEY)
-
-            if model_id.startswith("google_genai."):
-                model_id = model_id[12:]
-            model_id = model_id.lstrip(".")
+    def normalize_model_id(self, model_id: str) -> str:
+        if model_id.startswith("google_genai."):
+            model_id = model_id[12:]
+        return model_id.lstrip(".")
 
-            if not model_id.startswith("gemini-"):
-                return f"Error: Invalid model name format: {model_id}"
+    @coalesce_identical("google_genai")
+    def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Iterator]:
+        model_id = self.normalize_model_id(model_id)
+        error = self.validate(model_id)
+        if error:
+            return error
 
+        metrics = RequestMetrics(self.id, model_id)
+        try:
             print(f"Pipe function called for model: {model_id}")
             print(f"Stream mode: {body.get('stream', False)}")
 
-            system_message = next((msg["content"] for msg in messages if msg["role"] == "system"), None)
-
-            contents = []
-            for message in messages:
-                if message["role"] != "system":
-                    if isinstance(message.get("content"), list):
-                        parts = []
-                        for content in message["content"]:
-                            if content["type"] == "text":
-                                parts.append({"text": content["text"]})
-                            elif content["type"] == "image_url":
-                                image_url = content["image_url"]["url"]
-                                if image_url.startswith("data:image"):
-                                    image_data = image_url.split(",")[1]
-                                    parts.append({"inline_data": {"mime_type": "image/jpeg", "data": image_data}})
-                                else:
-                                    parts.append({"image_url": image_url})
-                        contents.append({"role": message["role"], "parts": parts})
-                    else:
-                        contents.append(
-                            {
-                                "role": "user" if message["role"] == "user" else "model",
-                                "parts": [{"text": message["content"]}],
-                            }
-                        )
-
-            if system_message:
-                contents.insert(0, {"role": "user", "parts": [{"text": f"System: {system_message}"}]})
-
-            model = genai.GenerativeModel(model_name=model_id)
-
-            generation_config = GenerationConfig(
-                temperature=body.get("temperature", 0.7),
-                top_p=body.get("top_p", 0.9),
-                top_k=body.get("top_k", 40),
-                max_output_tokens=body.get("max_tokens", 8192),
-                stop_sequences=body.get("stop", []),
-            )
-
-            if self.valves.USE_PERMISSIVE_SAFETY:
-                safety_settings = {
-                    genai.types.HarmCategory.HARM_CATEGORY_HARASSMENT: genai.types.HarmBlockThreshold.BLOCK_NONE,
-                    genai.types.HarmCategory.HARM_CATEGORY_HATE_SPEECH: genai.types.HarmBlockThreshold.BLOCK_NONE,
-                    genai.types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: genai.types.HarmBlockThreshold.BLOCK_NONE,
-                    genai.types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: genai.types.HarmBlockThreshold.BLOCK_NONE,
-                }
+            model, request = self.build_request(model_id, messages, body, metrics)
+            response = call_with_retry(self.id, model.generate_content, **request)
+
+            if body.get("stream", False):
+                # Reopened when it fails before the first chunk
+                stream = retry_stream(
+                    self.id,
+                    lambda: self.stream_response(model.generate_content(**request), metrics),
+                    self.stream_response(response, metrics),
+                )
+                return metrics.track(stream)
             else:
-                safety_settings = body.get("safety_settings")
+                record_usage(metrics, response)
+                metrics.finish(response.text)
+                return response.text
+
+        except Exception as e:
+            print(f"Error generating content: {e}")
+            metrics.finish(status="error")
+            return f"An error occurred: {str(e)}"
 
-            response = model.generate_content(
-                contents,
-                generation_config=generation_config,
-                safety_settings=safety_settings,
-                stream=body.get("stream", False),
-            )
+    def stream_response(self, response, metrics: RequestMetrics):
+        chunk = None
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+        # The last chunk carries the usage of the whole response
+        record_usage(metrics, chunk)
+
+    async def pipe_async(
+        self, user_message: str, model_id: str, messages: List[dict], body: dict
+    ) -> Union[str, AsyncIterator[str]]:
+        """
+        Async variant of pipe built on generate_content_async.
+
+        A stream is an async generator, so waiting on Gemini holds no worker
+        thread: many concurrent streams can share one event loop. The call goes
+        through the same circuit breaker and retries as pipe, but unlike pipe
+        a stream that fails before its first chunk is not reopened.
+        """
+
+        model_id = self.normalize_model_id(model_id)
+        error = self.validate(model_id)
+        if error:
+            return error
+
+        metrics = RequestMetrics(self.id, model_id)
+        try:
+            model, request = self.build_request(model_id, messages, body, metrics)
+            response = await call_with_retry_async(self.id, model.generate_content_async, **request)
 
             if body.get("stream", False):
-                return self.stream_response(response)
+                return metrics.track_async(self.stream_response_async(response, metrics))
             else:
+                record_usage(metrics, response)
+                metrics.finish(response.text)
                 return response.text
 
         except Exception as e:
             print(f"Error generating content: {e}")
+            metrics.finish(status="error")
             return f"An error occurred: {str(e)}"
 
-    def stream_response(self, response):
-        for chunk in response:
+    async def stream_response_async(self, response, metrics: RequestMetrics) -> AsyncIterator[str]:
+        chunk = None
+        async for chunk in response:
             if chunk.text:
                 yield chunk.text
+        record_usage(metrics, chunk)
@@ -0,0 +1,127 @@
+"""
+title: Model Router Manifold Pipeline
+description: Virtual "fast" and "cheap" models that send each request to the best Bedrock, OpenAI or Google model
+"""
+
+import importlib.util
+import os
+import threading
+import time
+from typing import List, Union, Generator, Iterator
+
+from pydantic import BaseModel
+
+from ai_gil_utils.metrics import ROUTED_REQUESTS, start_metrics_exporter
+from ai_gil_utils.model_router import MODEL_PROFILES, ModelRouter
+from ai_gil_utils.tokens import CHARS_PER_TOKEN
+
+PIPELINES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# A backend is only a candidate when its pipeline has credentials
+REQUIRED_ENV = {
+    "aws_anthropic_manifold_pipeline": "AWS_ACCESS_KEY_ID",
+    "aws_llama_manifold_pipeline": "AWS_ACCESS_KEY_ID",
+    "aws_mistral_manifold_pipeline": "AWS_ACCESS_KEY_ID",
+    "openai_manifold_pipeline": "OPENAI_API_KEY",
+    "google_manifold_pipeline": "GOOGLE_API_KEY",
+}
+ERROR_PREFIXES = ("Error", "An error occurred")
+
+
+class Pipeline:
+    class Valves(BaseModel):
+        CANDIDATES: str = ""  # comma separated model ids to route between, empty for every configured one
+        SHOW_ROUTE: bool = False  # print the chosen model for each request
+
+    def __init__(self):
+        self.type = "manifold"
+        self.id = "router"
+        self.name = "Router: "
+
+        self.valves = self.Valves(**{"CANDIDATES": os.getenv("ROUTER_CANDIDATES", "")})
+        self.router = ModelRouter()
+        # The other pipeline files, loaded on first use: the server does not share its instances
+        self.backends = {}
+        self.backends_lock = threading.Lock()
+
+    async def on_startup(self):
+        print(f"on_startup:{__name__}")
+        start_metrics_exporter()
+
+    async def on_shutdown(self):
+        print(f"on_shutdown:{__name__}")
+        pass
+
+    def pipelines(self) -> List[dict]:
+        return [
+            {"id": "fast", "name": "fast"},
+            {"id": "cheap", "name": "cheap"},
+        ]
+
+    def candidates(self) -> List[str]:
+        model_ids = [model_id.strip() for model_id in self.valves.CANDIDATES.split(",") if model_id.strip()]
+        return [
+            model_id
+            for model_id in model_ids or MODEL_PROFILES
+            if model_id in MODEL_PROFILES and os.getenv(REQUIRED_ENV[MODEL_PROFILES[model_id]["pipeline"]])
+        ]
+
+    def get_backend(self, name: str):
+        with self.backends_lock:
+            backend = self.backends.get(name)
+            if backend is None:
+                spec = importlib.util.spec_from_file_location(f"router_{name}", os.path.join(PIPELINES_DIR, f"{name}.py"))
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+                backend = self.backends[name] = module.Pipeline()
+            return backend
+
+    def pipe(
+        self, user_message: str, model_id: str, messages: List[dict], body: dict
+    ) -> Union[str, Generator, Iterator]:
+        strategy = model_id[len(self.id) + 1 :] if model_id.startswith(f"{self.id}.") else model_id
+        if strategy not in ModelRouter.STRATEGIES:
+            return f"Error: Unknown routing strategy: {model_id}"
+
+        backend_model_id = self.router.choose(strategy, messages, body.get("max_tokens"), self.candidates())
+        if backend_model_id is None:
+            return "Error: No configured model can take this request"
+        if self.valves.SHOW_ROUTE:
+            print(f"Routing {strategy} request to {backend_model_id}")
+        ROUTED_REQUESTS.inc((strategy, backend_model_id))
+
+        backend = self.get_backend(MODEL_PROFILES[backend_model_id]["pipeline"])
+        start = time.perf_counter()
+        try:
+            result = backend.pipe(user_message, backend_model_id, messages, body)
+        except Exception:
+            self.router.record(backend_model_id, error=True)
+            raise
+
+        if isinstance(result, str):
+            error = result.startswith(ERROR_PREFIXES)
+            self.router.record(backend_model_id, ttft=None if error else time.perf_counter() - start, error=error)
+            return result
+        return self.track(backend_model_id, result, start)
+
+    def track(self, model_id: str, stream: Iterator, start: float) -> Generator:
+        """Pass the stream through, feeding its latency and throughput back to the router"""
+        first_token_at = None
+        chars = 0
+        try:
+            for chunk in stream:
+                if chunk and first_token_at is None:
+                    first_token_at = time.perf_counter()
+                if type(chunk) is str:
+                    chars += len(chunk)
+                yield chunk
+        except Exception:
+            self.router.record(model_id, error=True)
+            raise
+
+        if first_token_at is None:
+            self.router.record(model_id, error=True)
+            return
+        generation_time = time.perf_counter() - first_token_at
+        tokens_per_second = chars / CHARS_PER_TOKEN / generation_time if generation_time > 0.1 else None
+        self.router.record(model_id, ttft=first_token_at - start, tokens_per_second=tokens_per_second)
@@ -4,15 +4,22 @@ from typing import List, Union, Generator, Iterator
 
 from pydantic import BaseModel
 
-from openai import OpenAI
 import os
-import requests
+import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
+from ai_gil_utils.http_sessions import get_http_session
+from ai_gil_utils.image_store import CHUNK_SIZE, THUMBNAIL_DIR_NAME, ImageStore
+from ai_gil_utils.metrics import RequestMetrics, start_metrics_exporter
+from ai_gil_utils.model_discovery import ModelDiscovery
+from ai_gil_utils.startup import start_warm_up
+
 
 SAVE_DIR = "/app/image_generations"
-SHOW_DIR = "/cache/image/generations"
-os.makedirs(SHOW_DIR, exist_ok=True)
+SHOW_DIR = "/cache/image/generations"  # only in the openwebui container, nothing is written there from here
 
 
 class Pipeline:
@@ -25,22 +32,34 @@ class Pipeline:
         OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "your-access-key-id-here")
         IMAGE_SIZE: str = "1024x1024"
         NUM_IMAGES: int = 1
+        RESPONSE_FORMAT: str = "url"  # "b64_json" returns the image inline, skipping the CDN download
 
     def __init__(self):
         self.type = "manifold"
         self.name = "ImageGen: "
 
         self.valves = self.Valves()
-        self.client = OpenAI(
-            base_url=self.valves.OPENAI_API_BASE_URL,
-            api_key=self.valves.OPENAI_API_KEY,
-        )
+        # Built by the warm-up or the first call: importing openai alone takes ~0.4 s
+        self.client = None
+        self.client_settings = None
+        self.client_lock = threading.Lock()
+
+        # The image CDN needs no key, so this session is never rebuilt
+        self.download_session = get_http_session("openai_dalle_images")
+        # Keeps the shared images volume under its disk budget and makes the chat thumbnails
+        self.image_store = ImageStore(SAVE_DIR)
 
-        self.pipelines = self.get_openai_assistants()
+        # Serve the cached model list right away and fetch the fresh one in the background
+        self.model_discovery = ModelDiscovery("openai_dalle", self.get_openai_assistants, self.set_pipelines)
+        self.pipelines = self.model_discovery.models
+        self.model_discovery.refresh()
 
     async def on_startup(self) -> None:
         """This function is called when the server is started."""
         print(f"on_startup:{__name__}")
+        start_metrics_exporter()
+        start_warm_up("openai_dalle", self.warm_up)
+        await self.model_discovery.wait_if_empty()
 
     async def on_shutdown(self):
         """This function is called when the server is stopped."""
@@ -49,11 +68,29 @@ class Pipeline:
     async def on_valves_updated(self):
         """This function is called when the valves are updated."""
         print(f"on_valves_updated:{__name__}")
-        self.client = OpenAI(
-            base_url=self.valves.OPENAI_API_BASE_URL,
-            api_key=self.valves.OPENAI_API_KEY,
-        )
-        self.pipelines = self.get_openai_assistants()
+        self.update_client()
+        self.model_discovery.refresh(force=True)
+
+    def set_pipelines(self, models: List[dict]) -> None:
+        self.pipelines = models
+
+    def update_client(self) -> None:
+        """(Re)build the OpenAI client only when the base URL or key changed, keeping its warm connections"""
+
+        settings = (self.valves.OPENAI_API_BASE_URL, self.valves.OPENAI_API_KEY)
+        if settings == self.client_settings:
+            return
+        with self.client_lock:
+            if settings != self.client_settings:
+                from openai import OpenAI
+
+                # OpenAI() raises without a key, which would keep the pipeline from loading
+                self.client = OpenAI(base_url=settings[0], api_key=settings[1]) if settings[1] else None
+                self.client_settings = settings
+
+    def warm_up(self) -> None:
+        """Import openai and build the client ahead of the first request"""
+        self.update_client()
 
     def get_openai_assistants(self) -> List[dict]:
         """Get the available ImageGen models from OpenAI
@@ -63,6 +100,7 @@ class Pipeline:
         """
 
         if self.valves.OPENAI_API_KEY:
+            self.update_client()
             models = self.client.models.list()
             return [
                 {
@@ -80,40 +118,61 @@ class Pipeline:
     ) -> Union[str, Generator, Iterator]:
         print(f"pipe:{__name__}")
 
-        response = self.client.images.generate(
-            model=model_id,
-            prompt=user_message,
-            size=self.valves.IMAGE_SIZE,
-            n=self.valves.NUM_IMAGES,
-        )
-
-        message = ""
-        # Download the image from the URL
-        for image in response.data:
-            if image.url:
-                # Extract the URL
+        self.update_client()
+        if self.client is None:
+            yield "Error: OPENAI_API_KEY is not set"
+            return
+
+        metrics = RequestMetrics("openai_dalle", model_id)
+        try:
+            response = self.client.images.generate(
+                model=model_id,
+                prompt=user_message,
+                size=self.valves.IMAGE_SIZE,
+                n=self.valves.NUM_IMAGES,
+                response_format=self.valves.RESPONSE_FORMAT,
+            )
+
+            # Save every image at the same time, keeping the order of the response
+            images = [image for image in response.data if image.url or image.b64_json]
+            markdown = ""
+            if images:
+                with ThreadPoolExecutor(max_workers=len(images)) as executor:
+                    markdown = "".join(executor.map(self.save_image, images))
+        except Exception:
+            metrics.finish(status="error")
+            raise
+        # Latency until the images are saved and ready to show, there are no tokens to count
+        metrics.finish()
+        yield markdown
+
+    def save_image(self, image) -> str:
+        """Persist one generated image under its content hash and return its markdown"""
+
+        start = time.perf_counter()
+        try:
+            if image.b64_json:
+                # Returned inline, no second round trip to the image CDN
+                file_name, thumbnail_name, size = self.image_store.save_bytes(base64.b64decode(image.b64_json))
+            else:
                 url = image.url
                 print(f"Image URL: {url}")
-
-                # Parse the URL to get the path and extract the file name
-                parsed_url = urlparse(url)
-                file_name = os.path.basename(parsed_url.path)
-                image_save_name = os.path.join(SAVE_DIR, file_name)  # Gil, in the pipelines container
-                image_show_name = os.path.join(SHOW_DIR, file_name)  # Gil, in the openwebui container
-
-                print(f"Image Name: {image_save_name}")
-
-                # Download and save the image
-                response = requests.get(url)
-                if response.status_code == 200:
-                    try:
-                        with open(image_save_name, "wb") as f:
-                            f.write(response.content)
-                        print(f"Image saved to {image_save_name}")
-                        message += f"![image]({image_show_name})\n"
-                    except Exception as e:
-                        print(f"Failed to save image: {e}")
-                else:
-                    alert_message = "⚠️ This is a temporary URL. Please download the image. ⚠️"
-                    message += f"![image]({url})\n{alert_message}\n"
-        yield message
+                extension = os.path.splitext(urlparse(url).path)[1] or ".png"
+
+                with self.download_session.get(url, stream=True) as r:
+                    if r.status_code != 200:
+                        alert_message = "⚠️ This is a temporary URL. Please download the image. ⚠️"
+                        return f"![image]({url})\n{alert_message}\n"
+                    file_name, thumbnail_name, size = self.image_store.save_chunks(r.iter_content(CHUNK_SIZE), extension)
+        except Exception as e:
+            print(f"Failed to save image: {e}")
+            return ""
+
+        image_save_name = os.path.join(SAVE_DIR, file_name)  # Gil, in the pipelines container
+        image_show_name = os.path.join(SHOW_DIR, file_name)  # Gil, in the openwebui container
+        print(f"Image saved to {image_save_name} ({size} bytes in {time.perf_counter() - start:.2f}s)")
+        if thumbnail_name:
+            # The chat loads the light thumbnail, clicking it opens the original
+            thumbnail_show_name = os.path.join(SHOW_DIR, THUMBNAIL_DIR_NAME, thumbnail_name)
+            return f"[![image]({thumbnail_show_name})]({image_show_name})\n"
+        return f"![image]({image_show_name})\n"
@@ -3,7 +3,17 @@ from schemas import OpenAIChatMessage
 from pydantic import BaseModel
 
 import os
-import requests
+import json
+
+from ai_gil_utils.context_window import ContextWindow
+from ai_gil_utils.http_sessions import get_http_session
+from ai_gil_utils.logs import get_logger, log_payload
+from ai_gil_utils.metrics import RequestMetrics, start_metrics_exporter
+from ai_gil_utils.model_discovery import ModelDiscovery
+from ai_gil_utils.resilience import call_with_retry, retry_stream
+from ai_gil_utils.single_flight import coalesce_identical
+
+logger = get_logger("openai")
 
 
 class Pipeline:
@@ -22,13 +32,30 @@ class Pipeline:
         self.name = "OpenAI: "
 
         self.valves = self.Valves(**{"OPENAI_API_KEY": os.getenv("OPENAI_API_KEY")})
-
-        self.pipelines = self.get_openai_models()
+        self.session = self.create_session()
+        self.context_window = ContextWindow()
+
+        # Serve the cached model list right away and fetch the fresh one in the background
+        self.model_discovery = ModelDiscovery(
+            "openai",
+            self.get_openai_models,
+            self.set_pipelines,
+            error_models=[
+                {
+                    "id": "error",
+                    "name": "Could not fetch models from OpenAI, please update the API Key in the valves.",
+                },
+            ],
+        )
+        self.pipelines = self.model_discovery.models
+        self.model_discovery.refresh()
         pass
 
     async def on_startup(self):
         # This function is called when the server is started.
         print(f"on_startup:{__name__}")
+        start_metrics_exporter()
+        await self.model_discovery.wait_if_empty()
         pass
 
     async def on_shutdown(self):
@@ -39,54 +66,51 @@ class Pipeline:
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
         print(f"on_valves_updated:{__name__}")
-        self.pipelines = self.get_openai_models()
+        self.session = self.create_session()
+        self.model_discovery.refresh(force=True)
         pass
 
+    def set_pipelines(self, models):
+        self.pipelines = models
+
+    def create_session(self):
+        # Shared keep-alive session, only rebuilt when the base URL or key change
+        return get_http_session(
+            "openai",
+            base_url=self.valves.OPENAI_API_BASE_URL,
+            api_key=self.valves.OPENAI_API_KEY,
+            headers={"Content-Type": "application/json"},
+        )
+
     def get_openai_models(self):
+        # Runs in the model discovery thread, errors are handled there
         if self.valves.OPENAI_API_KEY:
-            try:
-                headers = {}
-                headers["Authorization"] = f"Bearer {self.valves.OPENAI_API_KEY}"
-                headers["Content-Type"] = "application/json"
-
-                r = requests.get(f"{self.valves.OPENAI_API_BASE_URL}/models", headers=headers)
-
-                models = r.json()
-                return [
-                    {
-                        "id": model["id"],
-                        "name": model["name"] if "name" in model else model["id"],
-                    }
-                    for model in models["data"]
-                    if "gpt-4o" in model["id"]  # Gil modified this line
-                ]
-
-            except Exception as e:
-
-                print(f"Error: {e}")
-                return [
-                    {
-                        "id": "error",
-                        "name": "Could not fetch models from OpenAI, please update the API Key in the valves.",
-                    },
-                ]
+            r = self.session.get(f"{self.valves.OPENAI_API_BASE_URL}/models")
+            r.raise_for_status()
+
+            models = r.json()
+            return [
+                {
+                    "id": model["id"],
+                    "name": model["name"] if "name" in model else model["id"],
+                }
+                for model in models["data"]
+                if "gpt-4o" in model["id"]  # Gil modified this line
+            ]
         else:
             return []
 
+    @coalesce_identical("openai")
     def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
         # This is where you can add your custom pipelines like RAG.
         print(f"pipe:{__name__}")
+        metrics = RequestMetrics("openai", model_id)
 
-        print(messages)
-        print(user_message)
-
-        headers = {}
-        headers["Authorization"] = f"Bearer {self.valves.OPENAI_API_KEY}"
-        headers["Content-Type"] = "application/json"
-
-        payload = {**body, "model": model_id}
+        # Fit the history in the model's context window
+        messages = self.context_window.fit(body.get("chat_id"), model_id, messages, body.get("max_tokens"))
+        payload = {**body, "model": model_id, "messages": messages}
 
         if "user" in payload:
             del payload["user"]
@@ -94,22 +118,45 @@ class Pipeline:
             del payload["chat_id"]
         if "title" in payload:
             del payload["title"]
+        if payload.get("stream"):
+            # Without it OpenAI does not send the token usage of streamed answers
+            payload["stream_options"] = {**(payload.get("stream_options") or {}), "include_usage": True}
 
-        print(payload)
+        log_payload(logger, "Chat completion request", payload, model_id=model_id)
 
         try:
-            r = requests.post(
-                url=f"{self.valves.OPENAI_API_BASE_URL}/chat/completions",
-                json=payload,
-                headers=headers,
-                stream=True,
-            )
+            data = json.dumps(payload)
+            metrics.record_payload(len(data))
 
-            r.raise_for_status()
+            def post():
+                r = self.session.post(
+                    url=f"{self.valves.OPENAI_API_BASE_URL}/chat/completions",
+                    data=data,
+                    stream=True,
+                )
+                r.raise_for_status()
+                return r
+
+            r = call_with_retry("openai", post)
 
             if body["stream"]:
-                return r.iter_lines()
+                # Reopened when it fails before the first event
+                stream = retry_stream(
+                    "openai", lambda: self.stream_response(post(), metrics), self.stream_response(r, metrics)
+                )
+                return metrics.track(stream)
             else:
-                return r.json()
+                response = r.json()
+                metrics.record_usage(response.get("usage") or {})
+                metrics.finish(response["choices"][0]["message"].get("content") or "")
+                return response
         except Exception as e:
+            metrics.finish(status="error")
             return f"Error: {e}"
+
+    def stream_response(self, r, metrics: RequestMetrics) -> Generator:
+        # The raw server-sent events are passed through, only the one with the usage is parsed
+        for line in r.iter_lines():
+            if b'"usage":{' in line:
+                metrics.record_usage(json.loads(line[5:])["usage"])
+            yield line
@@ -3,7 +3,16 @@ from schemas import OpenAIChatMessage
 from pydantic import BaseModel
 
 import os
-import requests
+import json
+
+from ai_gil_utils.context_window import ContextWindow
+from ai_gil_utils.http_sessions import get_http_session
+from ai_gil_utils.metrics import RequestMetrics, start_metrics_exporter
+from ai_gil_utils.resilience import call_with_retry, retry_stream
+from ai_gil_utils.single_flight import coalesce_identical
+
+DEFAULT_SYSTEM_PROMPT = "Be precise and concise"
+SAMPLING_PARAMS = ["temperature", "top_p", "top_k", "max_tokens", "presence_penalty", "frequency_penalty"]
 
 
 class Pipeline:
@@ -16,19 +25,32 @@ class Pipeline:
         self.name = "Perplexity AI: "
 
         self.valves = self.Valves(**{"PERPLEXITY_API_KEY": os.getenv("PERPLEXITY_API_KEY")})
+        self.session = self.create_session()
+        self.context_window = ContextWindow()
 
         self.pipelines = self.get_perplexity_models()
 
     async def on_startup(self):
         print(f"on_startup:{__name__}")
+        start_metrics_exporter()
 
     async def on_shutdown(self):
         print(f"on_shutdown:{__name__}")
 
     async def on_valves_updated(self):
         print(f"on_valves_updated:{__name__}")
+        self.session = self.create_session()
         self.pipelines = self.get_perplexity_models()
 
+    def create_session(self):
+        # Shared keep-alive session, only rebuilt when the base URL or key change
+        return get_http_session(
+            "perplexity",
+            base_url=self.valves.PERPLEXITY_API_BASE_URL,
+            api_key=self.valves.PERPLEXITY_API_KEY,
+            headers={"accept": "application/json", "content-type": "application/json"},
+        )
+
     def get_perplexity_models(self):
         # For Perplexity AI, we'll hardcode the available models
         # You may want to update this list based on the latest available models
@@ -40,40 +62,82 @@ class Pipeline:
             # Add other available models here
         ]
 
+    @coalesce_identical("perplexity")
     def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
         print(f"pipe:{__name__}")
+        metrics = RequestMetrics("perplexity", model_id)
 
-        headers = {
-            "accept": "application/json",
-            "content-type": "application/json",
-            "authorization": f"Bearer {self.valves.PERPLEXITY_API_KEY}",
-        }
+        # Fit the history in the model's context window
+        messages = self.context_window.fit(body.get("chat_id"), model_id, messages, body.get("max_tokens"))
 
         payload = {
             "model": model_id,
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "Be precise and concise",
-                },
-                {
-                    "role": "user",
-                    "content": user_message,
-                },
-            ],
+            "messages": self.process_messages(messages),
+            "stream": body.get("stream", False),
+            **{key: body[key] for key in SAMPLING_PARAMS if body.get(key) is not None},
         }
 
         try:
-            r = requests.post(
-                url=f"{self.valves.PERPLEXITY_API_BASE_URL}/chat/completions",
-                json=payload,
-                headers=headers,
-            )
-
-            r.raise_for_status()
-            return r.json()["choices"][0]["message"]["content"]
+            data = json.dumps(payload)
+            metrics.record_payload(len(data))
+
+            def post():
+                r = self.session.post(
+                    url=f"{self.valves.PERPLEXITY_API_BASE_URL}/chat/completions",
+                    data=data,
+                    stream=payload["stream"],
+                )
+                r.raise_for_status()
+                return r
+
+            r = call_with_retry("perplexity", post)
+
+            if payload["stream"]:
+                # Reopened when it fails before the first delta
+                stream = retry_stream(
+                    "perplexity", lambda: self.stream_response(post(), metrics), self.stream_response(r, metrics)
+                )
+                return metrics.track(stream)
+            else:
+                response = r.json()
+                metrics.record_usage(response.get("usage") or {})
+                content = response["choices"][0]["message"]["content"]
+                metrics.finish(content)
+                return content
 
         except Exception as e:
+            metrics.finish(status="error")
             return f"Error: {e}"
+
+    def process_messages(self, messages: List[dict]) -> List[dict]:
+        # Perplexity only accepts text content, so multimodal messages keep their text parts
+        processed_messages = []
+        for message in messages:
+            content = message.get("content", "")
+            if isinstance(content, list):
+                content = "\n".join(item["text"] for item in content if item.get("type") == "text")
+            processed_messages.append({"role": message["role"], "content": content})
+
+        if not processed_messages or processed_messages[0]["role"] != "system":
+            processed_messages.insert(0, {"role": "system", "content": DEFAULT_SYSTEM_PROMPT})
+        return processed_messages
+
+    def stream_response(self, r, metrics: RequestMetrics) -> Generator:
+        # Server-sent events: one "data: {...}" line per delta, ending with "data: [DONE]"
+        usage = None
+        for line in r.iter_lines():
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+            event = json.loads(data)
+            # Every event carries the running usage, the last one is kept
+            usage = event.get("usage") or usage
+            delta = event["choices"][0].get("delta", {}).get("content")
+            if delta:
+                yield delta
+        if usage:
+            metrics.record_usage(usage)
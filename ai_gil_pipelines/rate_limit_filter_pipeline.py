@@ -0,0 +1,169 @@
+"""
+title: Rate Limit Filter Pipeline
+description: Per-user request and token-per-minute budgets, so one user cannot use up the shared provider quota
+"""
+
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+from ai_gil_utils.context_window import get_context_limit
+from ai_gil_utils.metrics import start_metrics_exporter, time_hook
+from ai_gil_utils.rate_limits import TokenBucketStore
+from ai_gil_utils.tokens import estimate_content_tokens, estimate_tokens
+
+MAX_PENDING_RESERVATIONS = 10000
+# Tasks and aborted turns never reach the outlet, their estimate just stays charged
+RESERVATION_TTL_SECONDS = 600
+
+
+class Pipeline:
+    class Valves(BaseModel):
+        pipelines: List[str] = []
+        priority: int = 0
+
+        # 0 turns a limit off
+        USER_REQUESTS_PER_MINUTE: int = 20  # per user and model
+        USER_TOKENS_PER_MINUTE: int = 200_000  # per user, all models together
+        MODEL_TOKENS_PER_MINUTE: int = 0  # all users of a model together, e.g. the Bedrock quota
+        MAX_WAIT_SECONDS: float = 5  # requests that would fit within this wait are queued instead of rejected
+        EXEMPT_ADMINS: bool = False
+
+    def __init__(self):
+        self.type = "filter"
+        self.name = "Rate Limit Filter"
+        self.valves = self.Valves(
+            **{
+                "pipelines": ["*"],
+                "USER_REQUESTS_PER_MINUTE": int(os.getenv("RATE_LIMIT_USER_REQUESTS_PER_MINUTE", "20")),
+                "USER_TOKENS_PER_MINUTE": int(os.getenv("RATE_LIMIT_USER_TOKENS_PER_MINUTE", "200000")),
+                "MODEL_TOKENS_PER_MINUTE": int(os.getenv("RATE_LIMIT_MODEL_TOKENS_PER_MINUTE", "0")),
+            }
+        )
+        self.buckets = TokenBucketStore()
+        # (user, request) -> (chat_id, model_id, tokens reserved in inlet, reserved at), reconciled in outlet
+        self.reservations = OrderedDict()
+
+    async def on_startup(self):
+        # This function is called when the server is started.
+        print(f"on_startup:{__name__}")
+        start_metrics_exporter()
+
+    async def on_shutdown(self):
+        # This function is called when the server is stopped.
+        print(f"on_shutdown:{__name__}")
+        self.buckets.save(force=True)
+
+    def token_buckets(self, user_id: str, model_id: str):
+        return [
+            (f"user:{user_id}:tokens", self.valves.USER_TOKENS_PER_MINUTE),
+            (f"model:{model_id}:tokens", self.valves.MODEL_TOKENS_PER_MINUTE),
+        ]
+
+    def estimate_request_tokens(self, body: dict) -> int:
+        """What the request may cost: the prompt plus the output it allows"""
+        model_id = body.get("model", "")
+        input_tokens = sum(estimate_content_tokens(message.get("content")) for message in body.get("messages", []))
+        max_output_tokens = body.get("max_tokens") or get_context_limit(model_id)[1]
+        return input_tokens + max_output_tokens
+
+    async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
+        """
+        Reserve one request and the estimated tokens before the pipeline runs.
+        Waits up to MAX_WAIT_SECONDS for the budget to refill, then rejects with
+        a message telling the user when to try again.
+        """
+        user = user or {}
+        if self.valves.EXEMPT_ADMINS and user.get("role") == "admin":
+            return body
+
+        # The hook time includes the wait for the budget
+        with time_hook(self.name, "inlet", body.get("model")):
+            return await self.reserve(body, user)
+
+    async def reserve(self, body: dict, user: dict) -> dict:
+        user_id = user.get("id", "anonymous")
+        model_id = body.get("model", "")
+        tokens = self.estimate_request_tokens(body)
+        requests = [(f"user:{user_id}:model:{model_id}:requests", self.valves.USER_REQUESTS_PER_MINUTE, 1)]
+        requests += [(key, capacity, tokens) for key, capacity in self.token_buckets(user_id, model_id)]
+
+        deadline = time.monotonic() + self.valves.MAX_WAIT_SECONDS
+        wait = self.buckets.acquire(requests)
+        while wait and time.monotonic() + wait <= deadline:
+            await asyncio.sleep(wait)
+            wait = self.buckets.acquire(requests)
+        if wait:
+            raise Exception(
+                f"Rate limit reached for {model_id} (at most {self.valves.USER_REQUESTS_PER_MINUTE} requests and "
+                f"{self.valves.USER_TOKENS_PER_MINUTE} tokens per minute per user). "
+                f"Please try again in {wait:.0f} seconds."
+            )
+
+        now = time.monotonic()
+        task = (body.get("metadata") or {}).get("task")
+        if task:
+            # Title/tag generation shares the turn's message id and never reaches the outlet
+            request_id = f"{task}:{uuid.uuid4()}"
+        else:
+            request_id = self.request_id(body) or f"generated:{uuid.uuid4()}"
+        self.reservations[(user_id, request_id)] = (body.get("chat_id"), model_id, tokens, now)
+        while self.reservations and (
+            len(self.reservations) > MAX_PENDING_RESERVATIONS
+            or next(iter(self.reservations.values()))[3] < now - RESERVATION_TTL_SECONDS
+        ):
+            self.reservations.popitem(last=False)
+        return body
+
+    @staticmethod
+    def request_id(body: dict) -> Optional[str]:
+        """The id of the answer being generated, sent by Open WebUI to both inlet (metadata) and outlet"""
+        return (body.get("metadata") or {}).get("message_id") or body.get("id")
+
+    def pop_reservation(self, user_id: str, body: dict):
+        request_id = self.request_id(body)
+        reservation = self.reservations.pop((user_id, request_id), None) if request_id else None
+        if reservation is None:
+            # Without ids on both sides: the oldest request of the chat the inlet could not identify
+            chat_id = body.get("chat_id")
+            for key, pending in self.reservations.items():
+                if key[0] == user_id and key[1].startswith("generated:") and pending[0] == chat_id:
+                    reservation = self.reservations.pop(key)
+                    break
+        return reservation
+
+    async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
+        """Replace the inlet estimate with what the turn actually used"""
+        user_id = (user or {}).get("id", "anonymous")
+        reservation = self.pop_reservation(user_id, body)
+        if reservation is None:
+            return body
+
+        _, model_id, reserved, _ = reservation
+        with time_hook(self.name, "outlet", model_id):
+            self.reconcile(body, user_id, model_id, reserved)
+        return body
+
+    def reconcile(self, body: dict, user_id: str, model_id: str, reserved: int) -> None:
+        messages = body.get("messages", [])
+        answer = messages[-1] if messages and messages[-1].get("role") == "assistant" else {}
+        usage = answer.get("usage") or answer.get("info") or {}
+        if "prompt_tokens" in usage or "input_tokens" in usage:
+            used = (usage.get("prompt_tokens") or usage.get("input_tokens") or 0) + (
+                usage.get("completion_tokens") or usage.get("output_tokens") or 0
+            )
+        else:
+            answer_text = answer.get("content") if isinstance(answer.get("content"), str) else ""
+            input_tokens = sum(estimate_content_tokens(message.get("content")) for message in messages[:-1])
+            used = input_tokens + estimate_tokens(answer_text)
+
+        for key, capacity in self.token_buckets(user_id, model_id):
+            if capacity:
+                # inlet took at most a whole bucket
+                self.buckets.adjust(key, min(reserved, capacity) - used)
+        self.buckets.save()
@@ -0,0 +1,73 @@
+"""
+Concurrent Gemini streams one pipelines process can hold, sync pipe vs pipe_async.
+
+The sync path is bounded by the worker threads the server iterates generators in
+(40, the Starlette default); the async path runs every stream on one event loop.
+
+    python -m benchmarks.bench_google_async_streams [streams]
+"""
+
+import asyncio
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import load_pipeline, make_chat
+from benchmarks.fakes import FakeGenerativeModel, install_fake_genai
+
+SERVER_THREADS = 40
+CHUNK_DELAY = 0.02  # 50 chunks, ~1 s per stream
+
+
+def body():
+    return {"stream": True, "max_tokens": 1024}
+
+
+def run_sync(pipeline, messages, streams):
+    def consume(_):
+        return sum(len(text) for text in pipeline.pipe("", "gemini-1.5-flash", messages, body()))
+
+    with ThreadPoolExecutor(max_workers=SERVER_THREADS) as executor:
+        return list(executor.map(consume, range(streams)))
+
+
+async def run_async(pipeline, messages, streams):
+    async def consume():
+        total = 0
+        async for text in await pipeline.pipe_async("", "gemini-1.5-flash", messages, body()):
+            total += len(text)
+        return total
+
+    return await asyncio.gather(*(consume() for _ in range(streams)))
+
+
+def measure(label, run, streams):
+    tracemalloc.start()
+    start = time.perf_counter()
+    threads_before = threading.active_count()
+    run()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{label:>6}: {streams} streams in {elapsed:5.2f} s, "
+        f"{streams / elapsed:6.1f} streams/s, peak {peak / 1024 / 1024:6.1f} MB "
+        f"({peak / streams / 1024:5.1f} KB/stream), threads before run {threads_before}"
+    )
+
+
+def main(streams=400):
+    module, pipeline = load_pipeline("google_manifold_pipeline")
+    install_fake_genai(module)
+    pipeline.valves.GOOGLE_API_KEY = "benchmark"
+    FakeGenerativeModel.delay = CHUNK_DELAY
+    messages = make_chat(turns=10, image_every=0)
+
+    measure("sync", lambda: run_sync(pipeline, messages, streams), streams)
+    measure("async", lambda: asyncio.run(run_async(pipeline, messages, streams)), streams)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 400)
@@ -0,0 +1,80 @@
+"""
+Per-turn message conversion cost over a 200-turn chat, with and without the ConversionCache.
+
+Checks that the cached conversion is always the full one and that an edited
+message is converted again. Exits non-zero when a check fails.
+
+    python -m benchmarks.bench_message_cache
+"""
+
+import hashlib
+import json
+import sys
+
+from benchmarks.common import make_chat, timed
+
+from ai_gil_utils.message_cache import ConversionCache
+
+
+def convert_message(message):
+    # Same shape of work as the Anthropic pipelines' process_message, including the
+    # content hash prepare_image computes to look up its cache
+    if isinstance(message.get("content"), list):
+        content = []
+        for item in message["content"]:
+            if item["type"] == "text":
+                content.append({"type": "text", "text": item["text"]})
+            elif item["type"] == "image_url":
+                mime_type, data = item["image_url"]["url"].split(",", 1)
+                media_type = mime_type.split(":")[1].split(";")[0]
+                hashlib.sha256(data.encode()).hexdigest()
+                content.append({"type": "image", "source": {"type": "base64", "media_type": media_type, "data": data}})
+    else:
+        content = [{"type": "text", "text": message.get("content", "")}]
+    return {"role": message["role"], "content": content}
+
+
+def check(label, ok, failures):
+    print(f"  {'ok' if ok else 'FAILED'}: {label}")
+    if not ok:
+        failures.append(label)
+
+
+def main(turns=200):
+    chat = json.dumps(make_chat(turns)[1:])
+    cache = ConversionCache()
+    uncached_total = cached_total = 0.0
+    failures = []
+    same = True
+
+    for turn in range(1, turns + 1):
+        # Open WebUI resends the whole history, as freshly parsed JSON, every turn
+        history = json.loads(chat)[: turn * 2 - 1]
+        full, uncached = timed(lambda: [convert_message(message) for message in history])
+        converted, cached = timed(cache.convert, "bench-chat", history, convert_message)
+        same = same and converted == full
+        uncached_total += uncached
+        cached_total += cached
+
+        if turn in (1, 50, 100, 200):
+            print(f"turn {turn:>3}: full conversion {uncached * 1000:7.2f} ms, cached {cached * 1000:7.2f} ms")
+
+    print(f"whole chat: full conversion {uncached_total:.2f} s, cached {cached_total:.2f} s")
+    print(f"messages reused {cache.hits}, converted {cache.misses}")
+
+    print("checks:")
+    check("the cached conversion is the full one on every turn", same, failures)
+    history = json.loads(chat)
+    history[2]["content"] += " (edited)"
+    check(
+        "an edited message is converted again",
+        cache.convert("bench-chat", history, convert_message)[2] == convert_message(history[2]),
+        failures,
+    )
+
+    if failures:
+        sys.exit(f"{len(failures)} check(s) failed")
+
+
+if __name__ == "__main__":
+    main()
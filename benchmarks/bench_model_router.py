@@ -0,0 +1,66 @@
+"""
+Routing overhead of the router pipeline's virtual models, and where they send requests.
+
+The decision must stay well under a millisecond, even for long chats with images.
+Exits non-zero when a check fails.
+
+    python -m benchmarks.bench_model_router
+"""
+
+import os
+import sys
+import time
+
+from benchmarks.common import load_pipeline, make_chat
+
+from ai_gil_utils.model_router import ModelRouter
+
+DECISIONS = 2000
+
+
+def check(label, ok, failures):
+    print(f"  {'ok' if ok else 'FAILED'}: {label}")
+    if not ok:
+        failures.append(label)
+
+
+def main():
+    router = ModelRouter()
+    chats = {
+        "short": [{"role": "user", "content": "What is the capital of France?"}],
+        "long_200": make_chat(turns=200, image_every=0),
+        "long_200_images": make_chat(turns=200, image_every=50),
+    }
+    for name, messages in chats.items():
+        for strategy in ModelRouter.STRATEGIES:
+            start = time.perf_counter()
+            for _ in range(DECISIONS):
+                model_id = router.choose(strategy, messages)
+            per_decision_us = (time.perf_counter() - start) / DECISIONS * 1e6
+            print(f"{name:>16} {strategy:>5}: {per_decision_us:7.1f} us per decision -> {model_id}")
+
+    # A backend that keeps failing is routed around until it gets a probe
+    messages = chats["short"]
+    fastest = router.choose("fast", messages)
+    for _ in range(5):
+        router.record(fastest, error=True)
+    print(f"after errors on {fastest}: fast -> {router.choose('fast', messages)}")
+
+    failures = []
+    check("no candidate, no route", router.choose("cheap", messages, candidates=[]) is None, failures)
+    _, pipeline = load_pipeline("model_router_manifold_pipeline")
+    # No provider credentials at all
+    keys = ["AWS_ACCESS_KEY_ID", "GOOGLE_API_KEY", "OPENAI_API_KEY", "PERPLEXITY_API_KEY"]
+    saved = {key: os.environ.pop(key, None) for key in keys}
+    try:
+        answer = pipeline.pipe("", "router.cheap", messages, {})
+    finally:
+        os.environ.update({key: value for key, value in saved.items() if value is not None})
+    check("without credentials the router answers with an error", answer.startswith("Error: No configured"), failures)
+
+    if failures:
+        sys.exit(f"{len(failures)} check(s) failed")
+
+
+if __name__ == "__main__":
+    main()
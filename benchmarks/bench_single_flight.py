@@ -0,0 +1,141 @@
+"""
+Identical temperature 0 requests arriving together, with and without coalescing.
+
+Checks that a burst of identical requests reaches the provider once and every
+caller gets the full answer, including callers that join a stream late or
+leave it early, and that requests differing in any way are never shared.
+Also times the request key every temperature 0 request computes.
+Exits non-zero when a check fails.
+
+    python -m benchmarks.bench_single_flight [callers]
+"""
+
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import load_pipeline, make_chat, timed
+from benchmarks.fakes import DELTA_TEXT, FakeBedrockClient
+
+import ai_gil_utils.single_flight as single_flight
+
+MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+CHUNKS = 50
+EVENT_DELAY = 0.01  # 50 deltas, ~0.5 s per answer
+
+
+def body(**overrides):
+    return {"stream": True, "temperature": 0, "max_tokens": 1024, **overrides}
+
+
+def answer(pipeline, messages, request_body, stop_after=None):
+    result = pipeline.pipe("", MODEL_ID, messages, request_body)
+    if isinstance(result, str):
+        return result
+    chunks = []
+    for chunk in result:
+        chunks.append(chunk)
+        if stop_after is not None and len(chunks) >= stop_after:
+            result.close()
+            break
+    return "".join(chunks)
+
+
+def burst(pipeline, messages, callers, make_body=lambda index: body(), stagger=0.0):
+    def call(index):
+        time.sleep(stagger * index)
+        return answer(pipeline, messages, make_body(index))
+
+    with ThreadPoolExecutor(max_workers=callers) as executor:
+        return list(executor.map(call, range(callers)))
+
+
+def check(label, ok, failures):
+    print(f"  {'ok' if ok else 'FAILED'}: {label}")
+    if not ok:
+        failures.append(label)
+
+
+def main(callers=20):
+    _, pipeline = load_pipeline("aws_anthropic_manifold_pipeline")
+    pipeline.valves.PROMPT_CACHING = False
+    messages = make_chat(turns=10, image_every=0)
+    expected = DELTA_TEXT * CHUNKS
+    failures = []
+
+    for enabled in (False, True):
+        single_flight.SINGLE_FLIGHT_ENABLED = enabled
+        pipeline.client = FakeBedrockClient("anthropic", chunks=CHUNKS, delay=EVENT_DELAY)
+        start = time.perf_counter()
+        answers = burst(pipeline, messages, callers)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{'coalesced' if enabled else 'separate':>9}: {callers} identical streams in {elapsed:5.2f} s, "
+            f"{pipeline.client.invocations} provider calls"
+        )
+        check("every caller got the whole answer", all(text == expected for text in answers), failures)
+        if enabled:
+            check("one provider call for the burst", pipeline.client.invocations == 1, failures)
+
+    print("scenarios:")
+    pipeline.client = FakeBedrockClient("anthropic", chunks=CHUNKS, delay=EVENT_DELAY)
+    answers = burst(pipeline, messages, callers, make_body=lambda index: body(stream=False))
+    check(
+        "non-streamed burst shares one call",
+        pipeline.client.invocations == 1 and all(text == expected for text in answers),
+        failures,
+    )
+
+    pipeline.client = FakeBedrockClient("anthropic", chunks=CHUNKS, delay=EVENT_DELAY)
+    answers = burst(pipeline, messages, 5, stagger=EVENT_DELAY * CHUNKS / 10)
+    check(
+        "late joiners replay the stream from the start",
+        pipeline.client.invocations == 1 and all(text == expected for text in answers),
+        failures,
+    )
+
+    pipeline.client = FakeBedrockClient("anthropic", chunks=CHUNKS, delay=EVENT_DELAY)
+    burst(pipeline, messages, 5, make_body=lambda index: body(temperature=0.7))
+    check("temperature above 0 is never shared", pipeline.client.invocations == 5, failures)
+
+    pipeline.client = FakeBedrockClient("anthropic", chunks=CHUNKS, delay=EVENT_DELAY)
+    burst(pipeline, messages, 5, make_body=lambda index: body(max_tokens=1000 + index))
+    check("different sampling parameters are not shared", pipeline.client.invocations == 5, failures)
+
+    pipeline.client = FakeBedrockClient("anthropic", chunks=CHUNKS, delay=EVENT_DELAY)
+    edited = [*messages[:-1], {**messages[-1], "content": messages[-1]["content"][:-1] + "?"}]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(lambda chat: answer(pipeline, chat, body()), [messages, edited]))
+    check("same lengths, other text: not shared", pipeline.client.invocations == 2, failures)
+
+    pipeline.client = FakeBedrockClient("anthropic", chunks=CHUNKS, delay=EVENT_DELAY)
+    barrier = threading.Barrier(3)
+
+    def leave_early(index):
+        barrier.wait()
+        return answer(pipeline, messages, body(), stop_after=None if index == 0 else 3)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        answers = list(executor.map(leave_early, range(3)))
+    check(
+        "callers leaving early do not cut the others off",
+        pipeline.client.invocations == 1 and answers[0] == expected,
+        failures,
+    )
+
+    pipeline.client = FakeBedrockClient("anthropic", chunks=CHUNKS, delay=EVENT_DELAY)
+    answer(pipeline, messages, body(), stop_after=3)
+    answer(pipeline, messages, body())
+    check("a finished or abandoned flight is not reused", pipeline.client.invocations == 2, failures)
+
+    long_chat = make_chat(turns=200, image_every=50)
+    _, seconds = timed(lambda: [single_flight.request_key(MODEL_ID, long_chat, body()) for _ in range(100)])
+    print(f"request key of a 200-turn chat with images: {seconds * 10:.3f} ms")
+
+    if failures:
+        sys.exit(f"{len(failures)} check(s) failed")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,167 @@
+"""
+Decoding and coalescing of Bedrock stream events, with and without the fast path.
+
+Times the decoding of Anthropic events one by one like before against
+decode_events, then runs concurrent paced streams through the Anthropic
+pipeline with coalescing off and on, counting the SSE frames the server would
+write and the CPU spent. Checks that the text is unchanged, that the first
+token is not held back, that a slow model's deltas are not held, that text
+held before a pause of the model goes out as soon as it resumes and that
+skipping never drops an event with text.
+Exits non-zero when a check fails.
+
+    python -m benchmarks.bench_stream_events [streams]
+"""
+
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import load_pipeline, make_chat
+from benchmarks.fakes import DELTA_TEXT, FakeBedrockClient
+
+import ai_gil_utils.stream_events as stream_events
+from ai_gil_utils.stream_events import ANTHROPIC_SKIPPED_EVENTS, coalesce_deltas, decode_events
+
+MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+CHUNKS = 200
+EVENT_DELAY = 0.002  # a fast model, ~500 tokens/s
+DECODE_ROUNDS = 50
+
+
+def check(label, ok, failures):
+    print(f"  {'ok' if ok else 'FAILED'}: {label}")
+    if not ok:
+        failures.append(label)
+
+
+def sse_frame(chunk):
+    # What the pipelines server writes for every chunk a pipe yields
+    return f"data: {json.dumps({'choices': [{'delta': {'content': chunk}}]})}\n\n"
+
+
+def stream(pipeline, messages):
+    """(frames, seconds to the first frame, text) of one streamed answer"""
+    start = time.perf_counter()
+    first_at = None
+    frames = 0
+    chunks = []
+    for chunk in pipeline.pipe("", MODEL_ID, list(messages), {"stream": True, "temperature": 0.7}):
+        first_at = first_at or time.perf_counter()
+        sse_frame(chunk)
+        frames += 1
+        chunks.append(chunk)
+    return frames, first_at - start, "".join(chunks)
+
+
+def irregular_stream(arrivals):
+    """Deltas in bursts, at a slower pace and after pauses, like a loaded model; records when each one arrived"""
+    gaps = [0.002] * 20 + [0.02] * 10 + [0.06] * 5 + [0.002] * 20 + [0.25] + [0.002] * 10
+    for index, gap in enumerate(gaps):
+        time.sleep(gap)
+        arrivals.append((time.monotonic(), gap))
+        yield f"{index:03d} "
+
+
+def check_irregular_arrivals(window, failures):
+    arrivals = []
+    frames = []
+    for text in coalesce_deltas(irregular_stream(arrivals), window=window):
+        frames.append((time.monotonic(), len(text) // 4))
+    late_after_pause = []
+    held_while_slow = []
+    held_too_long = []
+    index = 0
+    for emitted_at, count in frames:
+        chunks = arrivals[index : index + count]
+        index += count
+        for position, (arrived_at, gap) in enumerate(chunks):
+            if gap > window and (position != count - 1 or emitted_at - arrived_at > 0.005):
+                late_after_pause.append(round(gap, 3))
+            if gap > window / 2 and emitted_at - arrived_at > 0.005:
+                held_while_slow.append(round(gap, 3))
+        if all(gap < window for _, gap in chunks[1:]) and emitted_at - chunks[0][0] > window + 0.01:
+            held_too_long.append(round(emitted_at - chunks[0][0], 3))
+    print(f"irregular arrivals: {len(arrivals)} deltas in {len(frames)} frames")
+    check("text held before a pause goes out as soon as the model resumes", not late_after_pause, failures)
+    check("deltas slower than half the window are not held for the next one", not held_while_slow, failures)
+    check("while deltas come fast, text is held about one window at most", not held_too_long, failures)
+
+
+def bench_decode():
+    events = FakeBedrockClient("anthropic", chunks=CHUNKS).events * DECODE_ROUNDS
+    start = time.perf_counter()
+    for event in events:
+        json.loads(event["chunk"]["bytes"].decode())
+    before = (time.perf_counter() - start) / len(events) * 1e6
+    start = time.perf_counter()
+    for _ in decode_events(events, ANTHROPIC_SKIPPED_EVENTS):
+        pass
+    after = (time.perf_counter() - start) / len(events) * 1e6
+    decoder = "orjson" if stream_events.orjson is not None else "json"
+    print(f"decode: {before:.2f} us per event with json.loads, {after:.2f} us with decode_events ({decoder})")
+
+
+def main(streams=50):
+    failures = []
+    bench_decode()
+
+    _, pipeline = load_pipeline("aws_anthropic_manifold_pipeline")
+    pipeline.valves.PROMPT_CACHING = False
+    messages = make_chat(turns=10, image_every=0)
+    expected = DELTA_TEXT * CHUNKS
+    window = stream_events.STREAM_COALESCE_WINDOW
+
+    results = {}
+    for coalesce in (False, True):
+        stream_events.STREAM_COALESCE_WINDOW = window if coalesce else 0
+        pipeline.client = FakeBedrockClient("anthropic", chunks=CHUNKS, delay=EVENT_DELAY)
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=streams) as executor:
+            answers = list(executor.map(lambda index: stream(pipeline, messages), range(streams)))
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        frames = sum(frames for frames, _, _ in answers) / streams
+        first = max(first for _, first, _ in answers)
+        results[coalesce] = (frames, first, answers)
+        print(
+            f"{'coalesced' if coalesce else 'per delta':>9}: {streams} streams in {elapsed:5.2f} s, "
+            f"cpu {cpu:5.2f} s, {frames:5.1f} frames per answer, slowest first frame {first * 1000:5.1f} ms"
+        )
+    stream_events.STREAM_COALESCE_WINDOW = window
+
+    print("checks:")
+    check("every answer is complete", all(text == expected for _, _, text in results[True][2]), failures)
+    check("fewer frames when coalescing", results[True][0] < results[False][0] / 2, failures)
+    check(
+        "the first token is not held back",
+        all(text.startswith(DELTA_TEXT) and frames > 1 for frames, _, text in results[True][2]),
+        failures,
+    )
+    check(
+        "deltas are only held within the window",
+        results[True][0] >= CHUNKS * EVENT_DELAY / (window + EVENT_DELAY * 2),
+        failures,
+    )
+    check_irregular_arrivals(window, failures)
+
+    tricky = [
+        {"chunk": {"bytes": b'{ "type": "ping" }'}},
+        {"chunk": {"bytes": b'{"type":"content_block_delta","index":0,"delta":{"type":"text_delta","text":"\\"type\\":\\"ping\\""}}'}},
+        {"chunk": {"bytes": b'{"type":"ping"}'}},
+    ]
+    decoded = list(decode_events(tricky, ANTHROPIC_SKIPPED_EVENTS))
+    check(
+        "skipping is only a shortcut, no text event is dropped",
+        [event["type"] for event in decoded] == ["ping", "content_block_delta"],
+        failures,
+    )
+
+    if failures:
+        sys.exit(f"{len(failures)} check(s) failed")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
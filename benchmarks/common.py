@@ -0,0 +1,99 @@
+"""Shared helpers for the offline benchmarks, run from the repo root: python -m benchmarks.<name>"""
+
+import base64
+import hashlib
+import importlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINES_DIR = os.path.join(REPO_ROOT, "ai_gil_pipelines")
+HOST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "host")
+
+# Pipelines import `schemas` and `utils.pipelines.main` from the pipelines server,
+# the stand-ins in benchmarks/host are only used when the real ones are missing
+sys.path.append(HOST_DIR)
+sys.path.insert(0, PIPELINES_DIR)
+
+# Keep model lists and other caches out of the repo. Empty keys keep the pipelines
+# from reaching the real providers at load time, benchmarks set their own valves.
+os.environ.setdefault("AI_GIL_CACHE_DIR", tempfile.mkdtemp(prefix="ai_gil_bench_"))
+for key in ["OPENAI_API_KEY", "PERPLEXITY_API_KEY", "GOOGLE_API_KEY"]:
+    os.environ.setdefault(key, "")
+for key in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]:
+    os.environ.setdefault(key, "benchmark")
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+# In the containers volume_ai_gil_utils is mounted as the ai_gil_utils package. Here a
+# symlink named ai_gil_utils is put on sys.path: a real directory, so the spawned image
+# preprocessing workers can import it too. The missing private prompts come from HOST_DIR.
+PACKAGES_DIR = os.path.join(
+    tempfile.gettempdir(), "ai_gil_bench_" + hashlib.sha1(REPO_ROOT.encode()).hexdigest()[:8]
+)
+
+
+def _link_package():
+    link = os.path.join(PACKAGES_DIR, "ai_gil_utils")
+    if not os.path.exists(link):
+        os.makedirs(PACKAGES_DIR, exist_ok=True)
+        try:
+            os.symlink(os.path.join(REPO_ROOT, "volume_ai_gil_utils"), link, target_is_directory=True)
+        except FileExistsError:
+            pass  # another benchmark process got there first
+    if PACKAGES_DIR not in sys.path:
+        sys.path.insert(0, PACKAGES_DIR)
+
+
+_link_package()
+
+
+def load_pipeline(module_name):
+    """Import a pipeline file from ai_gil_pipelines and return (module, Pipeline())"""
+    module = importlib.import_module(module_name)
+    return module, module.Pipeline()
+
+
+def png_image(width=1600, height=1200):
+    """
+    PNG bytes of camera-like noise, which barely compresses, like a phone
+    photo (~5.5 MB at the default size). Falls back to a PNG signature
+    followed by random bytes of the same size without Pillow.
+    """
+    raw = os.urandom(width * height * 3)
+    try:
+        from PIL import Image
+    except ImportError:
+        return b"\x89PNG\r\n\x1a\n" + raw
+
+    output = io.BytesIO()
+    Image.frombytes("RGB", (width, height), raw).save(output, format="PNG", compress_level=1)
+    return output.getvalue()
+
+
+def image_data_url(width=1600, height=1200):
+    """A base64 PNG data URL of png_image(), like a photo pasted in the chat"""
+    return "data:image/png;base64," + base64.b64encode(png_image(width, height)).decode()
+
+
+def make_chat(turns=200, image_every=25, text_size=800, image_url=None):
+    """OpenAI style history with `turns` user/assistant pairs and an image every `image_every` turns"""
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    image_url = image_url or (image_data_url(640, 480) if image_every else None)
+    for turn in range(turns):
+        text = f"Turn {turn}: " + "lorem ipsum dolor sit amet " * (text_size // 27)
+        if image_every and turn % image_every == 0:
+            content = [{"type": "text", "text": text}, {"type": "image_url", "image_url": {"url": image_url}}]
+        else:
+            content = text
+        messages.append({"role": "user", "content": content})
+        messages.append({"role": "assistant", "content": text})
+    return messages
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
@@ -0,0 +1,256 @@
+"""Local stand-ins for the providers, so pipelines can be driven without network or keys"""
+
+import asyncio
+import base64
+import io
+import json
+import multiprocessing
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from benchmarks.common import png_image
+
+
+class FakeGenaiChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeAsyncGenaiStream:
+    def __init__(self, chunks, delay):
+        self.chunks = chunks
+        self.deltas = chunks
+        self.delay = delay
+
+    async def __aiter__(self):
+        for text in self.chunks:
+            await asyncio.sleep(self.delay)
+            yield FakeGenaiChunk(text)
+
+
+class FakeGenerativeModel:
+    """Mimics google.generativeai.GenerativeModel: `chunks` deltas, each after `delay` seconds"""
+
+    chunks = ["Lorem ipsum dolor sit amet "] * 50
+    delay = 0.0
+    invoked_at = None
+
+    def __init__(self, model_name, system_instruction=None, safety_settings=None):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+
+    def _stream(self):
+        for text in self.chunks:
+            if self.delay:
+                time.sleep(self.delay)
+            yield FakeGenaiChunk(text)
+
+    def generate_content(self, contents, generation_config=None, safety_settings=None, stream=False):
+        FakeGenerativeModel.invoked_at = time.perf_counter()
+        if stream:
+            return self._stream()
+        if self.delay:
+            time.sleep(self.delay * len(self.chunks))
+        return FakeGenaiChunk("".join(self.chunks))
+
+    async def generate_content_async(self, contents, generation_config=None, safety_settings=None, stream=False):
+        FakeGenerativeModel.invoked_at = time.perf_counter()
+        if stream:
+            return FakeAsyncGenaiStream(self.chunks, self.delay)
+        await asyncio.sleep(self.delay * len(self.chunks))
+        return FakeGenaiChunk("".join(self.chunks))
+
+
+def install_fake_genai(module):
+    """Point a loaded google_manifold_pipeline module at the fake genai client"""
+    module.load_genai()  # the real types (safety settings) are kept
+    module.genai = SimpleNamespace(
+        GenerativeModel=FakeGenerativeModel,
+        configure=lambda **kwargs: None,
+        list_models=lambda: [],
+        types=module.genai.types,
+    )
+
+
+STREAM_CHUNKS = 200  # deltas per streamed answer, a few characters each like real token deltas
+DELTA_TEXT = "lorem "
+
+
+def _anthropic_events(chunks):
+    yield {"type": "message_start", "message": {"usage": {"input_tokens": 1200, "output_tokens": 1}}}
+    yield {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}
+    for _ in range(chunks):
+        yield {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": DELTA_TEXT}}
+    yield {"type": "content_block_stop", "index": 0}
+    yield {"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": chunks}}
+    yield {"type": "message_stop", "amazon-bedrock-invocationMetrics": {"inputTokenCount": 1200}}
+
+
+def _meta_events(chunks):
+    for i in range(chunks):
+        yield {"generation": DELTA_TEXT, "prompt_token_count": None, "generation_token_count": i + 1, "stop_reason": None}
+
+
+def _mistral_events(chunks):
+    for _ in range(chunks):
+        yield {"outputs": [{"text": DELTA_TEXT, "stop_reason": None}]}
+
+
+class FakeBedrockClient:
+    """
+    Mimics a bedrock-runtime client for the anthropic, meta and mistral families.
+
+    Streamed events are JSON-encoded up front, compact like the bytes botocore hands over,
+    and `invoked_at` records when the pipeline finished building its payload.
+    With `delay`, each streamed event (or the whole answer) takes that long, like
+    a model generating; `invocations` counts the calls. `deltas` is the number of
+    text deltas of a streamed answer.
+    """
+
+    def __init__(self, family, chunks=STREAM_CHUNKS, delay=0.0):
+        self.family = family
+        self.chunks = chunks
+        self.deltas = chunks
+        self.delay = delay
+        self.invocations = 0
+        self.invoked_at = None
+        self.last_body = None
+        events = {"anthropic": _anthropic_events, "meta": _meta_events, "mistral": _mistral_events}[family]
+        self.events = [{"chunk": {"bytes": json.dumps(event, separators=(",", ":")).encode()}} for event in events(chunks)]
+
+    def _record(self, body):
+        self.invoked_at = time.perf_counter()
+        self.last_body = body
+        self.invocations += 1
+
+    def _slow_events(self):
+        for event in self.events:
+            time.sleep(self.delay)
+            yield event
+
+    def invoke_model(self, modelId, body, **kwargs):
+        self._record(body)
+        if self.delay:
+            time.sleep(self.delay * self.chunks)
+        text = DELTA_TEXT * self.chunks
+        if self.family == "anthropic":
+            result = {
+                "content": [{"type": "text", "text": text}],
+                "usage": {"input_tokens": 1200, "output_tokens": self.chunks},
+            }
+        elif self.family == "meta":
+            result = {"generation": text, "prompt_token_count": 1200, "generation_token_count": self.chunks}
+        else:
+            result = {"outputs": [{"text": text, "stop_reason": "stop"}]}
+        return {"body": io.BytesIO(json.dumps(result).encode())}
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        self._record(body)
+        return {"body": self._slow_events() if self.delay else iter(self.events)}
+
+
+class SessionRecorder:
+    """Records when a pipeline's HTTP session sends its first request, i.e. when the payload was ready"""
+
+    def __init__(self, session):
+        self.invoked_at = None
+        request = session.request
+
+        def recorded_request(method, url, **kwargs):
+            if self.invoked_at is None:
+                self.invoked_at = time.perf_counter()
+            return request(method, url, **kwargs)
+
+        session.request = recorded_request
+
+
+class _ProviderHandler(BaseHTTPRequestHandler):
+    """OpenAI style API (also serving Perplexity and the DALL-E image CDN) on localhost"""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, Nagle would hold the body for ~40 ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.endswith("/models"):
+            self._send_json({"data": [{"id": "gpt-4o"}, {"id": "gpt-4o-mini"}, {"id": "dall-e-3"}]})
+        elif self.path.endswith("/image.png"):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(self.server.image)))
+            self.end_headers()
+            self.wfile.write(self.server.image)
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.endswith("/images/generations"):
+            if request.get("response_format") == "b64_json":
+                image = {"b64_json": base64.b64encode(self.server.image).decode()}
+            else:
+                image = {"url": f"http://{self.headers['Host']}/cdn/image.png"}
+            self._send_json({"created": 0, "data": [image] * request.get("n", 1)})
+        elif self.path.endswith("/chat/completions"):
+            if request.get("stream"):
+                self._stream_chat(request)
+            else:
+                self._send_json(
+                    {
+                        "id": "chatcmpl-bench",
+                        "object": "chat.completion",
+                        "model": request.get("model"),
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": DELTA_TEXT * STREAM_CHUNKS}}],
+                        "usage": {"prompt_tokens": 1200, "completion_tokens": STREAM_CHUNKS},
+                    }
+                )
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def _stream_chat(self, request):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for _ in range(STREAM_CHUNKS):
+            event = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": DELTA_TEXT}}]}
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+def _serve(port_queue, image):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ProviderHandler)
+    server.image = image
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class LocalProviderServer:
+    """Runs the fake OpenAI/Perplexity API in its own process, so its CPU time is not counted"""
+
+    def __init__(self, image=None):
+        # A real 1024x1024 PNG like DALL-E's, so the image store can make its thumbnail
+        image = image or png_image(1024, 1024)
+        context = multiprocessing.get_context("spawn")
+        port_queue = context.Queue()
+        self.process = context.Process(target=_serve, args=(port_queue, image), daemon=True)
+        self.process.start()
+        self.url = f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+
+    def close(self):
+        self.process.terminate()
+        self.process.join()
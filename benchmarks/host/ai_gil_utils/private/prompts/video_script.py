@@ -0,0 +1,13 @@
+"""
+Stand-in for the private video script prompts, which are not in the repository.
+
+As a namespace package portion it only fills in ai_gil_utils.private when the
+real one is missing. The prompt is about as long as a real system prompt with
+examples, so the prompt caching path of the Anthropic pipelines is exercised.
+"""
+
+TITLE_AND_HOOK_SYSTEM_PROMPT = "You write titles and opening hooks for videos.\n" + "\n".join(
+    f"Example {index}: a title that promises one concrete outcome, then a hook that opens a question "
+    f"the first thirty seconds of the video answer, without repeating the title word for word."
+    for index in range(60)
+)
@@ -0,0 +1,17 @@
+"""Stand-in for the pipelines server's schemas module"""
+
+from typing import List, Optional, Union
+
+from pydantic import BaseModel
+
+
+class OpenAIChatMessage(BaseModel):
+    role: str
+    content: Union[str, List]
+
+
+class OpenAIChatCompletionForm(BaseModel):
+    stream: bool = True
+    model: str
+    messages: List[OpenAIChatMessage]
+    chat_id: Optional[str] = None
@@ -0,0 +1,31 @@
+"""Stand-in for the helpers the pipelines server exposes as utils.pipelines.main"""
+
+
+def get_last_user_message(messages):
+    for message in reversed(messages):
+        if message["role"] == "user":
+            content = message["content"]
+            if isinstance(content, list):
+                return next((item["text"] for item in content if item["type"] == "text"), None)
+            return content
+    return None
+
+
+def pop_system_message(messages):
+    system_message = next((message for message in messages if message["role"] == "system"), None)
+    return (
+        system_message["content"] if system_message else None,
+        [message for message in messages if message["role"] != "system"],
+    )
+
+
+def add_or_update_system_message(content, messages):
+    if messages and messages[0]["role"] == "system":
+        messages[0]["content"] = f"{content}\n{messages[0]['content']}"
+    else:
+        messages.insert(0, {"role": "system", "content": content})
+    return messages
+
+
+def get_tools_specs(tools):
+    return []
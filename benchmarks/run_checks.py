@@ -0,0 +1,47 @@
+"""
+Runs the checks of every benchmark that has some, with small loads, and exits
+non-zero when one fails. The numbers they print are not compared with anything,
+run_suite does that for the pipelines' overhead.
+
+    python -m benchmarks.run_checks
+"""
+
+import importlib
+import sys
+import time
+import traceback
+
+# Module and arguments of its main, small enough to run in a few seconds
+CHECKS = [
+    ("bench_message_cache", (50,)),
+    ("bench_model_router", ()),
+    ("bench_single_flight", (5,)),
+    ("bench_stream_events", (10,)),
+]
+
+
+def main():
+    failed = []
+    for name, args in CHECKS:
+        print(f"== {name}")
+        start = time.perf_counter()
+        try:
+            importlib.import_module(f"benchmarks.{name}").main(*args)
+        except SystemExit as e:
+            if e.code:
+                failed.append(f"{name}: {e.code}")
+        except Exception:
+            traceback.print_exc()
+            failed.append(f"{name}: crashed")
+        print(f"   {time.perf_counter() - start:.1f} s\n")
+
+    if failed:
+        print("Failed:")
+        for failure in failed:
+            print(f"  {failure}")
+        sys.exit(1)
+    print(f"All checks of {len(CHECKS)} benchmarks passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""
+Overhead our pipelines add on top of the providers, measured offline.
+
+Every Pipeline.pipe in ai_gil_pipelines is driven against local stand-ins (fake
+Bedrock client, fake genai models, a local OpenAI/Perplexity/DALL-E server in its
+own process) with short chats, 200-turn histories and large images. For each
+scenario it reports the best of --repeat runs (the least disturbed by the machine) of:
+
+- wall_ms / cpu_ms: one chat turn, from pipe() to the last chunk consumed
+- payload_build_ms: from pipe() until the provider is called
+- ttft_ms: from pipe() to the first chunk, or to the whole answer without streaming,
+  so the :stream and :no_stream rows of a pipeline compare the time to first token
+- per_chunk_us: CPU time spent per streamed chunk between the provider and the consumer
+- peak_alloc_kb: peak traced Python allocations during one extra run
+
+Turns are measured warm: the chat minus its last exchange is sent first under the
+same chat_id, like the previous turn in Open WebUI. Timings are compared with the
+baselines after scaling by a fixed calibration workload, so a slower or busier
+machine does not read as a regression (the calibration runs right before each scenario).
+
+    python -m benchmarks.run_suite                   # compare with benchmarks/baselines.json
+    python -m benchmarks.run_suite --save-baseline   # record new baselines
+    python -m benchmarks.run_checks                  # the pass/fail checks of the bench_* scripts
+"""
+
+import argparse
+import contextlib
+import gc
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from benchmarks.common import image_data_url, load_pipeline, make_chat
+from benchmarks.fakes import (
+    FakeBedrockClient,
+    FakeGenerativeModel,
+    LocalProviderServer,
+    SessionRecorder,
+    install_fake_genai,
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+METRICS = ["wall_ms", "cpu_ms", "payload_build_ms", "ttft_ms", "per_chunk_us", "peak_alloc_kb"]
+# Differences below these are noise, whatever the relative change
+NOISE_FLOORS = {
+    "wall_ms": 1.0,
+    "cpu_ms": 1.0,
+    "payload_build_ms": 1.0,
+    "ttft_ms": 1.0,
+    "per_chunk_us": 5.0,
+    "peak_alloc_kb": 256,
+}
+
+
+def calibrate(repeat=15):
+    """Milliseconds for a fixed mix of the work the pipelines do: JSON, hashing and string handling"""
+    chat = make_chat(turns=50, image_every=0)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        payload = json.dumps({"messages": json.loads(json.dumps(chat))})
+        hashlib.sha256(payload.encode()).hexdigest()
+        "".join(message["content"].upper() for message in chat)
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def setup_bedrock(family):
+    def setup(module, pipeline, server):
+        pipeline.client = FakeBedrockClient(family)
+        return pipeline.client
+
+    return setup
+
+
+def setup_google(module, pipeline, server):
+    install_fake_genai(module)
+    pipeline.valves.GOOGLE_API_KEY = "benchmark"
+    pipeline.models.clear()
+    return FakeGenerativeModel
+
+
+def setup_openai(module, pipeline, server):
+    pipeline.valves.OPENAI_API_BASE_URL = f"{server.url}/v1"
+    pipeline.valves.OPENAI_API_KEY = "benchmark"
+    pipeline.session = pipeline.create_session()
+    return SessionRecorder(pipeline.session)
+
+
+def setup_perplexity(module, pipeline, server):
+    pipeline.valves.PERPLEXITY_API_BASE_URL = server.url
+    pipeline.valves.PERPLEXITY_API_KEY = "benchmark"
+    pipeline.session = pipeline.create_session()
+    return SessionRecorder(pipeline.session)
+
+
+def setup_dalle(response_format):
+    def setup(module, pipeline, server):
+        from ai_gil_utils.image_store import ImageStore
+
+        save_dir = tempfile.mkdtemp(prefix="ai_gil_bench_images_")
+        module.SAVE_DIR = save_dir
+        pipeline.image_store = ImageStore(save_dir)
+        pipeline.valves.OPENAI_API_BASE_URL = f"{server.url}/v1"
+        pipeline.valves.OPENAI_API_KEY = "benchmark"
+        pipeline.valves.RESPONSE_FORMAT = response_format
+        pipeline.update_client()
+        return None
+
+    return setup
+
+
+def scenarios():
+    short = make_chat(turns=2, image_every=0)
+    long_text = make_chat(turns=200, image_every=0)
+    long_images = make_chat(turns=200, image_every=50)  # the Anthropic pipelines allow 5 images per call
+    large_image = short[:-2] + [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "What is in this picture?"},
+                {"type": "image_url", "image_url": {"url": image_data_url()}},
+            ],
+        },
+        {"role": "assistant", "content": "A lot of noise."},
+        {"role": "user", "content": "Describe it in more detail."},
+    ]
+
+    multimodal = {"short": short, "long_200_images": long_images, "large_image": large_image}
+    text_only = {"short": short, "long_200": long_text}
+    pipelines = [
+        ("aws_anthropic_manifold_pipeline", "anthropic.claude-3-haiku-20240307-v1:0", setup_bedrock("anthropic"), multimodal),
+        (
+            "ai_gil_aws_anthropic_manifold_pipeline",
+            # Prompt caching model, with the large video hook system prompt
+            "us.anthropic.claude-3-7-sonnet-20250219-v1:0__video_hook",
+            setup_bedrock("anthropic"),
+            multimodal,
+        ),
+        ("aws_llama_manifold_pipeline", "meta.llama3-1-70b-instruct-v1:0", setup_bedrock("meta"), text_only),
+        ("aws_mistral_manifold_pipeline", "mistral.mistral-large-2407-v1:0", setup_bedrock("mistral"), text_only),
+        ("google_manifold_pipeline", "gemini-1.5-flash", setup_google, multimodal),
+        ("openai_manifold_pipeline", "gpt-4o", setup_openai, text_only),
+        ("perplexity_manifold_pipeline", "llama-3.1-sonar-small-128k-online", setup_perplexity, text_only),
+    ]
+    for module_name, model_id, setup, chats in pipelines:
+        for chat_name, messages in chats.items():
+            yield f"{module_name}:{chat_name}:stream", module_name, model_id, setup, messages, True
+        yield f"{module_name}:short:no_stream", module_name, model_id, setup, short, False
+
+    prompt = [{"role": "user", "content": "A watercolor fox"}]
+    for response_format in ["url", "b64_json"]:
+        name = f"openai_dalle_manifold_pipeline:{response_format}"
+        yield name, "openai_dalle_manifold_pipeline", "dall-e-3", setup_dalle(response_format), prompt, False
+
+
+def run_turn(pipeline, model_id, messages, stream, chat_id, provider):
+    """One chat turn through pipe, fully consumed. Returns the raw measurements."""
+    body = {"stream": stream, "chat_id": chat_id, "max_tokens": 1024, "temperature": 0.7}
+    if provider is not None:
+        provider.invoked_at = None
+    user_message = messages[-1]["content"] if isinstance(messages[-1]["content"], str) else ""
+
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    result = pipeline.pipe(user_message, model_id, list(messages), dict(body))
+    cpu_returned = time.process_time()
+
+    chunks = 0
+    first_at = None
+    if isinstance(result, (str, dict)):
+        chunks = 1
+    else:
+        for _ in result:
+            first_at = first_at or time.perf_counter()
+            chunks += 1
+    end = time.perf_counter()
+    cpu_end = time.process_time()
+
+    invoked_at = provider.invoked_at if provider is not None else None
+    # Per delta sent by the provider, coalescing hands the consumer fewer, larger chunks
+    deltas = getattr(provider, "deltas", None) or chunks
+    return {
+        "wall_ms": (end - start) * 1000,
+        "cpu_ms": (cpu_end - cpu_start) * 1000,
+        "payload_build_ms": (invoked_at - start) * 1000 if invoked_at else None,
+        "ttft_ms": ((first_at or end) - start) * 1000,
+        # CPU time, so the local server taking its turn to write the next event is not counted
+        "per_chunk_us": (cpu_end - cpu_returned) / deltas * 1_000_000 if chunks > 1 else None,
+        "result": result if isinstance(result, str) else None,
+    }
+
+
+class RecordingHandler(logging.Handler):
+    """Keeps the warnings of a logger, which the suite would otherwise not see"""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    @contextlib.contextmanager
+    def attach(self, name):
+        logger = logging.getLogger(name)
+        logger.addHandler(self)
+        try:
+            yield self
+        finally:
+            logger.removeHandler(self)
+
+
+def run_scenario(module_name, model_id, setup, messages, stream, server, repeat):
+    module, pipeline = load_pipeline(module_name)
+    provider = setup(module, pipeline, server)
+
+    def turn():
+        # The previous turn of the same chat, so caches are as warm as in a real conversation
+        chat_id = str(uuid.uuid4())
+        if len(messages) > 3:
+            run_turn(pipeline, model_id, messages[:-2], stream, chat_id, provider)
+        return run_turn(pipeline, model_id, messages, stream, chat_id, provider)
+
+    fallbacks = RecordingHandler()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), fallbacks.attach(
+        "ai_gil.image_preprocessing"
+    ):
+        calibration_ms = calibrate()
+        runs = []
+        for _ in range(repeat):
+            # Like timeit, keep collections triggered by earlier scenarios out of the timings
+            gc.collect()
+            gc.disable()
+            try:
+                runs.append(turn())
+            finally:
+                gc.enable()
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        turn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    errors = [run["result"] for run in runs if run["result"] and run["result"].startswith(("Error", "An error"))]
+    if errors:
+        raise RuntimeError(errors[0])
+    if fallbacks.records:
+        # Images sent as is: the numbers would not include the preprocessing
+        raise RuntimeError(f"{fallbacks.records[0].getMessage()}: {fallbacks.records[0].fields['error']}")
+
+    metrics = {"peak_alloc_kb": peak / 1024, "calibration_ms": calibration_ms}
+    for metric in ["wall_ms", "cpu_ms", "payload_build_ms", "ttft_ms", "per_chunk_us"]:
+        values = [run[metric] for run in runs if run[metric] is not None]
+        metrics[metric] = min(values) if values else None
+    return metrics
+
+
+def compare(name, metrics, baseline, tolerance):
+    regressions = []
+    if not baseline:
+        return regressions
+    # How much slower the machine is now than when the baseline was recorded
+    speed = metrics["calibration_ms"] / baseline["calibration_ms"] if "calibration_ms" in baseline else 1.0
+    for metric in METRICS:
+        new, old = metrics.get(metric), baseline.get(metric)
+        if new is None or old is None:
+            continue
+        if metric != "peak_alloc_kb":
+            old *= speed
+        if new > old * (1 + tolerance) and new - old > NOISE_FLOORS[metric]:
+            regressions.append(f"{name} {metric}: {old:.1f} -> {new:.1f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", default="", help="run scenarios whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="relative slowdown counted as a regression")
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    server = LocalProviderServer()
+    results = {}
+    regressions = []
+    try:
+        print(f"{'scenario':<64}" + "".join(f"{metric:>18}" for metric in METRICS))
+        for name, module_name, model_id, setup, messages, stream in scenarios():
+            if args.only not in name:
+                continue
+            try:
+                metrics = run_scenario(module_name, model_id, setup, messages, stream, server, args.repeat)
+            except ImportError as e:
+                print(f"{name:<64} skipped: {e}")
+                continue
+            results[name] = metrics
+            row = "".join(f"{'-' if metrics[m] is None else f'{metrics[m]:.2f}':>18}" for m in METRICS)
+            print(f"{name:<64}{row}")
+            regressions += compare(name, metrics, baselines.get(name), args.tolerance)
+    finally:
+        server.close()
+
+    if args.save_baseline:
+        baselines.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Saved baselines to {args.baseline}")
+    elif regressions:
+        print("\nRegressions against the baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
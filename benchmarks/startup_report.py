@@ -0,0 +1,17 @@
+"""
+Import, init and warm-up time of every pipeline, each loaded in a fresh interpreter.
+
+Same report as `python -m ai_gil_utils.startup` in the container, run against
+this checkout with the benchmark stand-ins for the server modules.
+
+    python -m benchmarks.startup_report
+"""
+
+import sys
+
+from benchmarks.common import PIPELINES_DIR
+
+from ai_gil_utils.startup import main
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or [PIPELINES_DIR], child_command=[sys.executable, "-W", "ignore", "-m", "benchmarks.startup_report"])
@@ -1,12 +1,22 @@
 import json
-import boto3
-import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ai_gil_utils.bedrock_clients import get_model_family
+from ai_gil_utils.bedrock_regions import get_bedrock_pool
+from ai_gil_utils.logs import get_logger, log_payload
+from ai_gil_utils.resilience import call_with_retry
+from ai_gil_utils.response_cache import get_response_cache, make_cache_key
+from ai_gil_utils.tokens import estimate_tokens
 
 aws_access_key_id = os.getenv("AWS_ACCESS_KEY_ID")
 aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY")
 aws_default_region = os.getenv("AWS_REGION")
 
+logger = get_logger("ai_gil")
+
 
 def get_model_id(model):
     if model == "llama3_8B":
@@ -30,29 +40,33 @@ def invoke_bedrock_with_single_text_message(
     max_tokens=1024,
     verbose=False,
     temperature=0,
+    use_cache=None,
 ):
     """
     Since each call has a relation of 20x1 or more from input/output tokens
     PRICE-WISE Haiku is the best model for this task, as opposed to Llama3 8B
     which is cheaper when the relation is less than 13x1
     (given the prices of the models at the time of writing this code)
+
+    use_cache: None caches only deterministic (temperature=0) calls,
+    True forces the cache on, False turns it off
     """
 
+    region = aws_default_region
     if model == "sonnet":
-        aws_default_region = "us-east-1"  # Sonnet model is only available in us-east-1 as of 2024-07-31
+        region = "us-east-1"  # Sonnet model is only available in us-east-1 as of 2024-07-31
 
-    # Initialize the Amazon Bedrock runtime client
-    client = boto3.client(
-        "bedrock-runtime",
-        region_name=aws_default_region,
+    model_id = get_model_id(model)
+
+    # Shared Amazon Bedrock runtime clients, spread over the regions of the model
+    # when BEDROCK_MODEL_REGIONS lists it, failing over when one throttles
+    client = get_bedrock_pool(
+        region_name=region,
         aws_access_key_id=aws_access_key_id,
         aws_secret_access_key=aws_secret_access_key,
+        model_family=get_model_family(model_id),
     )
 
-    model_id = get_model_id(model)
-    print(f"Model ID: {model_id}")
-    print(f"region: {aws_default_region}")
-
     if "meta" in model_id:
         body = {
             "max_gen_len": max_tokens,
@@ -63,6 +77,7 @@ def invoke_bedrock_with_single_text_message(
         body = {
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": max_tokens,
+            "temperature": temperature,
             "system": system_prompt,
             "messages": [
                 {
@@ -74,11 +89,21 @@ def invoke_bedrock_with_single_text_message(
     else:
         raise ValueError("Invalid model ID")
 
-    print(f"Body: {body}")
-    response = client.invoke_model(modelId=model_id, body=json.dumps(body))
+    log_payload(logger, "Invoking model", body, model_id=model_id, region=region)
 
-    # Process and print the response
-    result = json.loads(response.get("body").read())
+    result = None
+    cache_key = None
+    if use_cache or (use_cache is None and temperature == 0):
+        cache_key = make_cache_key(model_id, system_prompt, prompt, max_tokens, temperature)
+        result = get_response_cache().get(cache_key)
+
+    if result is None:
+        response = call_with_retry("ai_gil", client.invoke_model, modelId=model_id, body=json.dumps(body))
+        result = json.loads(response.get("body").read())
+        if cache_key is not None:
+            get_response_cache().set(cache_key, result)
+
+    # Print the response
 
     if verbose and "usage" in result.keys():
         input_tokens = result["usage"]["input_tokens"]
@@ -99,3 +124,106 @@ def invoke_bedrock_with_single_text_message(
         print(f"The output is: \n\n{result['generation']}")
 
     return result
+
+
+class _RateLimiter:
+    """Spaces out call starts so that at most `requests_per_second` begin each second"""
+
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class _TokenBudget:
+    """Blocks until the estimated tokens of the in-flight requests fit under `limit`"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, tokens):
+        if not self.limit:
+            return 0
+        tokens = min(tokens, self.limit)  # an oversized item still runs, just alone
+        with self.condition:
+            while self.in_flight + tokens > self.limit:
+                self.condition.wait()
+            self.in_flight += tokens
+        return tokens
+
+    def release(self, tokens):
+        if not tokens:
+            return
+        with self.condition:
+            self.in_flight -= tokens
+            self.condition.notify_all()
+
+
+def invoke_bedrock_batch(
+    items,
+    max_workers=8,
+    requests_per_second=None,
+    max_inflight_tokens=None,
+    max_tokens=1024,
+    temperature=0,
+    use_cache=None,
+):
+    """
+    Run many single text messages concurrently on a bounded thread pool.
+
+    items: list of (prompt, system_prompt, model) tuples or dicts with those keys
+    requests_per_second / max_inflight_tokens: limits applied per model, either a
+        number for every model or a dict like {"haiku": 10, "sonnet": 2}
+
+    Returns one {"result": ..., "error": ...} dict per item, in input order.
+    A failing item only sets its own "error", the rest of the batch keeps going.
+    """
+
+    def normalize(item):
+        if isinstance(item, dict):
+            return item["prompt"], item.get("system_prompt", ""), item.get("model", "haiku")
+        prompt, system_prompt, model = item
+        return prompt, system_prompt, model
+
+    def per_model(limit, model):
+        return limit.get(model) if isinstance(limit, dict) else limit
+
+    items = [normalize(item) for item in items]
+    models = {model for _, _, model in items}
+    rate_limiters = {model: _RateLimiter(per_model(requests_per_second, model)) for model in models}
+    token_budgets = {model: _TokenBudget(per_model(max_inflight_tokens, model)) for model in models}
+
+    def run(item):
+        prompt, system_prompt, model = item
+        budget = token_budgets[model]
+        reserved = budget.acquire(estimate_tokens(prompt) + estimate_tokens(system_prompt) + max_tokens)
+        try:
+            rate_limiters[model].wait()
+            result = invoke_bedrock_with_single_text_message(
+                prompt,
+                system_prompt=system_prompt,
+                model=model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                use_cache=use_cache,
+            )
+            return {"result": result, "error": None}
+        except Exception as e:
+            return {"result": None, "error": f"{type(e).__name__}: {e}"}
+        finally:
+            budget.release(reserved)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run, items))
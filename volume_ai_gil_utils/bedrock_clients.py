@@ -0,0 +1,98 @@
+import os
+import threading
+
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.getenv("BEDROCK_MAX_POOL_CONNECTIONS", "50"))
+BEDROCK_TCP_KEEPALIVE = os.getenv("BEDROCK_TCP_KEEPALIVE", "true").lower() == "true"
+
+# Cross-region inference profiles prefix the model id, e.g. "us.anthropic.claude-3-haiku..."
+INFERENCE_PROFILE_PREFIXES = ("us", "eu", "apac")
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_model_family(model_id):
+    """
+    "anthropic.claude-3-haiku-20240307-v1:0" -> "anthropic"
+    "us.meta.llama3-1-70b-instruct-v1:0" -> "meta"
+    """
+    parts = model_id.split(".")
+    if len(parts) > 2 and parts[0] in INFERENCE_PROFILE_PREFIXES:
+        return parts[1]
+    return parts[0]
+
+
+def get_bedrock_client(
+    region_name,
+    aws_access_key_id=None,
+    aws_secret_access_key=None,
+    model_family="default",
+    max_pool_connections=None,
+    tcp_keepalive=None,
+    max_attempts=None,
+):
+    """
+    Return a process-wide bedrock-runtime client for (region, credentials, model family).
+
+    Building a client resolves credentials and endpoints, and a fresh client starts
+    with an empty connection pool, so every call paid a new TLS handshake.
+    Clients are thread-safe once built, so they are shared by every pipeline and
+    by ai_gil.py. Each model family gets its own pool so long 405B generations
+    cannot starve the connections used by short Haiku calls. `max_attempts`
+    caps botocore's attempts, first call included: 1 turns retries off for calls retried by
+    ai_gil_utils.resilience.
+    """
+    max_pool_connections = max_pool_connections or BEDROCK_MAX_POOL_CONNECTIONS
+    tcp_keepalive = BEDROCK_TCP_KEEPALIVE if tcp_keepalive is None else tcp_keepalive
+    key = (
+        region_name,
+        aws_access_key_id or None,
+        aws_secret_access_key or None,
+        model_family,
+        max_pool_connections,
+        tcp_keepalive,
+        max_attempts,
+    )
+
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            # Imported here, boto3 takes ~0.2 s to import: loading a pipeline should not pay for it
+            import boto3
+            from botocore.config import Config
+
+            # boto3's default session is not thread-safe, use a dedicated one per client
+            session = boto3.session.Session(
+                aws_access_key_id=aws_access_key_id or None,
+                aws_secret_access_key=aws_secret_access_key or None,
+                region_name=region_name or None,
+            )
+            client = session.client(
+                service_name="bedrock-runtime",
+                config=Config(
+                    max_pool_connections=max_pool_connections,
+                    tcp_keepalive=tcp_keepalive,
+                    **({"retries": {"total_max_attempts": max_attempts, "mode": "standard"}} if max_attempts else {}),
+                ),
+            )
+            _clients[key] = client
+    return client
+
+
+def clear_bedrock_clients():
+    """Drop every cached client, e.g. after rotating credentials"""
+    with _clients_lock:
+        _clients.clear()
+
+
+def get_invocation_usage(response):
+    """Token counts of an invoke_model response, from the headers Bedrock adds for every model family"""
+    headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    return {
+        "inputTokenCount": headers.get("x-amzn-bedrock-input-token-count"),
+        "outputTokenCount": headers.get("x-amzn-bedrock-output-token-count"),
+    }
@@ -0,0 +1,194 @@
+import json
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import (
+    ClientError,
+    ConnectionClosedError,
+    ConnectTimeoutError,
+    EndpointConnectionError,
+    ReadTimeoutError,
+)
+
+from ai_gil_utils.bedrock_clients import get_bedrock_client
+from ai_gil_utils.logs import get_logger
+from ai_gil_utils.metrics import BEDROCK_FAILOVERS
+
+BEDROCK_REGION_COOLDOWN = float(os.getenv("BEDROCK_REGION_COOLDOWN", "10"))  # seconds, doubled per failure in a row
+BEDROCK_REGION_MAX_COOLDOWN = float(os.getenv("BEDROCK_REGION_MAX_COOLDOWN", "300"))
+
+# Regions to spread each model over, opt-in since it decides where the data goes.
+# Models not listed are only called in the pipeline's AWS_REGION. An entry
+# "<model id>@<region>" calls that model id from the region instead, e.g. a
+# cross-region inference profile:
+#   BEDROCK_MODEL_REGIONS='{"anthropic.claude-3-haiku-20240307-v1:0": ["us-east-1", "us-west-2"],
+#                           "anthropic.claude-3-5-sonnet-20240620-v1:0":
+#                           ["us.anthropic.claude-3-5-sonnet-20240620-v1:0@us-east-1", "us-west-2"]}'
+MODEL_REGIONS = json.loads(os.getenv("BEDROCK_MODEL_REGIONS", "{}"))
+
+# Errors another region may not have: throttling, capacity and network trouble
+FAILOVER_ERROR_CODES = {
+    "ThrottlingException",
+    "ServiceUnavailableException",
+    "ServiceUnavailable",
+    "ModelNotReadyException",
+    "InternalServerException",
+}
+FAILOVER_EXCEPTIONS = (ConnectTimeoutError, ReadTimeoutError, EndpointConnectionError, ConnectionClosedError)
+
+logger = get_logger("bedrock_regions")
+
+
+class RegionHealth:
+    """
+    Health of one (region, model id): a score between 0 and 1 that drops on
+    every failure and recovers with successes, and a cooldown after a failure
+    that doubles while the failures continue. Shared by the server's threads,
+    updates are locked; reads are not, a stale score only skews one pick.
+    """
+
+    __slots__ = ("score", "failures", "cooldown_until", "_lock")
+
+    def __init__(self):
+        self.score = 1.0
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self._lock = threading.Lock()
+
+    def success(self):
+        if self.failures or self.score < 1.0:
+            with self._lock:
+                self.score += 0.2 * (1.0 - self.score)
+                self.failures = 0
+                self.cooldown_until = 0.0
+
+    def failure(self, now):
+        with self._lock:
+            self.score = max(self.score * 0.5, 0.01)
+            self.failures += 1
+            cooldown = BEDROCK_REGION_COOLDOWN * 2 ** min(self.failures - 1, 10)
+            self.cooldown_until = now + min(cooldown, BEDROCK_REGION_MAX_COOLDOWN)
+
+
+# Shared by every pool: a region throttling one pipeline throttles them all
+_health = {}
+_health_lock = threading.Lock()
+
+
+def get_region_health(region, model_id):
+    key = (region, model_id)
+    health = _health.get(key)
+    if health is None:
+        with _health_lock:
+            health = _health.setdefault(key, RegionHealth())
+    return health
+
+
+def _error_code(error):
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code", "")
+    return type(error).__name__
+
+
+class BedrockRegionPool:
+    """
+    Stands in for a bedrock-runtime client (invoke_model and
+    invoke_model_with_response_stream) and sends each call to one of the
+    regions of its model.
+
+    Healthy regions are picked at random, weighted by their health score, so
+    the load is spread over them. When a region throttles, is unavailable or
+    times out, the call moves on to the next one and that region cools down;
+    regions that are cooling down are only tried once every other one failed.
+    """
+
+    def __init__(self, region_name, aws_access_key_id=None, aws_secret_access_key=None, model_family="default"):
+        self.region_name = region_name
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.model_family = model_family
+        self.targets = {}  # model id -> [(region, model id to call)]
+
+    def get_targets(self, model_id):
+        targets = self.targets.get(model_id)
+        if targets is None:
+            targets = []
+            for entry in MODEL_REGIONS.get(model_id) or [self.region_name]:
+                target_model_id, _, region = entry.rpartition("@")
+                targets.append((region, target_model_id or model_id))
+            self.targets[model_id] = targets
+        return targets
+
+    def ordered_targets(self, model_id):
+        targets = self.get_targets(model_id)
+        if len(targets) == 1:
+            return targets
+
+        now = time.monotonic()
+        ready = []
+        cooling = []
+        for target in targets:
+            health = get_region_health(*target)
+            if health.cooldown_until <= now:
+                # Weighted sampling without replacement: sort by u^(1/weight)
+                ready.append((random.random() ** (1.0 / health.score), target))
+            else:
+                cooling.append((health.cooldown_until, target))
+        ready.sort(reverse=True)
+        cooling.sort()
+        return [target for _, target in ready] + [target for _, target in cooling]
+
+    def get_client(self, region):
+        return get_bedrock_client(
+            region_name=region,
+            aws_access_key_id=self.aws_access_key_id,
+            aws_secret_access_key=self.aws_secret_access_key,
+            model_family=self.model_family,
+            # Every pool call is retried by ai_gil_utils.resilience (call_with_retry,
+            # retry_stream) under its retry budget, botocore must not retry underneath
+            max_attempts=1,
+        )
+
+    def warm_up(self, model_ids):
+        """Build the clients of every region of `model_ids` ahead of the first call"""
+        for model_id in model_ids:
+            targets = self.get_targets(model_id)
+            for region, _ in targets:
+                self.get_client(region)
+
+    def invoke(self, method, modelId, **kwargs):
+        targets = self.ordered_targets(modelId)
+        error = None
+        for index, (region, target_model_id) in enumerate(targets):
+            client = self.get_client(region)
+            health = get_region_health(region, target_model_id)
+            try:
+                response = getattr(client, method)(modelId=target_model_id, **kwargs)
+            except (ClientError, *FAILOVER_EXCEPTIONS) as e:
+                code = _error_code(e)
+                if isinstance(e, ClientError) and code not in FAILOVER_ERROR_CODES:
+                    raise
+                health.failure(time.monotonic())
+                error = e
+                if index + 1 < len(targets):
+                    # Only a failover when there is another region to go to
+                    BEDROCK_FAILOVERS.inc((modelId, region, code))
+                    fields = {"model_id": target_model_id, "region": region, "error": code}
+                    logger.warning("Bedrock region failed, trying the next one", extra={"fields": fields})
+                continue
+            health.success()
+            return response
+        raise error
+
+    def invoke_model(self, modelId, **kwargs):
+        return self.invoke("invoke_model", modelId, **kwargs)
+
+    def invoke_model_with_response_stream(self, modelId, **kwargs):
+        return self.invoke("invoke_model_with_response_stream", modelId, **kwargs)
+
+
+def get_bedrock_pool(region_name, aws_access_key_id=None, aws_secret_access_key=None, model_family="default"):
+    """Region pool with the signature of get_bedrock_client; `region_name` serves the models without a region list"""
+    return BedrockRegionPool(region_name, aws_access_key_id, aws_secret_access_key, model_family)
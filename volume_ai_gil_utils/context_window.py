@@ -0,0 +1,216 @@
+import os
+import threading
+from collections import OrderedDict
+
+from ai_gil_utils.logs import get_logger
+from ai_gil_utils.message_cache import MESSAGE_CACHE_MAX_CHATS
+from ai_gil_utils.tokens import IMAGE_TOKENS, estimate_tokens
+
+# (context window, default max output) in tokens, matched by substring of the model id
+MODEL_CONTEXT_LIMITS = {
+    "claude-3-5-sonnet": (200_000, 8192),
+    "claude-3-5-haiku": (200_000, 8192),
+    "claude-3-7-sonnet": (200_000, 8192),
+    "claude": (200_000, 4096),
+    "llama3-1": (128_000, 2048),
+    "mistral-large-2407": (128_000, 8192),
+    "gemini-1.5-pro": (2_000_000, 8192),
+    "gemini": (1_000_000, 8192),
+    "gpt-4o": (128_000, 16_384),
+    "sonar": (127_000, 4096),
+}
+DEFAULT_CONTEXT_LIMIT = (8192, 2048)
+
+CONTEXT_KEEP_LAST_MESSAGES = int(os.getenv("CONTEXT_KEEP_LAST_MESSAGES", "6"))
+CONTEXT_TRIM_TARGET_RATIO = float(os.getenv("CONTEXT_TRIM_TARGET_RATIO", "0.8"))
+CONTEXT_MAX_PASTE_TOKENS = int(os.getenv("CONTEXT_MAX_PASTE_TOKENS", "4000"))
+CONTEXT_SAFETY_MARGIN = 0.05  # the local estimate is not exact
+
+IMAGE_REMOVED = "[image removed to fit the context window]"
+
+_tokenizers = OrderedDict()
+
+logger = get_logger("context_window")
+
+
+def register_tokenizer(model_prefix, count_tokens):
+    """Use `count_tokens(text) -> int` (e.g. tiktoken) instead of the estimate for matching model ids"""
+    _tokenizers[model_prefix] = count_tokens
+
+
+def get_tokenizer(model_id):
+    for prefix, count_tokens in _tokenizers.items():
+        if prefix in model_id:
+            return count_tokens
+    return estimate_tokens
+
+
+def get_context_limit(model_id):
+    for prefix, limits in MODEL_CONTEXT_LIMITS.items():
+        if prefix in model_id:
+            return limits
+    return DEFAULT_CONTEXT_LIMIT
+
+
+def truncate_text(text, max_tokens, count_tokens=estimate_tokens):
+    """Keep the head and tail of a huge paste, dropping the middle"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    keep = max_tokens * 4
+    head, tail = text[: keep * 2 // 3], text[-(keep // 3) :]
+    return f"{head}\n\n[... {len(text) - len(head) - len(tail)} characters removed to fit the context window ...]\n\n{tail}"
+
+
+def compact_message(message, max_text_tokens=CONTEXT_MAX_PASTE_TOKENS, count_tokens=estimate_tokens):
+    """Drop the images of an OpenAI style message and truncate its huge texts"""
+    content = message.get("content")
+    if isinstance(content, str):
+        return {**message, "content": truncate_text(content, max_text_tokens, count_tokens)}
+    if isinstance(content, list):
+        compacted = []
+        for item in content:
+            if item.get("type") == "image_url":
+                compacted.append({"type": "text", "text": IMAGE_REMOVED})
+            elif item.get("type") == "text":
+                compacted.append({**item, "text": truncate_text(item["text"], max_text_tokens, count_tokens)})
+            else:
+                compacted.append(item)
+        return {**message, "content": compacted}
+    return message
+
+
+def _signature(message):
+    """What the token counts of a message depend on with the estimate: its role and the length of its texts"""
+    content = message.get("content")
+    if isinstance(content, list):
+        return message.get("role"), tuple((item.get("type"), len(item.get("text") or "")) for item in content)
+    return message.get("role"), len(content) if isinstance(content, str) else content
+
+
+def count_message_tokens(message, count_tokens=estimate_tokens):
+    content = message.get("content")
+    if isinstance(content, list):
+        return sum(
+            IMAGE_TOKENS if item.get("type") == "image_url" else count_tokens(item.get("text", ""))
+            for item in content
+        )
+    return count_tokens(content or "")
+
+
+class ContextWindow:
+    """
+    Trim OpenAI style messages to the model's context window before `pipe` converts them.
+
+    Policy, applied only once the history no longer fits:
+    1. system messages and the last `keep_last_messages` messages are always kept whole
+    2. older messages are compacted: images dropped first, huge pastes truncated
+    3. if that is not enough, the oldest messages are dropped
+    Trimming goes down to `target_ratio` of the budget, and where the chat was cut
+    is remembered, so the kept prefix stays identical for the following turns
+    (keeping the conversion and provider prompt caches warm) instead of shifting
+    by one message per turn.
+
+    Only token counts are cached per chat, next to the role and text lengths
+    they were computed from: the history itself is already kept by the
+    pipeline's ConversionCache. Each turn counts the new messages and those
+    whose lengths changed; an edit that keeps every length (rare, and off by a
+    few tokens at most with a real tokenizer) keeps its counts. Compacted
+    copies are only built for the messages a trimmed chat sends.
+    """
+
+    def __init__(
+        self,
+        keep_last_messages=CONTEXT_KEEP_LAST_MESSAGES,
+        target_ratio=CONTEXT_TRIM_TARGET_RATIO,
+        max_chats=MESSAGE_CACHE_MAX_CHATS,
+    ):
+        self.keep_last_messages = keep_last_messages
+        self.target_ratio = target_ratio
+        self.max_chats = max_chats
+        # (chat_id, model_id) -> (signatures, (full, compacted) tokens per message, dropped before, compacted before)
+        self._chats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_budget(self, model_id, max_output_tokens=None):
+        context_limit, default_output = get_context_limit(model_id)
+        return int(context_limit * (1 - CONTEXT_SAFETY_MARGIN)) - (max_output_tokens or default_output)
+
+    def count(self, key, messages, count_tokens):
+        """(full, compacted) token counts of every message, reusing the counts of the chat's previous turn"""
+        with self._lock:
+            cached_signatures, cached_stats, cut, compacted_before = self._chats.get(key, ((), [], 0, 0))
+
+        signatures = [_signature(message) for message in messages]
+        reused = 0
+        for signature, cached_signature in zip(signatures, cached_signatures):
+            if signature != cached_signature:
+                break
+            reused += 1
+
+        stats = cached_stats[:reused]
+        for message in messages[reused:]:
+            compacted = compact_message(message, count_tokens=count_tokens)
+            stats.append((count_message_tokens(message, count_tokens), count_message_tokens(compacted, count_tokens)))
+        return signatures, stats, cut, compacted_before
+
+    def fit(self, chat_id, model_id, messages, max_output_tokens=None):
+        count_tokens = get_tokenizer(model_id)
+        key = (chat_id, model_id) if chat_id else None
+        signatures, stats, cut, compacted_before = self.count(key, messages, count_tokens)
+        conversation = [i for i, message in enumerate(messages) if message["role"] != "system"]
+        budget = self.get_budget(model_id, max_output_tokens)
+
+        if compacted_before > len(conversation):
+            cut, compacted_before = 0, 0  # the history was edited, start over
+
+        def total_tokens():
+            total = sum(stats[i][0] for i, message in enumerate(messages) if message["role"] == "system")
+            for position, i in enumerate(conversation):
+                if position >= cut:
+                    total += stats[i][1] if position < compacted_before else stats[i][0]
+            return total
+
+        total = total_tokens()
+        if total > budget:
+            target = budget * self.target_ratio
+            protected = max(0, len(conversation) - self.keep_last_messages)
+            while compacted_before < protected and total > target:
+                full, compacted = stats[conversation[compacted_before]]
+                total -= full - compacted
+                compacted_before += 1
+            while cut < protected and total > target:
+                total -= stats[conversation[cut]][1]
+                cut += 1
+            # Providers expect the conversation to start with a user message
+            while cut < len(conversation) - 1 and messages[conversation[cut]]["role"] != "user":
+                total -= stats[conversation[cut]][1 if cut < compacted_before else 0]
+                cut += 1
+            compacted_before = max(compacted_before, cut)
+            if total > budget:
+                logger.warning(
+                    "Context still over budget after trimming",
+                    extra={"fields": {"model_id": model_id, "tokens": total, "budget": budget}},
+                )
+
+        if key is not None:
+            with self._lock:
+                self._chats.pop(key, None)
+                self._chats[key] = (signatures, stats, cut, compacted_before)
+                while len(self._chats) > self.max_chats:
+                    self._chats.popitem(last=False)
+
+        if cut == 0 and compacted_before == 0:
+            return messages
+
+        trimmed = []
+        position = 0
+        for i, message in enumerate(messages):
+            if message["role"] == "system":
+                trimmed.append(message)
+                continue
+            if position >= compacted_before:
+                trimmed.append(message)
+            elif position >= cut:
+                trimmed.append(compact_message(message, count_tokens=count_tokens))
+            position += 1
+        return trimmed
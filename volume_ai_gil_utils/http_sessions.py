@@ -0,0 +1,68 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))  # connections kept alive per host
+HTTP_POOL_BLOCK = os.getenv("HTTP_POOL_BLOCK", "false").lower() == "true"  # wait instead of exceeding it
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "300"))
+
+
+class PooledSession(requests.Session):
+    """requests.Session with keep-alive pools per host and default connect/read timeouts"""
+
+    def __init__(self, pool_maxsize=None, pool_block=None, connect_timeout=None, read_timeout=None):
+        super().__init__()
+        pool_maxsize = pool_maxsize or HTTP_POOL_MAXSIZE
+        pool_block = HTTP_POOL_BLOCK if pool_block is None else pool_block
+        self.timeout = (connect_timeout or HTTP_CONNECT_TIMEOUT, read_timeout or HTTP_READ_TIMEOUT)
+
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize, pool_block=pool_block)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_http_session(name, base_url=None, api_key=None, headers=None, **session_options):
+    """
+    Return the shared session registered under `name` (usually the pipeline id).
+
+    The session is only rebuilt when `base_url` or `api_key` differ from the ones
+    it was created with, so calling this from on_valves_updated keeps the warm
+    connections unless the provider settings really changed.
+
+    HTTP/2 is not offered by requests; keep-alive already removes the per-request
+    TCP and TLS handshakes, which is where most of the time went.
+    """
+    fingerprint = (base_url, api_key)
+    with _sessions_lock:
+        entry = _sessions.get(name)
+        if entry is not None and entry[0] == fingerprint:
+            return entry[1]
+
+        session = PooledSession(**session_options)
+        if api_key:
+            session.headers["Authorization"] = f"Bearer {api_key}"
+        session.headers.update(headers or {})
+        _sessions[name] = (fingerprint, session)
+
+    if entry is not None:
+        entry[1].close()
+    return session
+
+
+def close_http_sessions():
+    with _sessions_lock:
+        entries = list(_sessions.values())
+        _sessions.clear()
+    for _, session in entries:
+        session.close()
@@ -0,0 +1,123 @@
+import base64
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from ai_gil_utils.logs import get_logger
+
+try:
+    from PIL import Image
+except ImportError:  # without Pillow images are forwarded untouched
+    Image = None
+
+# Longest edge the model actually looks at, larger images are downscaled by the provider anyway
+MAX_IMAGE_EDGE = {
+    "anthropic": 1568,
+    "gemini": 3072,
+}
+IMAGE_RECOMPRESS_BYTES = int(os.getenv("IMAGE_RECOMPRESS_BYTES", str(1024 * 1024)))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", "2"))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+_pool = None
+_pool_lock = threading.Lock()
+
+logger = get_logger("image_preprocessing")
+
+
+def _shrink_image(base64_data, media_type, max_edge):
+    """Runs in a worker process: downscale to max_edge and recompress big opaque images as JPEG"""
+    raw = base64.b64decode(base64_data)
+    with Image.open(io.BytesIO(raw)) as image:
+        if getattr(image, "is_animated", False):
+            return base64_data, media_type
+
+        too_large = max_edge and max(image.size) > max_edge
+        too_heavy = len(raw) > IMAGE_RECOMPRESS_BYTES
+        if not too_large and not too_heavy:
+            return base64_data, media_type
+
+        if too_large:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        output = io.BytesIO()
+        has_alpha = image.mode in ("RGBA", "LA") or "transparency" in image.info
+        if has_alpha:
+            image.save(output, format="PNG", optimize=True)
+            new_media_type = "image/png"
+        else:
+            image.convert("RGB").save(output, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+            new_media_type = "image/jpeg"
+
+    if output.tell() >= len(raw):
+        return base64_data, media_type
+    return base64.b64encode(output.getvalue()).decode(), new_media_type
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # spawn, forking the threaded pipelines server is not safe
+                _pool = ProcessPoolExecutor(
+                    max_workers=IMAGE_PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn")
+                )
+    return _pool
+
+
+def _reset_pool(pool):
+    """Drop a pool whose worker died, the next image builds a new one"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def prepare_image(base64_data, media_type, max_edge):
+    """
+    Return (base64_data, media_type) resized to `max_edge` and recompressed when oversized.
+
+    Decoding and encoding run in a process pool so they do not hold the GIL of
+    the pipelines server. Results are cached by content hash, so an image sent
+    early in a chat is only processed once, not again on every later turn.
+    """
+    global _cache_bytes
+    if Image is None:
+        return base64_data, media_type
+
+    key = (hashlib.sha256(base64_data.encode()).hexdigest(), max_edge)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+            return cached
+
+    pool = _get_pool()
+    try:
+        result = pool.submit(_shrink_image, base64_data, media_type, max_edge).result()
+    except Exception as e:
+        # Not cached: a broken pool or a transient failure should not pin the image unprocessed
+        if isinstance(e, BrokenProcessPool):
+            _reset_pool(pool)
+        logger.warning("Failed to preprocess image, sending it as is", extra={"fields": {"error": repr(e)}})
+        return base64_data, media_type
+
+    with _cache_lock:
+        if key not in _cache:
+            _cache[key] = result
+            _cache_bytes += len(result[0])
+            while _cache_bytes > IMAGE_CACHE_MAX_BYTES and _cache:
+                _, (evicted_data, _) = _cache.popitem(last=False)
+                _cache_bytes -= len(evicted_data)
+    return result
@@ -0,0 +1,149 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+try:
+    from PIL import Image
+except ImportError:  # thumbnails are optional
+    Image = None
+
+CHUNK_SIZE = 64 * 1024
+IMAGE_STORE_MAX_BYTES = int(os.getenv("IMAGE_STORE_MAX_BYTES", str(2 * 1024**3)))
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "512"))  # 0 disables thumbnails
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "WEBP")  # or "JPEG"
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "80"))
+THUMBNAIL_DIR_NAME = "thumbnails"
+
+
+def save_image_chunks(chunks, save_dir, extension=".png"):
+    """
+    Stream `chunks` to disk under their content hash and return (file_name, bytes_written).
+
+    The data is hashed while it is written to a temporary file, which is then
+    renamed to `<sha256><extension>`. Identical images end up in the same file,
+    so a duplicate only costs the download, not extra disk space.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=save_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                if chunk:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+
+        file_name = f"{digest.hexdigest()}{extension}"
+        file_path = os.path.join(save_dir, file_name)
+        if os.path.exists(file_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, file_path)
+        return file_name, size
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_image_bytes(data, save_dir, extension=".png"):
+    return save_image_chunks([data], save_dir, extension)
+
+
+class ImageStore:
+    """
+    Content-addressed image directory with a disk budget and a thumbnail tier.
+
+    Originals live in `save_dir`, thumbnails (smaller WebP/JPEG copies for the
+    chat view) in `save_dir/thumbnails`. After each save, the least recently
+    saved originals and their thumbnails are evicted until the directory fits
+    in `max_bytes`. A duplicate save refreshes the original's position.
+    Thumbnails need Pillow; without it only the originals are kept.
+    """
+
+    def __init__(
+        self,
+        save_dir,
+        max_bytes=IMAGE_STORE_MAX_BYTES,
+        thumbnail_size=THUMBNAIL_SIZE,
+        thumbnail_format=THUMBNAIL_FORMAT,
+        thumbnail_quality=THUMBNAIL_QUALITY,
+    ):
+        self.save_dir = save_dir
+        self.thumbnail_dir = os.path.join(save_dir, THUMBNAIL_DIR_NAME)
+        self.max_bytes = max_bytes
+        self.thumbnail_size = thumbnail_size
+        self.thumbnail_format = thumbnail_format.upper()
+        self.thumbnail_quality = thumbnail_quality
+        self._lock = threading.Lock()
+
+    def save_chunks(self, chunks, extension=".png"):
+        """Return (file_name, thumbnail_name or None, bytes_written)"""
+        file_name, size = save_image_chunks(chunks, self.save_dir, extension)
+        file_path = os.path.join(self.save_dir, file_name)
+        os.utime(file_path)  # mark as recently used, also for deduplicated saves
+        thumbnail_name = self.make_thumbnail(file_name)
+        self.evict()
+        return file_name, thumbnail_name, size
+
+    def save_bytes(self, data, extension=".png"):
+        return self.save_chunks([data], extension)
+
+    def thumbnail_name(self, file_name):
+        extension = ".jpg" if self.thumbnail_format == "JPEG" else f".{self.thumbnail_format.lower()}"
+        return f"{os.path.splitext(file_name)[0]}{extension}"
+
+    def make_thumbnail(self, file_name):
+        if Image is None or not self.thumbnail_size:
+            return None
+        thumbnail_name = self.thumbnail_name(file_name)
+        thumbnail_path = os.path.join(self.thumbnail_dir, thumbnail_name)
+        if os.path.exists(thumbnail_path):
+            return thumbnail_name
+
+        try:
+            os.makedirs(self.thumbnail_dir, exist_ok=True)
+            with Image.open(os.path.join(self.save_dir, file_name)) as image:
+                image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+                if self.thumbnail_format == "JPEG" and image.mode != "RGB":
+                    image = image.convert("RGB")
+                tmp_path = f"{thumbnail_path}.part"
+                image.save(tmp_path, format=self.thumbnail_format, quality=self.thumbnail_quality)
+            os.replace(tmp_path, thumbnail_path)
+            return thumbnail_name
+        except Exception as e:
+            print(f"Failed to create thumbnail for {file_name}: {e}")
+            return None
+
+    def evict(self):
+        """Delete the oldest originals (and their thumbnails) until the store fits in max_bytes"""
+        if not self.max_bytes:
+            return
+        with self._lock:
+            entries = []
+            total = 0
+            for directory in (self.save_dir, self.thumbnail_dir):
+                if not os.path.isdir(directory):
+                    continue
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_file() and not entry.name.endswith(".part"):
+                            stat = entry.stat()
+                            total += stat.st_size
+                            if directory == self.save_dir:
+                                entries.append((stat.st_mtime, entry.name, stat.st_size))
+
+            entries.sort()
+            for _, file_name, size in entries:
+                if total <= self.max_bytes:
+                    break
+                total -= size
+                os.remove(os.path.join(self.save_dir, file_name))
+                thumbnail_path = os.path.join(self.thumbnail_dir, self.thumbnail_name(file_name))
+                if os.path.exists(thumbnail_path):
+                    total -= os.path.getsize(thumbnail_path)
+                    os.remove(thumbnail_path)
+                print(f"Evicted image {file_name} ({size} bytes)")
@@ -0,0 +1,118 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+AI_GIL_LOG_LEVEL = os.getenv("AI_GIL_LOG_LEVEL", "INFO").upper()  # DEBUG to log the (redacted) payloads
+AI_GIL_LOG_SAMPLE_RATE = float(os.getenv("AI_GIL_LOG_SAMPLE_RATE", "1"))  # share of the payloads logged at DEBUG
+AI_GIL_LOG_MAX_STRING = int(os.getenv("AI_GIL_LOG_MAX_STRING", "200"))  # characters kept per string
+AI_GIL_LOG_MAX_ITEMS = int(os.getenv("AI_GIL_LOG_MAX_ITEMS", "10"))  # list items kept, e.g. the last messages
+
+REDACTED_KEYS = {"api_key", "authorization", "aws_access_key_id", "aws_secret_access_key", "password", "token"}
+_DATA_URL = re.compile(r"data:([\w/+.-]+);base64,", re.IGNORECASE)
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+class StructuredFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and the record's `fields`"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def get_logger(name):
+    """
+    Logger under "ai_gil", writing JSON lines to stdout through a queue: the
+    request threads only enqueue records and one background thread does the
+    writing, so a slow container log driver never blocks a request. DEBUG is
+    off unless AI_GIL_LOG_LEVEL=DEBUG.
+    """
+    global _listener
+    root = logging.getLogger("ai_gil")
+    with _listener_lock:
+        if _listener is None:
+            log_queue = queue.SimpleQueue()
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(StructuredFormatter())
+            _listener = QueueListener(log_queue, handler)
+            _listener.start()
+            atexit.register(_listener.stop)
+
+            root.addHandler(QueueHandler(log_queue))
+            root.setLevel(AI_GIL_LOG_LEVEL)
+            root.propagate = False
+    return root.getChild(name)
+
+
+def redact(value, max_string=AI_GIL_LOG_MAX_STRING, max_items=AI_GIL_LOG_MAX_ITEMS):
+    """
+    Copy of `value` that is small enough to log: image data is replaced by its
+    size, long strings are truncated, long lists keep their last items and
+    credentials are masked.
+    """
+    if isinstance(value, str):
+        match = _DATA_URL.match(value)
+        if match:
+            return f"<{match.group(1)} data, {len(value) - match.end()} base64 chars>"
+        if len(value) > max_string:
+            return f"{value[:max_string]}...(+{len(value) - max_string} chars)"
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return f"<{len(value)} bytes>"
+    if isinstance(value, dict):
+        redacted = {}
+        for key, item in value.items():
+            if str(key).lower() in REDACTED_KEYS:
+                redacted[key] = "***"
+            elif key == "data" and isinstance(item, str) and len(item) > max_string:
+                # Anthropic and Gemini images: {"type": "base64", "media_type": ..., "data": ...}
+                redacted[key] = f"<{len(item)} base64 chars>"
+            else:
+                redacted[key] = redact(item, max_string, max_items)
+        return redacted
+    if isinstance(value, (list, tuple)):
+        items = [redact(item, max_string, max_items) for item in value[-max_items:]]
+        if len(value) > max_items:
+            items.insert(0, f"<{len(value) - max_items} earlier items>")
+        return items
+    return value
+
+
+def log_payload(logger, message, payload, **fields):
+    """
+    Log a redacted `payload` at DEBUG for a sample of the calls. Nothing is
+    copied or serialized when DEBUG is off, so this is free in production.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if AI_GIL_LOG_SAMPLE_RATE < 1 and random.random() >= AI_GIL_LOG_SAMPLE_RATE:
+        return
+    logger.debug(message, extra={"fields": {**fields, "payload": redact(payload)}})
+
+
+def log_metrics(logger, metrics, **fields):
+    """
+    Log a request's RequestMetrics summary (time to first token, duration,
+    payload size, token usage) at DEBUG. The same numbers are exported by
+    ai_gil_utils.metrics, this is for following a single request.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    logger.debug("Request metrics", extra={"fields": {"model_id": metrics.model_id, **fields, "metrics": metrics.summary()}})
@@ -0,0 +1,113 @@
+import os
+import threading
+from collections import OrderedDict
+
+MESSAGE_CACHE_MAX_CHATS = int(os.getenv("MESSAGE_CACHE_MAX_CHATS", "256"))
+# Cached chats hold their base64 images (original and converted), so they are also capped by size, per cache
+MESSAGE_CACHE_MAX_BYTES = int(os.getenv("MESSAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+SHAPE_MAX_CHARS = 256
+
+
+def _shape(content):
+    """Hashable outline of a message content: short strings as they are, longer ones by their length only"""
+    if isinstance(content, str):
+        return content if len(content) < SHAPE_MAX_CHARS else len(content)
+    if isinstance(content, dict):
+        return tuple((key, _shape(value)) for key, value in content.items())
+    if isinstance(content, list):
+        return tuple(_shape(item) for item in content)
+    return content
+
+
+def _size(value):
+    """Approximate bytes held by a converted message: the length of its strings"""
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_size(item) for item in value)
+    return 0
+
+
+def _normalized(message):
+    """What a message asks: role and content only, text stripped, so ids, timestamps or trailing whitespace do not count"""
+    content = message.get("content")
+    return message.get("role"), content.strip() if isinstance(content, str) else content
+
+
+def messages_shape(messages):
+    """
+    Cheap hashable key of a list of messages, equal for identical requests.
+
+    Nothing is hashed beyond short strings, so it costs next to nothing for
+    chats with megabytes of images; requests with the same shape may still
+    differ, compare them with same_messages.
+    """
+    return tuple((role, _shape(content)) for role, content in map(_normalized, messages))
+
+
+def same_messages(messages, other):
+    """Whether two lists of messages ask the same, compared exactly (string comparison, no hashing)"""
+    return len(messages) == len(other) and all(
+        _normalized(message) == _normalized(other_message) for message, other_message in zip(messages, other)
+    )
+
+
+class ConversionCache:
+    """
+    Per-chat cache of converted messages.
+
+    Open WebUI resends the whole history every turn, so each pipeline used to
+    re-convert every message (re-splitting data URLs, rebuilding content dicts).
+    Here the converted messages are kept per `chat_id` next to their originals;
+    on the next turn the longest prefix equal to the cached originals is reused
+    and only the new tail goes through `convert_message`. Comparing the strings
+    is exact and several times cheaper than hashing megabytes of base64 every
+    turn. At most `max_chats` chats and `max_bytes` (originals and converted
+    messages) are kept, least recently used first out.
+
+    Converted messages are shared between turns, callers must copy before mutating them.
+    """
+
+    def __init__(self, max_chats=MESSAGE_CACHE_MAX_CHATS, max_bytes=MESSAGE_CACHE_MAX_BYTES):
+        self.max_chats = max_chats
+        self.max_bytes = max_bytes
+        self.hits = 0  # messages reused
+        self.misses = 0  # messages converted
+        self._chats = OrderedDict()  # chat_id -> (originals, converted, sizes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def convert(self, chat_id, messages, convert_message):
+        if not chat_id:
+            self.misses += len(messages)
+            return [convert_message(message) for message in messages]
+
+        with self._lock:
+            cached_originals, cached_converted, cached_sizes = self._chats.get(chat_id, ([], [], []))
+
+        reused = 0
+        for message, cached_message in zip(messages, cached_originals):
+            if message != cached_message:
+                break
+            reused += 1
+
+        added = [convert_message(message) for message in messages[reused:]]
+        converted = cached_converted[:reused] + added
+        sizes = cached_sizes[:reused] + [
+            _size(message) + _size(converted_message) for message, converted_message in zip(messages[reused:], added)
+        ]
+        self.hits += reused
+        self.misses += len(messages) - reused
+
+        with self._lock:
+            previous = self._chats.pop(chat_id, None)
+            if previous is not None:
+                self._bytes -= sum(previous[2])
+            self._chats[chat_id] = (list(messages), converted, sizes)
+            self._bytes += sum(sizes)
+            while self._chats and (len(self._chats) > self.max_chats or self._bytes > self.max_bytes):
+                _, (_, _, evicted_sizes) = self._chats.popitem(last=False)
+                self._bytes -= sum(evicted_sizes)
+        return list(converted)
@@ -0,0 +1,328 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ai_gil_utils.tokens import CHARS_PER_TOKEN
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # serve /metrics in Prometheus format, 0 to disable
+METRICS_DUMP_PATH = os.getenv("METRICS_DUMP_PATH", "")  # e.g. /app/ai_gil_utils/cache/metrics.prom
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", "60"))
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+TOKENS_PER_SECOND_BUCKETS = (5, 10, 20, 35, 50, 75, 100, 150, 200, 300, 500)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 3e5, 1e6, 3e6, 1e7, 3e7, 1e8)
+HOOK_SECONDS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+
+
+class Histogram:
+    """Prometheus style histogram: cumulative bucket counts, sum and count per label set"""
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self, label_names):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            label_text = _format_labels(label_names, labels)
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bucket}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {values[-1]}")
+            lines.append(f"{self.name}_count{{{label_text}}} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, value=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + value
+
+    def render(self, label_names):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            series = dict(self._series)
+        for labels, value in sorted(series.items()):
+            lines.append(f"{self.name}{{{_format_labels(label_names, labels)}}} {value}")
+        return lines
+
+
+def _format_labels(names, values):
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for value in values)
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+REQUEST_LABELS = ("pipeline", "model_id")
+
+TIME_TO_FIRST_TOKEN = Histogram(
+    "ai_gil_time_to_first_token_seconds",
+    "From pipe() to the first streamed token, or to the whole answer when not streaming (mode)",
+    SECONDS_BUCKETS,
+)
+REQUEST_DURATION = Histogram(
+    "ai_gil_request_duration_seconds", "From pipe() to the end of the response", SECONDS_BUCKETS
+)
+OUTPUT_TOKENS_PER_SECOND = Histogram(
+    "ai_gil_output_tokens_per_second", "Output tokens over the time spent generating them", TOKENS_PER_SECOND_BUCKETS
+)
+PAYLOAD_BYTES = Histogram("ai_gil_payload_bytes", "Size of the request body sent to the provider", BYTES_BUCKETS)
+REQUESTS = Counter("ai_gil_requests_total", "Requests by final status")
+TOKENS = Counter("ai_gil_tokens_total", "Tokens reported by the provider (estimated when it reports none)")
+COALESCED_REQUESTS = Counter(
+    "ai_gil_coalesced_requests_total", "Requests served by an identical request already in flight"
+)
+ROUTED_REQUESTS = Counter("ai_gil_routed_requests_total", "Requests of the router's virtual models by chosen model")
+BEDROCK_FAILOVERS = Counter("ai_gil_bedrock_failovers_total", "Bedrock calls moved to another region, by error")
+RETRIES = Counter("ai_gil_provider_retries_total", "Provider calls retried after a transient error")
+CIRCUIT_REJECTIONS = Counter("ai_gil_circuit_rejections_total", "Calls failed fast while a provider's circuit was open")
+FILTER_HOOK_DURATION = Histogram(
+    "ai_gil_filter_hook_duration_seconds", "Time spent in filter inlet/outlet hooks", HOOK_SECONDS_BUCKETS
+)
+
+_METRICS = [
+    (TIME_TO_FIRST_TOKEN, REQUEST_LABELS + ("mode",)),
+    (REQUEST_DURATION, REQUEST_LABELS),
+    (OUTPUT_TOKENS_PER_SECOND, REQUEST_LABELS),
+    (PAYLOAD_BYTES, REQUEST_LABELS),
+    (REQUESTS, REQUEST_LABELS + ("status",)),
+    (TOKENS, REQUEST_LABELS + ("type",)),
+    (COALESCED_REQUESTS, REQUEST_LABELS),
+    (ROUTED_REQUESTS, ("strategy", "model_id")),
+    (BEDROCK_FAILOVERS, ("model_id", "region", "error")),
+    (RETRIES, ("provider", "error")),
+    (CIRCUIT_REJECTIONS, ("provider",)),
+    (FILTER_HOOK_DURATION, ("filter", "hook", "model_id")),
+]
+
+# Names used by the providers for the same usage numbers
+_USAGE_KEYS = {
+    "input": ("input_tokens", "prompt_tokens", "prompt_token_count", "inputTokenCount"),
+    "output": ("output_tokens", "completion_tokens", "generation_token_count", "candidates_token_count", "outputTokenCount"),
+    "cache_read": ("cache_read_input_tokens", "cacheReadInputTokenCount", "cached_content_token_count"),
+    "cache_write": ("cache_creation_input_tokens", "cacheWriteInputTokenCount"),
+}
+
+
+class RequestMetrics:
+    """
+    Timings and usage of one pipe() call, recorded once it ends.
+
+    Create it when pipe() starts, then:
+    - `record_payload(size)` with the size of the serialized request
+    - `track(stream)` around a streamed response, or `finish()` after a complete one
+    - `record_usage(usage)` whenever the provider reports token counts
+
+    Per streamed chunk `track` only does a couple of comparisons and additions;
+    the histograms are only touched once, when the response ends.
+    """
+
+    __slots__ = (
+        "pipeline",
+        "model_id",
+        "start",
+        "first_token_at",
+        "payload_bytes",
+        "chunks",
+        "output_chars",
+        "usage",
+        "finished",
+    )
+
+    def __init__(self, pipeline, model_id):
+        self.pipeline = pipeline
+        self.model_id = model_id
+        self.start = time.perf_counter()
+        self.first_token_at = None
+        self.payload_bytes = None
+        self.chunks = 0
+        self.output_chars = 0
+        self.usage = {}
+        self.finished = False
+
+    def record_payload(self, size):
+        self.payload_bytes = size
+
+    def record_usage(self, usage):
+        """Accepts the usage dict of Bedrock, OpenAI, Perplexity or Gemini (later values win)"""
+        for kind, keys in _USAGE_KEYS.items():
+            for key in keys:
+                value = usage.get(key)
+                if value is not None:
+                    self.usage[kind] = int(value)
+                    break
+
+    def track(self, stream):
+        """Yield the chunks of `stream` unchanged, timing the first non-empty one"""
+        status = "error"
+        try:
+            for chunk in stream:
+                if chunk:
+                    self._record_chunk(chunk)
+                yield chunk
+            status = "ok"
+        except GeneratorExit:
+            status = "cancelled"
+            raise
+        finally:
+            self.finish(status=status)
+
+    async def track_async(self, stream):
+        """`track` for async generators"""
+        status = "error"
+        try:
+            async for chunk in stream:
+                if chunk:
+                    self._record_chunk(chunk)
+                yield chunk
+            status = "ok"
+        except GeneratorExit:
+            status = "cancelled"
+            raise
+        finally:
+            self.finish(status=status)
+
+    def _record_chunk(self, chunk):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.chunks += 1
+        if type(chunk) is str:
+            self.output_chars += len(chunk)
+
+    def finish(self, text=None, status="ok"):
+        if self.finished:
+            return
+        self.finished = True
+        end = time.perf_counter()
+        mode = "stream" if text is None else "complete"
+        if text is not None:
+            self.first_token_at = self.first_token_at or end
+            self.output_chars += len(text)
+            self.chunks = 1
+
+        labels = (self.pipeline, self.model_id)
+        REQUEST_DURATION.observe(labels, end - self.start)
+        REQUESTS.inc(labels + (status,))
+        if self.payload_bytes is not None:
+            PAYLOAD_BYTES.observe(labels, self.payload_bytes)
+        if self.first_token_at is None:
+            return
+
+        TIME_TO_FIRST_TOKEN.observe(labels + (mode,), self.first_token_at - self.start)
+        # Without usage from the provider: estimated from the text, or one token per raw event
+        output_tokens = self.usage.get("output") or (self.output_chars // CHARS_PER_TOKEN or self.chunks)
+        generation_time = end - self.first_token_at
+        if generation_time > 0 and self.chunks > 1:
+            OUTPUT_TOKENS_PER_SECOND.observe(labels, output_tokens / generation_time)
+        for kind, value in {**self.usage, "output": output_tokens}.items():
+            TOKENS.inc(labels + (kind,), value)
+
+    def summary(self):
+        end = time.perf_counter()
+        ttft = f"{self.first_token_at - self.start:.2f}s" if self.first_token_at else "-"
+        usage = " ".join(f"{kind}={value}" for kind, value in self.usage.items())
+        return f"ttft={ttft} total={end - self.start:.2f}s payload={self.payload_bytes or 0}B {usage}".rstrip()
+
+
+@contextmanager
+def time_hook(filter_name, hook, model_id=None):
+    """Time a filter's inlet/outlet: `with time_hook(self.name, "inlet", body.get("model")): ...`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        FILTER_HOOK_DURATION.observe((filter_name, hook, model_id or ""), time.perf_counter() - start)
+
+
+def render_prometheus():
+    lines = []
+    for metric, label_names in _METRICS:
+        lines.extend(metric.render(label_names))
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        data = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def dump_metrics(path=METRICS_DUMP_PATH):
+    # Written next to the target then renamed, so readers never see half a file
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+
+def _dump_periodically(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            dump_metrics(path)
+        except OSError as e:
+            print(f"Failed to dump metrics to {path}: {e}")
+
+
+_exporter_started = False
+_exporter_lock = threading.Lock()
+
+
+def start_metrics_exporter(port=METRICS_PORT, dump_path=METRICS_DUMP_PATH, dump_interval=METRICS_DUMP_INTERVAL):
+    """
+    Start the configured exporters once per process, whichever pipeline asks first:
+    an HTTP endpoint for Prometheus on `port`, and/or a dump to `dump_path` every
+    `dump_interval` seconds. All pipelines share the same metrics.
+    """
+    global _exporter_started
+    with _exporter_lock:
+        if _exporter_started:
+            return
+        _exporter_started = True
+
+    if port:
+        try:
+            server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+        except OSError as e:
+            print(f"Could not serve metrics on port {port}: {e}")
+        else:
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+            print(f"Serving metrics on :{port}/metrics")
+    if dump_path:
+        threading.Thread(
+            target=_dump_periodically, args=(dump_path, dump_interval), name="metrics-dump", daemon=True
+        ).start()
@@ -0,0 +1,89 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+AI_GIL_CACHE_DIR = os.getenv("AI_GIL_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
+MODEL_CACHE_TTL_SECONDS = float(os.getenv("MODEL_CACHE_TTL_SECONDS", "3600"))
+MODEL_DISCOVERY_STARTUP_TIMEOUT = float(os.getenv("MODEL_DISCOVERY_STARTUP_TIMEOUT", "10"))
+
+
+class ModelDiscovery:
+    """
+    Keep a pipeline's model list without blocking the pipelines server.
+
+    The last good list is read from `<AI_GIL_CACHE_DIR>/models/<name>.json` and
+    served right away; fetching from the provider happens in a background thread
+    and `on_update(models)` is called with the fresh list. If a fetch fails, the
+    last good list is kept, or `error_models` is served when there is none.
+    """
+
+    def __init__(self, name, fetch_models, on_update, error_models=None, ttl=MODEL_CACHE_TTL_SECONDS):
+        self.name = name
+        self.fetch_models = fetch_models
+        self.on_update = on_update
+        self.error_models = error_models or []
+        self.ttl = ttl
+        self.cache_path = os.path.join(AI_GIL_CACHE_DIR, "models", f"{name}.json") if AI_GIL_CACHE_DIR else None
+        self.models, self.fetched_at = self._load()
+        self._generation = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+            return cached["models"], cached["fetched_at"]
+        except Exception:
+            return [], 0
+
+    def _save(self):
+        if not self.cache_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"fetched_at": self.fetched_at, "models": self.models}, f)
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            print(f"Could not cache models for {self.name}: {e}")
+
+    def is_stale(self):
+        return time.time() - self.fetched_at > self.ttl
+
+    def refresh(self, force=False):
+        """Start a background fetch when the cached list is stale, or always with `force` (e.g. new API key)"""
+        with self._lock:
+            if not force and (not self.is_stale() or (self._thread and self._thread.is_alive())):
+                return
+            # A newer refresh supersedes older ones, whose results are then ignored
+            self._generation += 1
+            self._thread = threading.Thread(
+                target=self._run, args=(self._generation,), name=f"model-discovery-{self.name}", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self, generation):
+        try:
+            models = self.fetch_models()
+        except Exception as e:
+            print(f"Error fetching models for {self.name}: {e}")
+            if generation == self._generation and not self.models:
+                self.on_update(self.error_models)
+            return
+
+        if generation != self._generation:
+            return
+        self.models = models
+        self.fetched_at = time.time()
+        self._save()
+        self.on_update(models)
+
+    async def wait_if_empty(self, timeout=MODEL_DISCOVERY_STARTUP_TIMEOUT):
+        """On a cold cache, give the first fetch a bounded chance to finish before startup completes"""
+        thread = self._thread
+        if not self.models and thread is not None:
+            await asyncio.to_thread(thread.join, timeout)
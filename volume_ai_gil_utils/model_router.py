@@ -0,0 +1,210 @@
+import os
+import threading
+import time
+
+from ai_gil_utils.context_window import get_context_limit
+from ai_gil_utils.tokens import CHARS_PER_TOKEN, IMAGE_TOKENS
+
+ROUTER_EXPECTED_OUTPUT_TOKENS = int(os.getenv("ROUTER_EXPECTED_OUTPUT_TOKENS", "500"))  # before the chat has answers
+ROUTER_STATS_ALPHA = float(os.getenv("ROUTER_STATS_ALPHA", "0.2"))  # weight of the latest request in the averages
+ROUTER_MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.5"))
+ROUTER_RETRY_AFTER = float(os.getenv("ROUTER_RETRY_AFTER", "30"))  # seconds before an unhealthy backend gets a probe
+
+# Backends the router can pick, with list prices in $ per million tokens and the
+# latency to expect before live numbers come in (time to first token, output tokens/s).
+# Llama 3.1 8B vs Haiku: 0.3x + 0.6 = 0.25x + 1.25 at x = 13 input tokens per output
+# token, the break-even worked out by hand in ai_gil.py.
+MODEL_PROFILES = {
+    "anthropic.claude-3-haiku-20240307-v1:0": {
+        "pipeline": "aws_anthropic_manifold_pipeline",
+        "input_price": 0.25,
+        "output_price": 1.25,
+        "ttft": 0.6,
+        "tokens_per_second": 120,
+        "vision": True,
+    },
+    "anthropic.claude-3-5-sonnet-20240620-v1:0": {
+        "pipeline": "aws_anthropic_manifold_pipeline",
+        "input_price": 3.0,
+        "output_price": 15.0,
+        "ttft": 1.2,
+        "tokens_per_second": 60,
+        "vision": True,
+    },
+    "meta.llama3-1-8b-instruct-v1:0": {
+        "pipeline": "aws_llama_manifold_pipeline",
+        "input_price": 0.3,
+        "output_price": 0.6,
+        "ttft": 0.4,
+        "tokens_per_second": 150,
+        "vision": False,
+    },
+    "meta.llama3-1-70b-instruct-v1:0": {
+        "pipeline": "aws_llama_manifold_pipeline",
+        "input_price": 0.99,
+        "output_price": 0.99,
+        "ttft": 0.7,
+        "tokens_per_second": 60,
+        "vision": False,
+    },
+    "mistral.mistral-large-2407-v1:0": {
+        "pipeline": "aws_mistral_manifold_pipeline",
+        "input_price": 3.0,
+        "output_price": 9.0,
+        "ttft": 0.8,
+        "tokens_per_second": 40,
+        "vision": False,
+    },
+    "gpt-4o-mini": {
+        "pipeline": "openai_manifold_pipeline",
+        "input_price": 0.15,
+        "output_price": 0.6,
+        "ttft": 0.5,
+        "tokens_per_second": 90,
+        "vision": True,
+    },
+    "gpt-4o": {
+        "pipeline": "openai_manifold_pipeline",
+        "input_price": 5.0,
+        "output_price": 15.0,
+        "ttft": 0.6,
+        "tokens_per_second": 80,
+        "vision": True,
+    },
+    "gemini-1.5-flash": {
+        "pipeline": "google_manifold_pipeline",
+        "input_price": 0.075,
+        "output_price": 0.3,
+        "ttft": 0.5,
+        "tokens_per_second": 160,
+        "vision": True,
+    },
+    "gemini-1.5-pro": {
+        "pipeline": "google_manifold_pipeline",
+        "input_price": 3.5,
+        "output_price": 10.5,
+        "ttft": 1.0,
+        "tokens_per_second": 60,
+        "vision": True,
+    },
+}
+
+
+class BackendStats:
+    """Rolling (exponentially weighted) latency and error rate of one backend model"""
+
+    __slots__ = ("ttft", "tokens_per_second", "error_rate", "last_error_at")
+
+    def __init__(self, profile):
+        self.ttft = profile["ttft"]
+        self.tokens_per_second = profile["tokens_per_second"]
+        self.error_rate = 0.0
+        self.last_error_at = 0.0
+
+    def record(self, ttft=None, tokens_per_second=None, error=False, alpha=ROUTER_STATS_ALPHA):
+        self.error_rate += alpha * ((1.0 if error else 0.0) - self.error_rate)
+        if error:
+            self.last_error_at = time.monotonic()
+            return
+        if ttft is not None:
+            self.ttft += alpha * (ttft - self.ttft)
+        if tokens_per_second:
+            self.tokens_per_second += alpha * (tokens_per_second - self.tokens_per_second)
+
+    def healthy(self, now):
+        # An unhealthy backend gets a request now and then, so it can recover
+        return self.error_rate <= ROUTER_MAX_ERROR_RATE or now - self.last_error_at >= ROUTER_RETRY_AFTER
+
+
+def estimate_request(messages, max_tokens=None):
+    """
+    (input tokens, expected output tokens, has images) of an OpenAI style request.
+    The expected output is the average answer so far in the chat, capped by max_tokens.
+    """
+    input_chars = 0
+    images = 0
+    answer_chars = 0
+    answers = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            for item in content:
+                if item.get("type") == "text":
+                    input_chars += len(item.get("text", ""))
+                elif item.get("type") == "image_url":
+                    images += 1
+        elif isinstance(content, str):
+            input_chars += len(content)
+            if message.get("role") == "assistant":
+                answer_chars += len(content)
+                answers += 1
+
+    output_tokens = answer_chars // CHARS_PER_TOKEN // answers if answers else ROUTER_EXPECTED_OUTPUT_TOKENS
+    if max_tokens:
+        output_tokens = min(output_tokens, max_tokens)
+    return input_chars // CHARS_PER_TOKEN + images * IMAGE_TOKENS, max(output_tokens, 1), images > 0
+
+
+class ModelRouter:
+    """
+    Picks a backend model per request for a routing strategy:
+
+    - "cheap": lowest expected price of the request (input and expected output tokens)
+    - "fast": lowest expected time to the end of the answer, from live stats
+
+    Both skip models whose context cannot hold the request, models without
+    vision for requests with images and backends that keep failing, and weigh
+    the rest by their error rate. A decision is a few comparisons per model,
+    well under a millisecond.
+    """
+
+    STRATEGIES = ("cheap", "fast")
+
+    def __init__(self, profiles=MODEL_PROFILES):
+        self.profiles = profiles
+        self.stats = {model_id: BackendStats(profile) for model_id, profile in profiles.items()}
+        self._lock = threading.Lock()
+
+    def cost(self, model_id, input_tokens, output_tokens):
+        profile = self.profiles[model_id]
+        return (input_tokens * profile["input_price"] + output_tokens * profile["output_price"]) / 1e6
+
+    def latency(self, model_id, output_tokens):
+        stats = self.stats[model_id]
+        return stats.ttft + output_tokens / stats.tokens_per_second
+
+    def choose(self, strategy, messages, max_tokens=None, candidates=None):
+        """
+        Return the model id to send the request to, or None when no candidate can
+        take it. `candidates` None means every profiled model, an empty list none.
+        """
+        input_tokens, output_tokens, has_images = estimate_request(messages, max_tokens)
+        now = time.monotonic()
+        best = None
+        best_score = None
+        for model_id in self.profiles if candidates is None else candidates:
+            profile = self.profiles.get(model_id)
+            if profile is None or (has_images and not profile["vision"]):
+                continue
+            context, max_output = get_context_limit(model_id)
+            if input_tokens + min(output_tokens, max_output) > context:
+                continue
+            stats = self.stats[model_id]
+            if not stats.healthy(now):
+                continue
+
+            if strategy == "cheap":
+                score = self.cost(model_id, input_tokens, output_tokens)
+            else:
+                score = self.latency(model_id, output_tokens)
+            # A failed request is paid for and waited on again
+            score /= max(1.0 - stats.error_rate, 0.05)
+            if best_score is None or score < best_score:
+                best, best_score = model_id, score
+        return best
+
+    def record(self, model_id, ttft=None, tokens_per_second=None, error=False):
+        stats = self.stats.get(model_id)
+        if stats is not None:
+            with self._lock:
+                stats.record(ttft, tokens_per_second, error)
@@ -0,0 +1,81 @@
+from ai_gil_utils.tokens import estimate_content_tokens, estimate_tokens
+
+CACHE_CONTROL = {"type": "ephemeral"}
+MAX_CACHE_BREAKPOINTS = 4
+
+# Models with prompt caching on Bedrock, and the smallest prefix they will cache
+PROMPT_CACHING_MIN_TOKENS = {
+    "anthropic.claude-3-5-haiku": 2048,
+    "anthropic.claude-haiku-4": 2048,
+    "anthropic.claude-3-7-sonnet": 1024,
+    "anthropic.claude-sonnet-4": 1024,
+    "anthropic.claude-opus-4": 1024,
+}
+
+
+def get_prompt_caching_min_tokens(model_id):
+    """None when the model does not support prompt caching"""
+    for prefix, min_tokens in PROMPT_CACHING_MIN_TOKENS.items():
+        if prefix in model_id:
+            return min_tokens
+    return None
+
+
+def _with_cache_control(message):
+    # Converted messages are shared with the ConversionCache, so copy instead of mutating
+    content = list(message["content"])
+    content[-1] = {**content[-1], "cache_control": CACHE_CONTROL}
+    return {**message, "content": content}
+
+
+def add_cache_breakpoints(payload, model_id):
+    """
+    Add Anthropic `cache_control` breakpoints to a Bedrock messages payload.
+
+    Breakpoints only go on blocks that stay identical on the next turn:
+    - the system prompt, when it is large enough to be cached on its own
+    - the end of the previous turn, to read what that turn wrote to the cache
+    - the end of the latest message, so the next turn can read the whole history
+    Each one is placed only once the prefix it closes reaches the model's
+    minimum cacheable size, since smaller prefixes are not cached but a write
+    still costs more than a plain input token.
+    """
+    min_tokens = get_prompt_caching_min_tokens(model_id)
+    if min_tokens is None:
+        return payload
+
+    payload = dict(payload)
+    breakpoints = 0
+    prefix_tokens = 0
+
+    system = payload.get("system")
+    if system:
+        prefix_tokens = estimate_tokens(system)
+        if prefix_tokens >= min_tokens:
+            payload["system"] = [{"type": "text", "text": system, "cache_control": CACHE_CONTROL}]
+            breakpoints += 1
+
+    messages = payload["messages"]
+    cumulative_tokens = []
+    for message in messages:
+        prefix_tokens += estimate_content_tokens(message["content"])
+        cumulative_tokens.append(prefix_tokens)
+
+    candidates = [len(messages) - 1]
+    previous_user_turn = next(
+        (i for i in range(len(messages) - 2, -1, -1) if messages[i]["role"] == "user"),
+        None,
+    )
+    if previous_user_turn is not None:
+        candidates.insert(0, previous_user_turn)
+
+    messages = list(messages)
+    for index in candidates:
+        if breakpoints >= MAX_CACHE_BREAKPOINTS:
+            break
+        if index >= 0 and messages[index]["content"] and cumulative_tokens[index] >= min_tokens:
+            messages[index] = _with_cache_control(messages[index])
+            breakpoints += 1
+    payload["messages"] = messages
+    return payload
+
@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "10000"))
+RATE_LIMIT_STATE_PATH = os.getenv("RATE_LIMIT_STATE_PATH", "")  # e.g. /app/ai_gil_utils/cache/rate_limits.json
+RATE_LIMIT_SAVE_INTERVAL = float(os.getenv("RATE_LIMIT_SAVE_INTERVAL", "10"))
+
+
+class TokenBucket:
+    """`capacity` tokens, refilled continuously at `capacity / period` per second"""
+
+    __slots__ = ("capacity", "rate", "tokens", "updated_at")
+
+    def __init__(self, capacity, period=60.0, tokens=None, updated_at=None):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity if tokens is None else tokens
+        self.updated_at = time.time() if updated_at is None else updated_at
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` tokens are available (refill first)"""
+        # A request bigger than the whole bucket only waits for a full bucket
+        missing = min(amount, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+
+class TokenBucketStore:
+    """
+    Named token buckets in an LRU bounded by `max_buckets`, each operation O(1)
+    per bucket. With `path`, the levels are saved there (at most every
+    `save_interval` seconds) and reloaded on start, so a restart does not hand
+    everyone a full budget.
+    """
+
+    def __init__(
+        self, max_buckets=RATE_LIMIT_MAX_BUCKETS, path=RATE_LIMIT_STATE_PATH, save_interval=RATE_LIMIT_SAVE_INTERVAL
+    ):
+        self.max_buckets = max_buckets
+        self.path = path
+        self.save_interval = save_interval
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+        self._load()
+
+    def _bucket(self, key, capacity, now):
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket.capacity != capacity:
+            # New limit from the valves: start over with the new capacity
+            bucket = self._buckets[key] = TokenBucket(capacity, updated_at=now)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.refill(now)
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+        return bucket
+
+    def acquire(self, requests):
+        """
+        Take `amount` from each `(key, capacity, amount)` bucket, all or nothing.
+        Returns 0 when taken, otherwise the seconds to wait before trying again.
+        A capacity of 0 means no limit.
+        """
+        now = time.time()
+        with self._lock:
+            buckets = [(self._bucket(key, capacity, now), amount) for key, capacity, amount in requests if capacity]
+            wait = max((bucket.wait_time(amount) for bucket, amount in buckets), default=0.0)
+            if wait == 0:
+                for bucket, amount in buckets:
+                    bucket.tokens -= min(amount, bucket.capacity)
+            return wait
+
+    def adjust(self, key, amount):
+        """Give back (positive) or charge (negative) tokens once the real usage is known; a bucket can go into debt"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.refill(time.time())
+                bucket.tokens = min(bucket.capacity, bucket.tokens + amount)
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"Could not load rate limits from {self.path}: {e}")
+            return
+        for key, (capacity, tokens, updated_at) in state.items():
+            self._buckets[key] = TokenBucket(capacity, tokens=tokens, updated_at=updated_at)
+
+    def save(self, force=False):
+        if not self.path:
+            return
+        now = time.time()
+        with self._lock:
+            if not force and now - self._saved_at < self.save_interval:
+                return
+            self._saved_at = now
+            state = {key: [bucket.capacity, bucket.tokens, bucket.updated_at] for key, bucket in self._buckets.items()}
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Could not save rate limits to {self.path}: {e}")
@@ -0,0 +1,302 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+import requests
+
+from ai_gil_utils.logs import get_logger
+from ai_gil_utils.metrics import CIRCUIT_REJECTIONS, RETRIES
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))  # first call included
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))  # seconds, doubled per attempt
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))  # retries earned per call
+RETRY_BUDGET_MAX = float(os.getenv("RETRY_BUDGET_MAX", "10"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))  # retryable failures in a row
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))  # seconds open before a trial call
+
+# Bedrock error codes (lowercase: errors inside event streams use camelCase) and
+# HTTP statuses that are worth another try: throttling, overload and outages
+RETRYABLE_ERROR_CODES = {
+    "throttlingexception",
+    "toomanyrequestsexception",
+    "serviceunavailableexception",
+    "serviceunavailable",
+    "modelnotreadyexception",
+    "internalserverexception",
+    "modelstreamerrorexception",
+}
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504, 529}
+# botocore network errors, matched by name so this module does not need botocore
+RETRYABLE_EXCEPTION_NAMES = {"ConnectTimeoutError", "ReadTimeoutError", "EndpointConnectionError", "ConnectionClosedError"}
+
+logger = get_logger("resilience")
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit breaker is open"""
+
+
+def is_retryable(error):
+    """Whether `error` from boto3, requests or google-generativeai is transient"""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        # botocore ClientError
+        return response.get("Error", {}).get("Code", "").lower() in RETRYABLE_ERROR_CODES
+    # requests HTTPError, or google.api_core errors whose `code` is the HTTP status
+    status = getattr(response, "status_code", None) or getattr(error, "code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS_CODES
+    return type(error).__name__ in RETRYABLE_EXCEPTION_NAMES
+
+
+def is_provider_response(error):
+    """Whether `error` is an answer of the provider (an error response), not a failure on our side"""
+    response = getattr(error, "response", None)
+    if isinstance(response, dict) or isinstance(getattr(response, "status_code", None), int):
+        # botocore ClientError, requests HTTPError
+        return True
+    # google.api_core errors
+    return isinstance(getattr(error, "code", None), int)
+
+
+def _retry_after(error):
+    """Seconds the provider asked to wait (Retry-After header), if any"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After", ""))
+    except ValueError:
+        return None
+
+
+class CircuitBreaker:
+    """
+    Closed while the provider works. After `failure_threshold` retryable
+    failures in a row it opens and calls fail fast with CircuitOpenError; after
+    `reset_timeout` seconds one trial call goes through, closing it again on
+    success or reopening it on failure.
+    """
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        if self.opened_at is None:
+            return
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining <= 0 and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return
+        CIRCUIT_REJECTIONS.inc((self.name,))
+        raise CircuitOpenError(
+            f"{self.name} is failing, calls are paused for {max(remaining, 1):.0f} more seconds"
+        )
+
+    def success(self):
+        if self.failures or self.opened_at is not None:
+            with self._lock:
+                self.failures = 0
+                self.opened_at = None
+                self.trial_in_flight = False
+
+    def release_trial(self):
+        """Let another trial call through when this one ended without an answer either way"""
+        if self.trial_in_flight:
+            with self._lock:
+                self.trial_in_flight = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(
+                        "Circuit breaker opened", extra={"fields": {"provider": self.name, "failures": self.failures}}
+                    )
+                self.opened_at = time.monotonic()
+
+
+class RetryBudget:
+    """
+    Every call earns `ratio` retries, up to `maximum`, and every retry spends
+    one: retries stay a small share of the traffic, so an outage is not
+    multiplied into a retry storm.
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, maximum=RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.tokens = maximum
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider_guards(provider):
+    """(CircuitBreaker, RetryBudget) shared by every call to `provider`"""
+    guards = _providers.get(provider)
+    if guards is None:
+        with _providers_lock:
+            guards = _providers.get(provider)
+            if guards is None:
+                guards = _providers[provider] = (CircuitBreaker(provider), RetryBudget())
+    return guards
+
+
+def _backoff_delay(provider, attempt, error):
+    """Full jitter exponential backoff, at least what the provider asked for"""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+    retry_after = _retry_after(error)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, RETRY_MAX_DELAY))
+    RETRIES.inc((provider, type(error).__name__))
+    logger.info(
+        "Retrying provider call",
+        extra={"fields": {"provider": provider, "delay": round(delay, 2), "error": f"{type(error).__name__}: {error}"}},
+    )
+    return delay
+
+
+def _backoff(provider, attempt, error):
+    time.sleep(_backoff_delay(provider, attempt, error))
+
+
+def _should_retry(provider, attempt, error, budget):
+    return attempt + 1 < RETRY_MAX_ATTEMPTS and is_retryable(error) and budget.withdraw()
+
+
+def _settle(breaker, error):
+    """Report a call that failed with a non-retryable `error` to the breaker"""
+    if is_provider_response(error):
+        # The provider answered, the request itself is wrong
+        breaker.success()
+    else:
+        # A bug on our side (KeyError, a parse error...) says nothing about the provider
+        breaker.release_trial()
+
+
+def call_with_retry(provider, function, *args, **kwargs):
+    """
+    `function(*args, **kwargs)` behind the provider's circuit breaker, retried
+    with jittered exponential backoff on retryable errors while the retry
+    budget allows. Other errors are raised right away.
+    """
+    breaker, budget = get_provider_guards(provider)
+    budget.deposit()
+    attempt = 0
+    while True:
+        breaker.allow()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                _settle(breaker, e)
+                raise
+            breaker.failure()
+            if not _should_retry(provider, attempt, e, budget):
+                raise
+            _backoff(provider, attempt, e)
+            attempt += 1
+            continue
+        breaker.success()
+        return result
+
+
+async def call_with_retry_async(provider, function, *args, **kwargs):
+    """call_with_retry for coroutine functions, waiting between attempts without blocking the event loop"""
+    breaker, budget = get_provider_guards(provider)
+    budget.deposit()
+    attempt = 0
+    while True:
+        breaker.allow()
+        try:
+            result = await function(*args, **kwargs)
+        except asyncio.CancelledError:
+            breaker.release_trial()
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                _settle(breaker, e)
+                raise
+            breaker.failure()
+            if not _should_retry(provider, attempt, e, budget):
+                raise
+            await asyncio.sleep(_backoff_delay(provider, attempt, e))
+            attempt += 1
+            continue
+        breaker.success()
+        return result
+
+
+def retry_stream(provider, open_stream, stream=None):
+    """
+    Iterate `open_stream()` like call_with_retry, and while nothing has been
+    yielded yet, a retryable error (including one raised by the first
+    `next()`, e.g. throttling inside a Bedrock event stream) reopens the stream.
+    Once a chunk went out, the caller has seen part of the answer and errors
+    are raised as they are. `stream` is an already opened first attempt.
+    """
+    breaker, budget = get_provider_guards(provider)
+    if stream is None:
+        budget.deposit()
+    attempt = 0
+    emitted = False
+    while True:
+        try:
+            if stream is None:
+                breaker.allow()
+                stream = open_stream()
+            for chunk in stream:
+                if chunk and not emitted:
+                    emitted = True
+                    breaker.success()
+                yield chunk
+            if not emitted:
+                breaker.success()
+            return
+        except CircuitOpenError:
+            raise
+        except GeneratorExit:
+            # The caller left before the provider answered: this says nothing
+            # about the provider, but a trial call must not stay in flight
+            if not emitted:
+                breaker.release_trial()
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                if not emitted:
+                    _settle(breaker, e)
+                raise
+            breaker.failure()
+            if emitted or not _should_retry(provider, attempt, e, budget):
+                raise
+            _backoff(provider, attempt, e)
+            attempt += 1
+            stream = None
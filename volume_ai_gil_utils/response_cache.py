@@ -0,0 +1,152 @@
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+AI_GIL_CACHE_MAX_ENTRIES = int(os.getenv("AI_GIL_CACHE_MAX_ENTRIES", "1024"))
+AI_GIL_CACHE_TTL_SECONDS = float(os.getenv("AI_GIL_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+AI_GIL_CACHE_MAX_DISK_ENTRIES = int(os.getenv("AI_GIL_CACHE_MAX_DISK_ENTRIES", "100000"))
+AI_GIL_CACHE_PATH = os.getenv("AI_GIL_CACHE_PATH", "")  # e.g. /app/ai_gil_utils/cache/responses.sqlite3
+
+
+def make_cache_key(model_id, system_prompt, prompt, max_tokens, temperature):
+    raw = json.dumps([model_id, system_prompt, prompt, max_tokens, temperature], ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Exact-match cache for model responses.
+
+    Two tiers: an in-memory LRU bounded by `max_entries`, and an optional SQLite
+    file at `path` that survives restarts, bounded by `max_disk_entries`. Both
+    drop entries older than `ttl`; the file is swept every `SWEEP_EVERY` writes.
+    Values are copied in and out, callers may modify what they get.
+    """
+
+    SWEEP_EVERY = 100
+
+    def __init__(
+        self,
+        max_entries=AI_GIL_CACHE_MAX_ENTRIES,
+        ttl=AI_GIL_CACHE_TTL_SECONDS,
+        path=AI_GIL_CACHE_PATH,
+        max_disk_entries=AI_GIL_CACHE_MAX_DISK_ENTRIES,
+    ):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._writes = 0
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, created_at REAL, value TEXT)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+            self._sweep()
+            self._db.commit()
+
+    def _expired(self, created_at):
+        return self.ttl and time.time() - created_at > self.ttl
+
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, value = entry
+                if not self._expired(created_at):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return copy.deepcopy(value)
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT created_at, value FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    created_at, raw = row
+                    if not self._expired(created_at):
+                        value = json.loads(raw)
+                        self._store_in_memory(key, created_at, value)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return copy.deepcopy(value)
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        created_at = time.time()
+        with self._lock:
+            self._store_in_memory(key, created_at, copy.deepcopy(value))
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, created_at, value) VALUES (?, ?, ?)",
+                    (key, created_at, json.dumps(value)),
+                )
+                self._writes += 1
+                if self._writes % self.SWEEP_EVERY == 0:
+                    self._sweep()
+                self._db.commit()
+
+    def _sweep(self):
+        """Delete expired rows, then the oldest ones beyond max_disk_entries (caller commits)"""
+        if self.ttl:
+            self._db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+        if self.max_disk_entries:
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_disk_entries,),
+            )
+
+    def _store_in_memory(self, key, created_at, value):
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+            }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Process-wide cache configured from the AI_GIL_CACHE_* environment variables"""
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = ResponseCache()
+    return _default_cache
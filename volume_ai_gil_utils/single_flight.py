@@ -0,0 +1,248 @@
+import functools
+import os
+import threading
+
+from ai_gil_utils.message_cache import messages_shape, same_messages
+from ai_gil_utils.metrics import COALESCED_REQUESTS
+
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+# Body keys that change the answer, on top of the model and the messages
+SAMPLING_KEYS = (
+    "temperature",
+    "top_p",
+    "top_k",
+    "max_tokens",
+    "stop",
+    "seed",
+    "frequency_penalty",
+    "presence_penalty",
+    "stream",
+)
+
+
+def request_key(model_id, messages, body):
+    """
+    Key of a deterministic request, or None when it must not be shared: only
+    temperature 0 answers are the same for every caller. The messages only
+    count by their shape, SingleFlight compares them when the key is in flight.
+    """
+    if body.get("temperature") != 0:
+        return None
+    params = tuple(_freeze(body.get(key)) for key in SAMPLING_KEYS)
+    return model_id, params, messages_shape(messages)
+
+
+def _freeze(value):
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple((key, _freeze(item)) for key, item in value.items())
+    return value
+
+
+class _Flight:
+    """One provider call and everything its callers need to share it"""
+
+    __slots__ = (
+        "messages",
+        "ready",
+        "result",
+        "error",
+        "source",
+        "chunks",
+        "done",
+        "fetching",
+        "subscribers",
+        "condition",
+    )
+
+    def __init__(self, messages):
+        self.messages = messages  # compared with the messages of callers arriving under the same key
+        self.ready = threading.Event()
+        self.result = None
+        self.error = None
+        self.source = None  # the leader's stream, pulled by whichever subscriber needs the next chunk
+        self.chunks = []  # everything streamed so far, replayed to callers that join late
+        self.done = False
+        self.fetching = False
+        self.subscribers = 0
+        self.condition = threading.Condition()
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight requests of one pipeline.
+
+    The first caller of a key runs the request. Callers arriving while it is
+    in flight wait for the same answer, or for a stream get every chunk from
+    the start, as if they had made the call. The flight is forgotten as soon
+    as it ends, so this never serves stale answers: it is not a cache.
+
+    Streams are pulled through: the subscriber that is furthest ahead reads
+    the next chunk from the provider and the others take it from the buffer,
+    so the stream moves at the pace of its fastest reader. When every
+    subscriber has gone, the provider stream is closed.
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, function, messages=()):
+        """
+        Return `function()`, or the result of the call already running under
+        `key` for the same `messages`. Keys are cheap, the messages are only
+        compared once a call with the same key is in flight.
+        """
+        if key is None:
+            return function()
+
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight(messages)
+                # Counted on arrival, so a stream is not closed under a caller that is about to read it
+                flight.subscribers += 1
+                leader = True
+            else:
+                leader = False
+
+        if leader:
+            return self._lead(key, flight, function)
+        # Compared outside the lock, this reads every string of both chats
+        if not same_messages(flight.messages, messages):
+            return function()
+        with self._lock:
+            joined = self._flights.get(key) is flight
+            if joined:
+                flight.subscribers += 1
+        if not joined:
+            # It ended in the meantime
+            return self.run(key, function, messages)
+
+        COALESCED_REQUESTS.inc((self.pipeline, key[0]))
+        flight.ready.wait()
+        if flight.error is not None:
+            raise flight.error
+        if flight.source is None:
+            return flight.result
+        return self._subscribe(key, flight)
+
+    def _lead(self, key, flight, function):
+        try:
+            result = function()
+        except BaseException as e:
+            flight.error = e
+            self._forget(key, flight)
+            flight.ready.set()
+            raise
+
+        if isinstance(result, (str, bytes, dict)) or not hasattr(result, "__next__"):
+            flight.result = result
+            self._forget(key, flight)
+            flight.ready.set()
+            return result
+
+        flight.source = result
+        flight.ready.set()
+        return self._subscribe(key, flight)
+
+    def _subscribe(self, key, flight):
+        position = 0
+        finished = False
+        try:
+            while True:
+                with flight.condition:
+                    while position >= len(flight.chunks) and not flight.done and flight.fetching:
+                        flight.condition.wait()
+                    fetch = position >= len(flight.chunks) and not flight.done
+                    if fetch:
+                        flight.fetching = True
+                    elif position < len(flight.chunks):
+                        chunk = flight.chunks[position]
+                    elif flight.error is not None:
+                        raise flight.error
+                    else:
+                        finished = True
+                        return
+
+                if fetch and not self._fetch(key, flight):
+                    continue
+                if fetch:
+                    chunk = flight.chunks[position]
+                position += 1
+                yield chunk
+        finally:
+            if not finished:
+                self._leave(key, flight)
+
+    def _fetch(self, key, flight):
+        """Read the next chunk from the provider outside the lock; False once the stream has ended"""
+        error = None
+        try:
+            chunk = next(flight.source)
+            ended = False
+        except StopIteration:
+            ended = True
+        except BaseException as e:
+            error = e
+            ended = True
+        with flight.condition:
+            flight.fetching = False
+            if ended:
+                flight.done = True
+                flight.error = error
+            else:
+                flight.chunks.append(chunk)
+            flight.condition.notify_all()
+        if ended:
+            self._forget(key, flight)
+        return not ended
+
+    def _leave(self, key, flight):
+        """A subscriber stopped reading early: the last one out closes the provider stream"""
+        with self._lock:
+            flight.subscribers -= 1
+            if flight.subscribers > 0 or flight.done:
+                return
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        with flight.condition:
+            flight.done = True
+            flight.condition.notify_all()
+        close = getattr(flight.source, "close", None)
+        if close is not None:
+            close()
+
+    def _forget(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+
+def coalesce_identical(pipeline):
+    """
+    Decorator for a pipeline's `pipe`: identical temperature 0 requests that
+    arrive while one is in flight share its answer or stream.
+
+        @coalesce_identical("aws_anthropic")
+        def pipe(self, user_message, model_id, messages, body): ...
+    """
+    single_flight = SingleFlight(pipeline)
+
+    def decorator(pipe):
+        @functools.wraps(pipe)
+        def wrapper(self, user_message, model_id, messages, body):
+            if not SINGLE_FLIGHT_ENABLED:
+                return pipe(self, user_message, model_id, messages, body)
+            key = request_key(model_id, messages, body)
+            if key is not None:
+                # Two instances of the same pipeline (e.g. other valves) never share answers
+                key += (id(self),)
+            return single_flight.run(key, lambda: pipe(self, user_message, model_id, messages, body), messages)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,107 @@
+"""
+Cold-start cost of the pipelines.
+
+The server imports every file of the pipelines directory and builds its
+Pipeline at boot, so SDK imports and client construction are deferred to a
+background warm-up (start_warm_up) or the first request. To see what each
+pipeline still costs at load, run in the pipelines container:
+
+    python -m ai_gil_utils.startup /app/pipelines
+
+Each file is loaded in a fresh interpreter, as after a container restart, and
+the import and Pipeline() times are reported, plus the warm-up when the
+pipeline has one.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+STARTUP_WARM_UP = os.getenv("STARTUP_WARM_UP", "true").lower() == "true"
+
+
+def start_warm_up(name, warm_up):
+    """Run `warm_up()` (SDK imports, client construction) in a background thread, off the request path"""
+    if not STARTUP_WARM_UP:
+        return None
+
+    def run():
+        start = time.perf_counter()
+        try:
+            warm_up()
+        except Exception as e:
+            print(f"Warm-up of {name} failed: {e}")
+            return
+        print(f"Warmed up {name} in {time.perf_counter() - start:.2f}s")
+
+    thread = threading.Thread(target=run, name=f"warm-up-{name}", daemon=True)
+    thread.start()
+    return thread
+
+
+def time_pipeline(path):
+    """Load one pipeline file like the server does: seconds to import it, build it and warm it up"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    start = time.perf_counter()
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    imported = time.perf_counter()
+    pipeline = module.Pipeline()
+    built = time.perf_counter()
+    timings = {"pipeline": name, "import_s": imported - start, "init_s": built - imported, "warm_up_s": None}
+    warm_up = getattr(pipeline, "warm_up", None)
+    if warm_up is not None:
+        try:
+            warm_up()
+            timings["warm_up_s"] = time.perf_counter() - built
+        except Exception as e:
+            timings["warm_up_error"] = str(e)
+    return timings
+
+
+def report(pipelines_dir, child_command=None):
+    """Time every pipeline file of `pipelines_dir`, each in a fresh interpreter"""
+    child_command = child_command or [sys.executable, "-m", "ai_gil_utils.startup"]
+    results = []
+    for file_name in sorted(os.listdir(pipelines_dir)):
+        if not file_name.endswith(".py") or file_name.startswith("_"):
+            continue
+        path = os.path.join(pipelines_dir, file_name)
+        child = subprocess.run(child_command + ["--child", path], capture_output=True, text=True)
+        lines = child.stdout.strip().splitlines()
+        try:
+            results.append(json.loads(lines[-1]))
+        except (IndexError, ValueError):
+            error = (child.stderr.strip().splitlines() or ["no output"])[-1]
+            results.append({"pipeline": file_name[:-3], "error": error})
+
+    print(f"{'pipeline':<42}{'import_ms':>12}{'init_ms':>12}{'warm_up_ms':>12}")
+    for result in results:
+        if "error" in result:
+            print(f"{result['pipeline']:<42}  failed: {result['error']}")
+            continue
+        warm_up = "-" if result["warm_up_s"] is None else f"{result['warm_up_s'] * 1000:.1f}"
+        print(f"{result['pipeline']:<42}{result['import_s'] * 1000:>12.1f}{result['init_s'] * 1000:>12.1f}{warm_up:>12}")
+    return results
+
+
+def main(argv=None, child_command=None):
+    parser = argparse.ArgumentParser(description="Import and init time of every pipeline")
+    parser.add_argument("path", nargs="?", default="/app/pipelines", help="pipelines directory")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        # The pipeline's own prints go to stdout too, the timings are the last line
+        print(json.dumps(time_pipeline(args.path)))
+    else:
+        report(args.path, child_command)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import json
+import os
+import time
+
+try:
+    import orjson
+except ImportError:  # the standard library decoder takes bytes too, just slower
+    orjson = None
+
+# Deltas are merged into one chunk until the window is over or the merged text
+# is this long. The first delta always goes out alone, so the time to first
+# token does not change.
+STREAM_COALESCE_WINDOW = float(os.getenv("STREAM_COALESCE_WINDOW", "0.03"))  # seconds, 0 disables coalescing
+STREAM_COALESCE_SIZE = int(os.getenv("STREAM_COALESCE_SIZE", "256"))  # characters, 0 for no limit
+
+# Anthropic stream events the pipelines have nothing to take from. On Bedrock
+# message_stop carries the invocation metrics, usage is read from message_start
+# and message_delta instead.
+ANTHROPIC_SKIPPED_EVENTS = ("ping", "content_block_stop", "message_stop")
+
+# "type" is the first key of every Anthropic event, so it is within the first bytes
+_TYPE_PREFIX_BYTES = 40
+
+loads = orjson.loads if orjson is not None else json.loads
+
+
+def decode_events(events, skip_types=()):
+    """
+    Payloads of a Bedrock response stream as dicts, skipping the events whose
+    "type" is in `skip_types` without parsing them. Skipping only looks at the
+    start of the raw bytes: an event it misses is parsed as usual.
+    """
+    markers = [f'"type":"{event_type}"'.encode() for event_type in skip_types]
+    for event in events:
+        raw = event["chunk"]["bytes"]
+        if markers and any(raw.find(marker, 0, _TYPE_PREFIX_BYTES) != -1 for marker in markers):
+            continue
+        yield loads(raw)
+
+
+def coalesce_deltas(chunks, window=None, max_size=None):
+    """
+    Merge consecutive text chunks, so each SSE frame downstream carries several
+    tokens instead of one. The first chunk is yielded right away, then text is
+    held until `window` seconds passed since the last flush or `max_size`
+    characters are buffered. The window is checked as chunks arrive, so text
+    is only held when the next chunk is expected in time: when the gap since
+    the previous chunk says it would come after the window closed (a slow
+    model, or one resuming after a pause), the buffer goes out at once. Text
+    held right before an unexpected pause still waits for the next chunk.
+    Non-text chunks flush the buffer and pass through unchanged.
+    """
+    window = STREAM_COALESCE_WINDOW if window is None else window
+    max_size = STREAM_COALESCE_SIZE if max_size is None else max_size
+    if window <= 0:
+        yield from chunks
+        return
+
+    buffer = []
+    size = 0
+    flushed_at = None
+    last_at = None
+    for chunk in chunks:
+        if type(chunk) is not str:
+            if buffer:
+                yield "".join(buffer)
+                buffer, size = [], 0
+            yield chunk
+            continue
+        if not chunk:
+            continue
+        if flushed_at is None:
+            # First token, the user is waiting for it
+            flushed_at = last_at = time.monotonic()
+            yield chunk
+            continue
+        buffer.append(chunk)
+        size += len(chunk)
+        now = time.monotonic()
+        # At the pace of the last gap, would the next chunk come after the window?
+        next_at = now + (now - last_at)
+        last_at = now
+        if next_at - flushed_at > window or (max_size > 0 and size >= max_size):
+            yield "".join(buffer)
+            buffer, size = [], 0
+            flushed_at = now
+    if buffer:
+        yield "".join(buffer)
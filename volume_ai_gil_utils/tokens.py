@@ -0,0 +1,22 @@
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1600  # a ~1.15 megapixel image on Claude, in the same range on Gemini and GPT-4o
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token), good enough for budgeting"""
+    return len(text or "") // CHARS_PER_TOKEN + 1
+
+
+def estimate_content_tokens(content):
+    """Estimate for a message content in OpenAI, Anthropic or Gemini shape"""
+    if isinstance(content, str):
+        return estimate_tokens(content)
+    if isinstance(content, list):
+        return sum(estimate_content_tokens(item) for item in content)
+    if isinstance(content, dict):
+        if content.get("type") in ("image", "image_url") or "inline_data" in content:
+            return IMAGE_TOKENS
+        if "text" in content:
+            return estimate_tokens(content["text"])
+        return estimate_content_tokens(content.get("content") or content.get("parts"))
+    return 0